@@ -0,0 +1 @@
+# init file to designate this directory as a package
@@ -0,0 +1,105 @@
+# Stand-in page data for rendering templates in benchmarks, without
+# needing any storage
+import datetime
+
+
+class FakeUser(object):
+    def __init__(self, uid, name):
+        self.uid = uid
+        self.name = name
+
+
+class FakeComment(object):
+    def __init__(self, cid, author, text):
+        self.cid = cid
+        self.author = author
+        self.text = text
+        self.created = datetime.datetime(2017, 1, 1)
+
+    def get_id(self):
+        return self.cid
+
+    def get_author(self):
+        return self.author.name
+
+
+class FakePost(object):
+    def __init__(self, blog_id, author, subject, content, likes=0,
+                 comments=0):
+        self.blog_id = blog_id
+        self.author = author
+        self.subject = subject
+        self.content = content
+        self.likes = likes
+        self.comments = comments
+        self.created = datetime.datetime(2017, 1, 1)
+
+    def get_id(self):
+        return self.blog_id
+
+    def like_count(self):
+        return self.likes
+
+    def comment_count(self):
+        return self.comments
+
+
+class FakeSummary(object):
+    def __init__(self, post, excerpt_size=300):
+        self.blog_id = post.blog_id
+        self.author_name = post.author.name
+        self.subject = post.subject
+        self.excerpt = post.content[:excerpt_size]
+        self.truncated = len(post.content) > excerpt_size
+        self.like_count = post.likes
+        self.comment_count = post.comments
+        self.created = post.created
+
+    def get_id(self):
+        return self.blog_id
+
+
+class FakeStats(object):
+    def __init__(self, posts, likes, comments):
+        self.post_count = posts
+        self.like_count = likes
+        self.comment_count = comments
+
+
+def make_posts(count, content_size=2000):
+    """ Returns a list of posts by a handful of authors """
+    authors = [FakeUser(i, 'author%d' % i) for i in range(1, 6)]
+    return [FakePost(i, authors[i % len(authors)], 'Subject %d' % i,
+                     'x' * content_size, likes=i, comments=i)
+            for i in range(1, count + 1)]
+
+def make_summaries(count, content_size=2000):
+    """ Returns a list of summaries of posts by a handful of authors """
+    return [FakeSummary(post) for post in make_posts(count, content_size)]
+
+def make_comments(count, text_size=300):
+    """ Returns a list of comments by a handful of authors """
+    authors = [FakeUser(i, 'reader%d' % i) for i in range(1, 21)]
+    return [FakeComment(i, authors[i % len(authors)], 'y' * text_size)
+            for i in range(1, count + 1)]
+
+def page_params():
+    """ Returns example render parameters for every page template """
+    user = FakeUser(1, 'author1')
+    posts = make_posts(10)
+    summaries = make_summaries(10)
+    entry = posts[0]
+    return {
+        'front.html': dict(entries=summaries, next_cursor='abc', page_size=10,
+                           pager_url='/blog', user=None),
+        'permalink.html': dict(entry=entry, comments=make_comments(50),
+                               user=user),
+        'welcome.html': dict(username=user.name, entries=summaries, user=user,
+                             stats=FakeStats(10, 55, 55), page_size=10,
+                             pager_url='/blog/welcome'),
+        'form.html': dict(subject=entry.subject, content=entry.content,
+                          user=user),
+        'comment.html': dict(entry=entry, comment='Nice', user=user),
+        'login.html': dict(),
+        'signup.html': dict(username='someone'),
+    }
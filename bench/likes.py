@@ -0,0 +1,149 @@
+# Benchmark of like throughput on one hot post.
+#
+# Seeds a fresh in-memory local store (see storage/local.py) with an
+# author and a few posts, then drives blog.app in-process with --likes
+# like requests on the newest post, each by a different user. Every
+# --front-every likes it requests the front page --front-requests
+# times, so its latency is measured while the likes keep coming and the
+# like count grows. It reports:
+#   likes - requests, throughput, mean/p50/p95/p99 latency in
+#     milliseconds, the status codes seen, and the storage calls per
+#     like
+#   front - the same for the front page, over the whole run and for
+#     each tenth of the likes
+#   counts - the likes counted on the post and shown on its summary
+#     once the run is over, which should both equal --likes
+# as JSON. The exit status is 1 if either count is off.
+#
+# With --buffer, likes go through the write-behind buffer (see
+# models/likebuffer.py), which is flushed at the end of the run.
+#
+# Usage: python -m bench.likes [options] [--output FILE]
+import json
+import optparse
+import os
+import sys
+import time
+
+# The benchmark always runs against the local storage engine
+os.environ['BLOG_STORAGE'] = 'local'
+
+import webapp2
+
+import blog
+import instrument
+import utils
+from storage import local
+from models import likebuffer
+from models.user import User
+from models.post import BlogPost
+from models.summary import PostSummary, SummaryIndex
+
+from bench.loadtest import ms, summarize
+
+# Number of stages the front page latency is reported for
+STAGES = 10
+
+
+def seed(options):
+    """ Fills a fresh local store and returns the id of the newest post,
+    which is the one liked. The users who like it aren't stored, since
+    a like only needs their session cookie.
+    """
+    local.reset()
+    author = User.register('author', utils.make_pw_hash('author', 'bench'))
+    post_ids = [BlogPost.create(author.key(), author.name, 'Post %d' % i,
+                                'Content of post %d' % i).get_id()
+                for i in range(options.posts)]
+    SummaryIndex.mark_complete()
+    return post_ids[-1]
+
+def like_request(blog_id, uid):
+    """ Returns a request liking the post as the user with this id """
+    name = 'liker%d' % uid
+    cookie = 'user_id=%s' % utils.make_session_token(uid, name)
+    return webapp2.Request.blank('/blog/%d/like' % blog_id,
+                                 headers={'Cookie': cookie})
+
+def timed(request):
+    """ Returns a tuple (elapsed, status, counter) for the response to
+    request
+    """
+    with instrument.counting() as counter:
+        start = time.time()
+        response = request.get_response(blog.app)
+        # Read streamed bodies in full, so their render is timed
+        response.body
+        elapsed = time.time() - start
+    return elapsed, response.status_int, counter
+
+def run(blog_id, options):
+    """ Makes the requests and returns the report dict """
+    # Like ids start well above those of the stored users
+    first_uid = 1000000
+    likes = []
+    front = [[] for i in range(STAGES)]
+    stage_size = max(options.likes // STAGES, 1)
+    started = time.time()
+    for i in range(options.likes):
+        likes.append(timed(like_request(blog_id, first_uid + i)))
+        if (i + 1) % options.front_every == 0:
+            stage = min(i // stage_size, STAGES - 1)
+            for j in range(options.front_requests):
+                front[stage].append(timed(webapp2.Request.blank('/blog')))
+    duration = time.time() - started
+    if likebuffer.enabled():
+        likebuffer.get_buffer().flush()
+    post = BlogPost.get_with_counts(blog_id)
+    summary = PostSummary.get(PostSummary.summary_key(post.key()))
+    all_front = sum(front, [])
+    return {
+        'options': dict((name, getattr(options, name))
+                        for name in OPTIONS),
+        'duration_s': round(duration, 3),
+        'likes': summarize(likes, duration),
+        'front': all_front and summarize(all_front, duration) or None,
+        'front_p95_ms_by_stage': [
+            results and ms(instrument.percentile(
+                sorted(elapsed for elapsed, status, counter in results),
+                95)) or None
+            for results in front],
+        'counts': {'post': post.like_count(),
+                   'summary': summary and summary.like_count}}
+
+# Options kept in the report, so results are only compared with like
+# runs
+OPTIONS = ['likes', 'posts', 'front_every', 'front_requests', 'buffer']
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--likes', type='int', default=100000)
+    parser.add_option('--posts', type='int', default=20,
+                      help='number of posts on the front page')
+    parser.add_option('--front-every', type='int', default=1000,
+                      help='likes between front page samples')
+    parser.add_option('--front-requests', type='int', default=10,
+                      help='front page requests per sample')
+    parser.add_option('--buffer', action='store_true', default=False,
+                      help='buffer likes (BLOG_LIKE_BUFFER=on)')
+    parser.add_option('--output', help='file to write the report to')
+    options, args = parser.parse_args()
+
+    if options.buffer:
+        os.environ['BLOG_LIKE_BUFFER'] = 'on'
+    blog_id = seed(options)
+    report = run(blog_id, options)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    print output
+    counts = report['counts']
+    if counts['post'] != options.likes or counts['summary'] != options.likes:
+        sys.stderr.write('Likes were lost or not shown\n')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
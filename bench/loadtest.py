@@ -0,0 +1,293 @@
+# Load test of the blog with a realistic traffic mix.
+#
+# Seeds a fresh in-memory local store (see storage/local.py) with users,
+# posts, comments and likes. A few hot posts draw a large share of the
+# comments, likes and traffic. Then it drives blog.app in-process with a
+# weighted mix of front page, permalink, like, comment, login and
+# welcome requests, and reports for each route:
+#   requests, throughput, mean/p50/p95/p99 latency in milliseconds,
+#   the status codes seen, and the storage calls per request
+# as JSON. Everything random comes from --seed, so runs with the same
+# options make the same requests.
+#
+# With --baseline, the results are compared with a stored report: a
+# route regresses if its p95 latency grows by more than --tolerance, or
+# if it makes more storage calls per request. The exit status is 1 if
+# any route regressed.
+#
+# Usage: python -m bench.loadtest [options] [--output FILE]
+#                                 [--baseline FILE]
+import json
+import optparse
+import os
+import random
+import sys
+import time
+
+# The load test always runs against the local storage engine
+os.environ['BLOG_STORAGE'] = 'local'
+
+import webapp2
+
+import blog
+import instrument
+import utils
+from storage import db, local
+from models.user import User
+from models.post import BlogPost
+from models.comment import Comment
+from models.like import Like
+from models.summary import SummaryIndex
+
+PASSWORD = 'loadtest'
+
+# Share of requests of each kind, by default
+DEFAULT_MIX = 'front=35,permalink=35,welcome=10,like=8,comment=7,login=5'
+
+# Route names used in the report
+ROUTES = {
+    'front': '/blog',
+    'permalink': '/blog/<id>',
+    'welcome': '/blog/welcome',
+    'like': '/blog/<id>/like',
+    'comment': '/blog/<id>/comment',
+    'login': '/blog/login',
+}
+
+
+class Site(object):
+    """ Site class for holding the seeded data the requests are made
+    against
+
+    Attributes:
+        users - list of (user id, username) tuples
+        posts - list of post ids, hot posts first
+        hot_posts - number of hot posts at the start of posts
+        hot_share - share of activity that goes to the hot posts
+    """
+    def __init__(self, hot_posts, hot_share):
+        self.users = []
+        self.posts = []
+        self.hot_posts = hot_posts
+        self.hot_share = hot_share
+
+    def pick_post(self, rand):
+        """ Returns a post id, favouring the hot posts """
+        if self.hot_posts and rand.random() < self.hot_share:
+            return self.posts[rand.randrange(self.hot_posts)]
+        return rand.choice(self.posts)
+
+    def pick_user(self, rand):
+        """ Returns a (user id, username) tuple """
+        return rand.choice(self.users)
+
+
+def seed(options, rand):
+    """ Fills a fresh local store and returns the Site """
+    local.reset()
+    site = Site(min(options.hot_posts, options.posts), options.hot_share)
+    for i in range(options.users):
+        name = 'user%d' % i
+        user = User.register(name, utils.make_pw_hash(name, PASSWORD))
+        site.users.append((user.key().id(), name))
+    for i in range(options.posts):
+        uid, name = site.pick_user(rand)
+        post = BlogPost.create(db_key(uid), name, 'Post %d' % i,
+                               rand_text(rand, options.post_size))
+        site.posts.append(post.get_id())
+    for i in range(options.comments):
+        uid, name = site.pick_user(rand)
+        Comment.create(site.pick_post(rand), db_key(uid),
+                       rand_text(rand, 200))
+    for i in range(options.likes):
+        uid, name = site.pick_user(rand)
+        Like.add(site.pick_post(rand), uid)
+    # Every seeded post has its summary
+    SummaryIndex.mark_complete()
+    return site
+
+def db_key(uid):
+    """ Returns the key of the user with this id """
+    return db.Key.from_path('User', uid)
+
+def rand_text(rand, size):
+    """ Returns size characters of words """
+    words = []
+    length = 0
+    while length < size:
+        word = ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz')
+                       for i in range(rand.randint(2, 9)))
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+def parse_mix(mix):
+    """ Returns a list of (kind, weight) pairs from 'kind=weight,...' """
+    pairs = []
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        if kind not in ROUTES:
+            raise ValueError('Unknown request kind: %s' % kind)
+        pairs.append((kind, float(weight)))
+    return pairs
+
+def pick_kind(mix, rand):
+    """ Returns a request kind, chosen by the weights of mix """
+    point = rand.random() * sum(weight for kind, weight in mix)
+    for kind, weight in mix:
+        point -= weight
+        if point < 0:
+            return kind
+    return mix[-1][0]
+
+def make_request(kind, site, rand):
+    """ Returns a webapp2 request of this kind """
+    uid, name = site.pick_user(rand)
+    cookie = {'Cookie': 'user_id=%s' % utils.make_session_token(uid, name)}
+    if kind == 'front':
+        # Half the visitors are logged in
+        headers = rand.random() < 0.5 and cookie or {}
+        return webapp2.Request.blank('/blog', headers=headers)
+    if kind == 'permalink':
+        return webapp2.Request.blank('/blog/%d' % site.pick_post(rand))
+    if kind == 'welcome':
+        return webapp2.Request.blank('/blog/welcome', headers=cookie)
+    if kind == 'like':
+        return webapp2.Request.blank('/blog/%d/like' % site.pick_post(rand),
+                                     headers=cookie)
+    if kind == 'comment':
+        return webapp2.Request.blank(
+            '/blog/%d/comment' % site.pick_post(rand), headers=cookie,
+            POST={'action': 'Save', 'comment': rand_text(rand, 200)})
+    return webapp2.Request.blank(
+        '/blog/login', POST={'username': name, 'password': PASSWORD})
+
+def run(site, options, rand):
+    """ Makes the requests and returns the report dict """
+    mix = parse_mix(options.mix)
+    for i in range(options.warmup):
+        make_request(pick_kind(mix, rand), site, rand).get_response(blog.app)
+    samples = dict((kind, []) for kind, weight in mix)
+    started = time.time()
+    for i in range(options.requests):
+        kind = pick_kind(mix, rand)
+        request = make_request(kind, site, rand)
+        with instrument.counting() as counter:
+            start = time.time()
+            response = request.get_response(blog.app)
+            # Read streamed bodies in full, so their render is timed
+            response.body
+            elapsed = time.time() - start
+        samples[kind].append((elapsed, response.status_int, counter))
+    duration = time.time() - started
+    routes = {}
+    for kind, results in samples.items():
+        if results:
+            routes[ROUTES[kind]] = summarize(results, duration)
+    return {
+        'options': dict((name, getattr(options, name))
+                        for name in SEED_OPTIONS + RUN_OPTIONS),
+        'requests': options.requests,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(options.requests / duration, 1),
+        'routes': routes}
+
+def ms(seconds):
+    """ Returns seconds in milliseconds, rounded for the report """
+    return round(seconds * 1000, 3)
+
+def summarize(results, duration):
+    """ Returns the report for one route's (elapsed, status, counter)
+    results
+    """
+    times = sorted(elapsed for elapsed, status, counter in results)
+    statuses = {}
+    ops = {}
+    for elapsed, status, counter in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        for op, (calls, items, seconds) in counter.ops.items():
+            ops[op] = ops.get(op, 0) + calls
+    count = len(results)
+    per_request = dict((op, round(float(calls) / count, 2))
+                       for op, calls in ops.items())
+    return {
+        'requests': count,
+        'throughput_rps': round(count / duration, 1),
+        'mean_ms': ms(sum(times) / count),
+        'p50_ms': ms(instrument.percentile(times, 50)),
+        'p95_ms': ms(instrument.percentile(times, 95)),
+        'p99_ms': ms(instrument.percentile(times, 99)),
+        'statuses': statuses,
+        'ops_per_request': per_request,
+        'total_ops_per_request': round(sum(per_request.values()), 2)}
+
+def compare(report, baseline, tolerance):
+    """ Returns a dict of route to its changes from the baseline, with
+    a regressed flag
+    """
+    changes = {}
+    for route, current in sorted(report['routes'].items()):
+        before = baseline.get('routes', {}).get(route)
+        if not before:
+            continue
+        p95_ratio = current['p95_ms'] / max(before['p95_ms'], 0.001)
+        ops_change = (current['total_ops_per_request'] -
+                      before['total_ops_per_request'])
+        changes[route] = {
+            'p95_ratio': round(p95_ratio, 2),
+            'ops_change': round(ops_change, 2),
+            'regressed': p95_ratio > 1 + tolerance or ops_change > 0}
+    return changes
+
+# Options that shape the data and the traffic, kept in the report so
+# results are only compared with like runs
+SEED_OPTIONS = ['users', 'posts', 'comments', 'likes', 'hot_posts',
+                'hot_share', 'post_size', 'seed']
+RUN_OPTIONS = ['requests', 'warmup', 'mix']
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--users', type='int', default=50)
+    parser.add_option('--posts', type='int', default=200)
+    parser.add_option('--comments', type='int', default=2000)
+    parser.add_option('--likes', type='int', default=1000)
+    parser.add_option('--hot-posts', type='int', default=5,
+                      help='number of posts that draw most activity')
+    parser.add_option('--hot-share', type='float', default=0.5,
+                      help='share of activity that goes to hot posts')
+    parser.add_option('--post-size', type='int', default=2000,
+                      help='characters of content per post')
+    parser.add_option('--requests', type='int', default=2000)
+    parser.add_option('--warmup', type='int', default=200,
+                      help='requests made before measuring')
+    parser.add_option('--mix', default=DEFAULT_MIX,
+                      help='request weights, as kind=weight,...')
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--output', help='file to write the report to')
+    parser.add_option('--baseline', help='report to compare against')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='allowed growth in p95 latency')
+    options, args = parser.parse_args()
+
+    rand = random.Random(options.seed)
+    site = seed(options, rand)
+    report = run(site, options, rand)
+    regressed = False
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('options') != report['options']:
+            sys.stderr.write('Baseline was run with different options\n')
+        report['comparison'] = compare(report, baseline, options.tolerance)
+        regressed = any(change['regressed']
+                        for change in report['comparison'].values())
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    print output
+    return regressed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+# Benchmark of buffered and streamed rendering of a large page.
+#
+# Renders the permalink page of a post with many comments (5000 by
+# default) in each mode, each in a new Python process so the memory
+# figures don't mix:
+#   buffered - render() builds the whole page as one string
+#   streamed - stream_template() yields chunks as they are rendered
+#   gzipped - the streamed chunks, gzipped as they go
+# For each mode it reports the time to the first chunk and to the end,
+# the bytes sent, the largest chunk, and how much the peak memory use
+# of the process grew while rendering.
+#
+# Usage: python -m bench.render [--comments N] [--runs N]
+import json
+import optparse
+import os
+import subprocess
+import sys
+
+base_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..'))
+
+MODES = ['buffered', 'streamed', 'gzipped']
+
+# Run in the new process: renders the page once in one mode
+CHILD_SCRIPT = '''
+import json, resource, sys, time
+from bench import fakes
+from handlers import templating
+mode, count = sys.argv[1], int(sys.argv[2])
+entry = fakes.make_posts(1)[0]
+entry.comments = count
+params = dict(entry=entry, comments=fakes.make_comments(count),
+              user=fakes.FakeUser(1, 'reader1'), page_size=count)
+templating.get_environment().get_template('permalink.html')
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.time()
+if mode == 'buffered':
+    template = templating.get_environment().get_template('permalink.html')
+    chunks = [template.render(params).encode('utf-8')]
+else:
+    chunks = templating.stream_template('permalink.html', params)
+    if mode == 'gzipped':
+        chunks = templating.gzip_chunks(chunks)
+first = None
+sent = largest = 0
+for chunk in chunks:
+    if first is None:
+        first = time.time() - start
+    sent += len(chunk)
+    largest = max(largest, len(chunk))
+total = time.time() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print json.dumps({'first_chunk': first, 'total': total, 'bytes': sent,
+                  'largest_chunk': largest, 'peak_kb': after - before})
+'''
+
+
+def run_mode(mode, comments):
+    """ Returns the measurements of one render in a new process """
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD_SCRIPT, mode, str(comments)],
+        cwd=base_dir)
+    return json.loads(output)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--comments', type='int', default=5000,
+                      help='number of comments on the page')
+    parser.add_option('--runs', type='int', default=3,
+                      help='processes per mode; the best times are kept')
+    options, args = parser.parse_args()
+
+    results = {}
+    for mode in MODES:
+        runs = [run_mode(mode, options.comments)
+                for i in range(options.runs)]
+        results[mode] = {
+            'first_chunk': min(run['first_chunk'] for run in runs),
+            'total': min(run['total'] for run in runs),
+            'bytes': runs[0]['bytes'],
+            'largest_chunk': runs[0]['largest_chunk'],
+            'peak_kb': min(run['peak_kb'] for run in runs)
+        }
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# Benchmark of instance startup.
+#
+# Each route is timed in a new Python process, as a new instance would
+# see it, using local storage. For every route it reports:
+#   import - seconds to import blog.py and build the route table
+#   dispatch - seconds to serve the first request, including importing
+#     the handler module and everything it needs
+#   modules - the number of modules loaded once the request is served
+# With --profile it also lists the slowest imports of one route, with
+# the time spent in each module itself (excluding the modules it
+# imports in turn).
+#
+# Usage: python -m bench.startup [--runs N] [--profile ROUTE] [ROUTE ...]
+import json
+import optparse
+import os
+import subprocess
+import sys
+
+base_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Routes timed by default. The pages that need a post or a login still
+# import their handlers before redirecting or reporting the error.
+ROUTES = ['/blog', '/blog/1', '/blog/login', '/blog/signup',
+          '/blog/welcome', '/blog/newpost']
+
+# Run in the new process: times the import of blog and the first
+# request to a route, and optionally profiles every import on the way
+CHILD_SCRIPT = '''
+import __builtin__, json, os, sys, time
+os.environ['BLOG_STORAGE'] = 'local'
+route, profile = sys.argv[1], sys.argv[2] == '1'
+imports = {}
+stack = []
+real_import = __builtin__.__import__
+
+def timed_import(name, *args, **kwargs):
+    known = set(sys.modules)
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        new = [m for m in set(sys.modules) - known
+               if sys.modules[m] is not None]
+        if new:
+            imports[min(new, key=len)] = (elapsed, elapsed - nested)
+
+if profile:
+    __builtin__.__import__ = timed_import
+start = time.time()
+import blog
+imported = time.time()
+import webapp2
+response = webapp2.Request.blank(route).get_response(blog.app)
+done = time.time()
+__builtin__.__import__ = real_import
+print json.dumps({'import': imported - start, 'dispatch': done - imported,
+                  'status': response.status_int,
+                  'modules': len([m for m in sys.modules.values() if m]),
+                  'imports': imports})
+'''
+
+
+def run_route(route, profile=False):
+    """ Returns the timings of a route in a new Python process """
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD_SCRIPT, route, profile and '1' or '0'],
+        cwd=base_dir)
+    return json.loads(output)
+
+def time_route(route, runs):
+    """ Returns the best import and dispatch times of a route over runs """
+    results = [run_route(route) for i in range(runs)]
+    return {'import': min(r['import'] for r in results),
+            'dispatch': min(r['dispatch'] for r in results),
+            'status': results[0]['status'],
+            'modules': results[0]['modules']}
+
+def profile_route(route, limit=20):
+    """ Returns the slowest imports when serving a route, as (module,
+    total seconds, own seconds) tuples
+    """
+    imports = run_route(route, profile=True)['imports']
+    slowest = sorted(imports.items(), key=lambda item: -item[1][1])
+    return [(name, total, own) for name, (total, own) in slowest[:limit]]
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--runs', type='int', default=3,
+                      help='processes per route; the best time is kept')
+    parser.add_option('--profile', metavar='ROUTE',
+                      help='list the slowest imports of ROUTE')
+    options, routes = parser.parse_args()
+
+    results = {'routes': {}}
+    for route in routes or ROUTES:
+        results['routes'][route] = time_route(route, options.runs)
+    if options.profile:
+        results['profile'] = profile_route(options.profile)
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
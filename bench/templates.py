@@ -0,0 +1,112 @@
+# Benchmark of template loading and rendering.
+#
+# For each way the blog can load templates it measures:
+#   cold - time to load and render every page once in a new environment
+#   render - average time to render each page again once loaded
+# The loading modes are:
+#   source - parse the template files (no bytecode cache)
+#   bytecode - load compiled bytecode from the cache backend
+#   compiled - import the modules built by compile_templates.py
+# With --ttfb it also times a new Python process from start to the
+# first byte of the front page, using local storage.
+#
+# Usage: python -m bench.templates [--renders N] [--ttfb]
+import json
+import optparse
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import jinja2
+
+from bench import fakes
+from handlers import templating
+
+TTFB_SCRIPT = '''
+import os, time
+start = time.time()
+os.environ['BLOG_STORAGE'] = 'local'
+import blog, webapp2
+response = webapp2.Request.blank('/blog').get_response(blog.app)
+assert response.status_int == 200
+print time.time() - start
+'''
+
+
+def source_env():
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(templating.template_dir),
+        **templating.TEMPLATE_OPTIONS)
+
+def bytecode_env():
+    return templating.make_environment(compiled=False)
+
+def compiled_env(target):
+    return jinja2.Environment(loader=jinja2.ModuleLoader(target),
+                              auto_reload=False,
+                              **templating.TEMPLATE_OPTIONS)
+
+def time_cold(make_env, params):
+    """ Returns seconds to load and render every page in a new env """
+    start = time.time()
+    env = make_env()
+    for name, page in params.items():
+        env.get_template(name).render(page)
+    return time.time() - start, env
+
+def time_renders(env, params, renders):
+    """ Returns a dict of page name to average render time in seconds """
+    results = {}
+    for name, page in params.items():
+        template = env.get_template(name)
+        start = time.time()
+        for i in range(renders):
+            template.render(page)
+        results[name] = (time.time() - start) / renders
+    return results
+
+def time_ttfb():
+    """ Returns (process seconds, in-process seconds) to the first byte
+    of the front page in a new Python process
+    """
+    base_dir = templating.base_dir
+    start = time.time()
+    output = subprocess.check_output([sys.executable, '-c', TTFB_SCRIPT],
+                                     cwd=base_dir)
+    return time.time() - start, float(output.strip())
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--renders', type='int', default=200,
+                      help='renders per page for the render timings')
+    parser.add_option('--ttfb', action='store_true',
+                      help='also time a cold process to first byte')
+    options, args = parser.parse_args()
+
+    params = fakes.page_params()
+    target = tempfile.mkdtemp()
+    try:
+        templating.compile_templates(target)
+        # Fill the bytecode cache, as a previous instance would have
+        bytecode_env_warm = bytecode_env()
+        for name in params:
+            bytecode_env_warm.get_template(name)
+        results = {}
+        for mode, make_env in [('source', source_env),
+                               ('bytecode', bytecode_env),
+                               ('compiled', lambda: compiled_env(target))]:
+            cold, env = time_cold(make_env, params)
+            renders = time_renders(env, params, options.renders)
+            results[mode] = {'cold': cold, 'render': renders}
+    finally:
+        shutil.rmtree(target)
+    if options.ttfb:
+        process, in_process = time_ttfb()
+        results['ttfb'] = {'process': process, 'in_process': in_process}
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 # Program to create a multi-user blog implemented with Google App Engine
 # and Jinja templates.
 #
-# Dependencies: app.yaml, index.yaml
+# Dependencies: app.yaml, index.yaml, cron.yaml, queue.yaml
 #   models/user.py
 #   models/post.py
 #   models/user.py
@@ -17,12 +17,21 @@
 #   handlers/permalink.py
 #   handlers/like.py
 #   handlers/newcomment.py
+#   handlers/comments.py
 #   handlers/editcmt.py
 #   handlers/delcmt.py
+#   handlers/search.py
+#   handlers/feed.py
+#   handlers/authorstats.py
+#   handlers/admin.py
+#   handlers/warmup.py
+#   handlers/templating.py
 #   templates/blog-base.html
 #   templates/front.html
 #   templates/welcome.html
 #   templates/permalink.html
+#   templates/comments.html
+#   templates/search.html
 #   templates/form.html
 #   templates/comment.html
 #   templates/login-base.html
@@ -30,37 +39,48 @@
 #   templates/login.html
 #   static/css/blog-style.css
 #   static/css/login-style.css
+#   static/js/comments.js
 
 import webapp2
 
-# import Page Handlers
-from handlers.mainpage import MainPage
-from handlers.signup import SignupHandler
-from handlers.login import LoginHandler
-from handlers.logout import LogoutHandler
-from handlers.welcome import WelcomeHandler
-from handlers.newpost import NewPost
-from handlers.editpost import EditPost
-from handlers.delpost import DeletePost
-from handlers.permalink import PermalinkHandler
-from handlers.like import LikeHandler
-from handlers.newcomment import NewComment
-from handlers.editcmt import EditComment
-from handlers.delcmt import DeleteComment
+import instrument
 
-# launch the application
+# launch the application. Page handlers are named by their import path,
+# so each handler module (and the models and templates it needs) is only
+# imported when the first request for one of its pages arrives, rather
+# than when a new instance starts.
 app = webapp2.WSGIApplication([
-    ('/blog', MainPage),
-    ('/blog/signup', SignupHandler),
-    ('/blog/login', LoginHandler),
-    ('/blog/logout', LogoutHandler),
-    ('/blog/welcome', WelcomeHandler),
-    ('/blog/newpost', NewPost),
-    ('/blog/editpost', EditPost),
-    ('/blog/delpost', DeletePost),
-    (r'/blog/(\d+)', PermalinkHandler),
-    (r'/blog/(\d+)/like', LikeHandler),
-    (r'/blog/(\d+)/comment', NewComment),
-    (r'/blog/(\d+)/editcmt', EditComment),
-    (r'/blog/(\d+)/delcmt', DeleteComment)
+    ('/blog', 'handlers.mainpage.MainPage'),
+    ('/blog/signup', 'handlers.signup.SignupHandler'),
+    ('/blog/login', 'handlers.login.LoginHandler'),
+    ('/blog/logout', 'handlers.logout.LogoutHandler'),
+    ('/blog/welcome', 'handlers.welcome.WelcomeHandler'),
+    ('/blog/newpost', 'handlers.newpost.NewPost'),
+    ('/blog/editpost', 'handlers.editpost.EditPost'),
+    ('/blog/delpost', 'handlers.delpost.DeletePost'),
+    ('/blog/search', 'handlers.search.SearchHandler'),
+    ('/blog/feed.atom', 'handlers.feed.FeedHandler'),
+    (r'/blog/author/([a-zA-Z0-9_-]+)/feed.atom', 'handlers.feed.FeedHandler'),
+    (r'/blog/author/([a-zA-Z0-9_-]+)/stats.json',
+     'handlers.authorstats.AuthorStatsHandler'),
+    (r'/blog/(\d+)', 'handlers.permalink.PermalinkHandler'),
+    (r'/blog/(\d+)/like', 'handlers.like.LikeHandler'),
+    (r'/blog/(\d+)/comment', 'handlers.newcomment.NewComment'),
+    (r'/blog/(\d+)/comments', 'handlers.comments.CommentsHandler'),
+    (r'/blog/(\d+)/editcmt', 'handlers.editcmt.EditComment'),
+    (r'/blog/(\d+)/delcmt', 'handlers.delcmt.DeleteComment'),
+    ('/blog/_admin/resume-purges', 'handlers.admin.ResumePurges'),
+    ('/blog/_admin/backfill-usernames', 'handlers.admin.BackfillUsernames'),
+    ('/blog/_admin/migrate-comments', 'handlers.admin.MigrateComments'),
+    ('/blog/_admin/backfill-summaries', 'handlers.admin.BackfillSummaries'),
+    ('/blog/_admin/reindex-search', 'handlers.admin.ReindexSearch'),
+    ('/blog/_admin/flush-likes', 'handlers.admin.FlushLikes'),
+    ('/blog/_admin/reconcile-author-stats',
+     'handlers.admin.ReconcileAuthorStats'),
+    ('/blog/_stats', 'handlers.admin.StatsHandler'),
+    ('/_ah/warmup', 'handlers.warmup.WarmupHandler')
 ], debug=True)
+
+# Record per-route timings and storage calls when BLOG_STATS is "on"
+if instrument.enabled():
+    app = instrument.StatsMiddleware(app)
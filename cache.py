@@ -0,0 +1,219 @@
+# Caching helpers for our blog.
+#
+# The cache backend is pluggable. By default we use an in-process LRU
+# cache. Setting the BLOG_CACHE environment variable to "memcache" (see
+# app.yaml) switches to App Engine's memcache, which the LRU cache
+# stands in for since both share the same get/set/add/delete/incr/decr
+# interface.
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ In-process least-recently-used cache with a memcache-style
+    interface.
+
+    Attributes:
+        max_items - maximum number of items held before the least
+            recently used ones are evicted
+        hits, misses - counters of get() calls that found or missed a value
+    """
+    def __init__(self, max_items=1000):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        """ Returns the (expires, value) item for key, dropping it if it
+        has expired. Must be called with the lock held.
+        """
+        item = self.items.pop(key, None)
+        if item and item[0] and item[0] <= time.time():
+            item = None
+        if item:
+            # Re-insert to mark as most recently used
+            self.items[key] = item
+        return item
+
+    def _store(self, key, value, ttl):
+        """ Stores value under key and evicts the oldest items if we
+        are over the size limit. Must be called with the lock held.
+        """
+        expires = ttl and time.time() + ttl
+        self.items.pop(key, None)
+        self.items[key] = (expires, value)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def get(self, key):
+        """ Returns the value stored under key, or None """
+        with self.lock:
+            item = self._lookup(key)
+            if item:
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, time=0):
+        """ Stores value under key. A non-zero time is the number of
+        seconds until it expires.
+        """
+        with self.lock:
+            self._store(key, value, time)
+        return True
+
+    def add(self, key, value, time=0):
+        """ Stores value only if key is not already set. Returns True
+        if the value was stored.
+        """
+        with self.lock:
+            if self._lookup(key):
+                return False
+            self._store(key, value, time)
+        return True
+
+    def delete(self, key):
+        """ Removes key from the cache """
+        with self.lock:
+            self.items.pop(key, None)
+        return True
+
+    def incr(self, key, delta=1, initial_value=None):
+        """ Atomically increments the integer stored under key and
+        returns the new value. If key is not set, it starts from
+        initial_value, or returns None if that isn't given.
+        """
+        with self.lock:
+            item = self._lookup(key)
+            if item:
+                expires, value = item
+            elif initial_value is not None:
+                expires, value = 0, initial_value
+            else:
+                return None
+            value += delta
+            self.items[key] = (expires, value)
+        return value
+
+    def decr(self, key, delta=1):
+        """ Atomically decrements the integer stored under key, but not
+        below zero, and returns the new value, or None if key is not set
+        """
+        with self.lock:
+            item = self._lookup(key)
+            if not item:
+                return None
+            expires, value = item
+            value = max(0, value - delta)
+            self.items[key] = (expires, value)
+        return value
+
+    def flush_all(self):
+        """ Removes every item from the cache """
+        with self.lock:
+            self.items.clear()
+        return True
+
+    def get_stats(self):
+        """ Returns a dict of cache counters """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'items': len(self.items)}
+
+
+_backend = None
+
+def get_backend():
+    """ Returns the cache backend, creating the default one on first use """
+    global _backend
+    if _backend is None:
+        if os.environ.get('BLOG_CACHE') == 'memcache':
+            from google.appengine.api import memcache
+            _backend = memcache
+        else:
+            _backend = LRUCache()
+    return _backend
+
+def set_backend(backend):
+    """ Replaces the cache backend. Any object with the memcache
+    get/set/add/delete/incr/decr/get_stats methods will do.
+    """
+    global _backend
+    _backend = backend
+
+def get_stats():
+    """ Returns the hit and miss counters of the cache backend """
+    return get_backend().get_stats()
+
+
+# Front page cache.
+#
+# Rendered front pages are stored, with their ETag and last modified
+# date, under a generation number that is bumped on every write that
+# changes the front page, so stale pages are never looked up again and
+# simply age out of the cache. The front page query is only eventually
+# consistent, so for SETTLE_TIME seconds after a write, pages are only
+# kept that long, in case they were filled without it.
+FRONT_GEN_KEY = 'front:gen'
+FRONT_BUMPED_KEY = 'front:bumped'
+# Upper bound on how long a rendered front page is kept
+FRONT_PAGE_TTL = 600
+# Seconds a write may take to show up in queries
+SETTLE_TIME = 5
+
+def _new_generation():
+    """ Returns a generation number that can't collide with one handed
+    out before the counter was evicted.
+    """
+    return int(time.time() * 1000)
+
+def front_generation():
+    """ Returns the current front page generation number """
+    client = get_backend()
+    gen = client.get(FRONT_GEN_KEY)
+    if gen is None:
+        client.add(FRONT_GEN_KEY, _new_generation())
+        gen = client.get(FRONT_GEN_KEY)
+    return gen
+
+def bump_front_page():
+    """ Invalidates all cached front pages by moving to a new generation """
+    client = get_backend()
+    if client.incr(FRONT_GEN_KEY) is None:
+        client.add(FRONT_GEN_KEY, _new_generation())
+    client.set(FRONT_BUMPED_KEY, True, time=SETTLE_TIME)
+
+def fill_ttl(ttl):
+    """ Returns how long a front page or feed filled now may be kept:
+    ttl, or only SETTLE_TIME if the last write was so recent that the
+    page's query may not show it yet
+    """
+    if get_backend().get(FRONT_BUMPED_KEY) is not None:
+        return min(ttl, SETTLE_TIME)
+    return ttl
+
+def front_page_key(variant):
+    """ Returns the cache key for the current front page. The variant
+    separates pages that render differently, such as the logged-in and
+    anonymous views.
+    """
+    return 'front:page:%s:%s' % (front_generation(), variant)
+
+
+# Feed cache.
+#
+# Generated Atom feeds are kept under the front page generation, since
+# every write that changes a feed's entries also changes the front page.
+# Feed readers poll often, so feeds are kept longer than pages.
+FEED_TTL = 3600
+
+def feed_key(variant):
+    """ Returns the cache key for the current version of a feed. The
+    variant names the feed, such as the whole blog or one author's.
+    """
+    return 'feed:%s:%s' % (front_generation(), variant)
@@ -0,0 +1,11 @@
+# Precompiles the Jinja templates in templates/ into Python modules in
+# compiled_templates/, which the blog loads in production instead of
+# parsing the templates. Run this before every deploy:
+#
+#     python compile_templates.py
+from handlers import templating
+
+if __name__ == '__main__':
+    templating.compile_templates()
+    print 'Compiled %d templates into %s' % (len(templating.template_names()),
+                                             templating.compiled_dir)
@@ -0,0 +1,230 @@
+# Admin maintenance pages. Access is restricted to app admins by the
+# login: admin settings for /blog/_admin and /blog/_stats in app.yaml.
+import json
+import time
+
+import bloghandler
+import cache
+import instrument
+from models import likebuffer
+from models.purge import PostPurge
+from models.user import backfill_usernames
+from models.comment import migrate_comments
+from models.post import backfill_summaries
+from models.authorstats import reconcile_author_stats
+from models.search import reindex_posts
+from models.txn import get_stats as get_txn_stats
+
+# Seconds an admin job works before reporting back
+TIME_BUDGET = 30
+
+
+class AdminHandler(bloghandler.Handler):
+    """ Parent handler for admin jobs, which report in plain text """
+    def report(self, msg):
+        """ Writes a plain text job report """
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.write(msg + '\n')
+
+
+class ResumePurges(AdminHandler):
+    """ ResumePurges restarts the background cleanup of every deleted
+    post whose comments and likes haven't all been deleted yet.
+    """
+    def get(self):
+        count = PostPurge.resume_all()
+        self.report('Resumed %d unfinished post purges' % count)
+
+
+class BackfillUsernames(AdminHandler):
+    """ BackfillUsernames adds existing users to the unique Username
+    index, in batches, until the time budget runs out. The report links
+    to the next batch if there are users left.
+    """
+    def get(self):
+        stop_time = time.time() + TIME_BUDGET
+        cursor = self.request.get('cursor') or None
+        claimed = 0
+        conflicts = []
+        while True:
+            batch_claimed, batch_conflicts, cursor = backfill_usernames(
+                cursor)
+            claimed += batch_claimed
+            conflicts.extend(batch_conflicts)
+            if not cursor or time.time() > stop_time:
+                break
+        lines = ['Indexed %d usernames' % claimed]
+        for name in conflicts:
+            lines.append('Conflict: %s is held by another user' % name)
+        if cursor:
+            lines.append('More to do: /blog/_admin/backfill-usernames'
+                         '?cursor=%s' % cursor)
+        else:
+            lines.append('Done')
+        self.report('\n'.join(lines))
+
+
+class MigrateComments(AdminHandler):
+    """ MigrateComments moves the comments still listed on each post
+    under the post, in batches, until the time budget runs out. The
+    report links to the next batch if there are posts left.
+    """
+    def get(self):
+        stop_time = time.time() + TIME_BUDGET
+        cursor = self.request.get('cursor') or None
+        migrated = 0
+        while True:
+            batch_migrated, cursor = migrate_comments(cursor)
+            migrated += batch_migrated
+            if not cursor or time.time() > stop_time:
+                break
+        lines = ['Migrated the comments of %d posts' % migrated]
+        if cursor:
+            lines.append('More to do: /blog/_admin/migrate-comments'
+                         '?cursor=%s' % cursor)
+        else:
+            lines.append('Done')
+        self.report('\n'.join(lines))
+
+
+class BackfillSummaries(AdminHandler):
+    """ BackfillSummaries adds the summaries shown on list pages to the
+    posts saved before they were kept, in batches, until the time budget
+    runs out. The report links to the next batch if there are posts
+    left.
+    """
+    def get(self):
+        stop_time = time.time() + TIME_BUDGET
+        cursor = self.request.get('cursor') or None
+        added = 0
+        while True:
+            batch_added, cursor = backfill_summaries(cursor)
+            added += batch_added
+            if not cursor or time.time() > stop_time:
+                break
+        lines = ['Added summaries to %d posts' % added]
+        if cursor:
+            lines.append('More to do: /blog/_admin/backfill-summaries'
+                         '?cursor=%s' % cursor)
+        else:
+            lines.append('Done')
+        self.report('\n'.join(lines))
+
+
+class ReindexSearch(AdminHandler):
+    """ ReindexSearch indexes every post and its comments for search, in
+    batches, until the time budget runs out. Only the postings that
+    changed are rewritten, so it can be re-run at any time to repair
+    the index. The report links to the next batch if there are posts
+    left.
+    """
+    def get(self):
+        stop_time = time.time() + TIME_BUDGET
+        cursor = self.request.get('cursor') or None
+        indexed = 0
+        while True:
+            batch_indexed, cursor = reindex_posts(cursor)
+            indexed += batch_indexed
+            if not cursor or time.time() > stop_time:
+                break
+        lines = ['Indexed %d posts and their comments' % indexed]
+        if cursor:
+            lines.append('More to do: /blog/_admin/reindex-search'
+                         '?cursor=%s' % cursor)
+        else:
+            lines.append('Done')
+        self.report('\n'.join(lines))
+
+
+class ReconcileAuthorStats(AdminHandler):
+    """ ReconcileAuthorStats recomputes each user's post, like and
+    comment totals from their post summaries, in batches, until the time
+    budget runs out, and corrects the totals that drifted. The report
+    lists the drift found and links to the next batch if there are
+    users left.
+    """
+    def get(self):
+        stop_time = time.time() + TIME_BUDGET
+        cursor = self.request.get('cursor') or None
+        checked = 0
+        drifts = []
+        while True:
+            batch_checked, batch_drifts, cursor = reconcile_author_stats(
+                cursor)
+            checked += batch_checked
+            drifts.extend(batch_drifts)
+            if not cursor or time.time() > stop_time:
+                break
+        lines = ['Checked the totals of %d users, %d drifted' %
+                 (checked, len(drifts))]
+        for name, stored, totals, fixed in drifts:
+            lines.append('%s: posts, likes, comments were %d, %d, %d; '
+                         'counted %d, %d, %d%s' %
+                         ((name,) + stored + totals +
+                          (not fixed and ' (still changing, not fixed)'
+                           or '',)))
+        if cursor:
+            lines.append('More to do: /blog/_admin/reconcile-author-stats'
+                         '?cursor=%s' % cursor)
+        else:
+            lines.append('Done')
+        self.report('\n'.join(lines))
+
+
+class FlushLikes(AdminHandler):
+    """ FlushLikes stores the likes waiting in the like buffer, when
+    likes are buffered. It is run every minute by cron.
+    """
+    def get(self):
+        if not likebuffer.enabled():
+            self.report('Likes are not buffered; set BLOG_LIKE_BUFFER '
+                        'to "on"')
+            return
+        buf = likebuffer.get_buffer()
+        count = buf.flush()
+        self.report('Stored %d buffered likes, %d waiting' %
+                    (count, buf.get_stats()['pending']))
+
+
+class StatsHandler(AdminHandler):
+    """ StatsHandler shows the request timings and storage operations
+    recorded per route by the instrumentation middleware, with the cache
+    and transaction counters. Add format=json for JSON, and reset=1 to
+    start the route totals afresh.
+    """
+    def get(self):
+        stats = {'routes': instrument.get_stats(),
+                 'cache': cache.get_stats(),
+                 'transactions': get_txn_stats()}
+        if likebuffer.enabled():
+            stats['like_buffer'] = likebuffer.get_buffer().get_stats()
+        if self.request.get('reset'):
+            instrument.reset()
+        if self.request.get('format') == 'json':
+            self.response.headers['Content-Type'] = 'application/json'
+            self.write(json.dumps(stats, indent=2, sort_keys=True))
+            return
+        if instrument.enabled():
+            lines = ['Route timings (ms) and storage calls per request']
+        else:
+            lines = ['Instrumentation is off; set BLOG_STATS to "on"']
+        for route, summary in sorted(stats['routes'].items()):
+            lines.append('')
+            lines.append('%s: %d requests, %d errors' %
+                         (route, summary['requests'], summary['errors']))
+            lines.append('  wall avg %(wall_ms).1f p50 %(p50_ms).1f '
+                         'p95 %(p95_ms).1f max %(max_ms).1f, '
+                         'render avg %(render_ms).1f' % summary)
+            for op, op_stats in sorted(summary['ops_per_request'].items()):
+                lines.append('  %-12s %6.2f calls %8.2f items %8.3f ms' %
+                             (op, op_stats['calls'], op_stats['items'],
+                              op_stats['ms']))
+        lines.append('')
+        lines.append('Cache: %s' % json.dumps(stats['cache'],
+                                              sort_keys=True))
+        lines.append('Transactions: %s' % json.dumps(stats['transactions'],
+                                                     sort_keys=True))
+        if 'like_buffer' in stats:
+            lines.append('Like buffer: %s' % json.dumps(stats['like_buffer'],
+                                                        sort_keys=True))
+        self.report('\n'.join(lines))
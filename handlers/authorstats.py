@@ -0,0 +1,27 @@
+# Author statistics page
+import json
+
+import bloghandler
+from models.user import User
+from models.authorstats import AuthorStats
+
+
+class AuthorStatsHandler(bloghandler.Handler):
+    """ Author stats handler serves the totals of an author's posts, the
+    likes of them and the comments on them, as JSON. Clients with a
+    current copy get a 304 response.
+    """
+    def get(self, name):
+        user = User.by_name(name)
+        if not user:
+            self.error(404)
+            return
+        stats = (AuthorStats.get(AuthorStats.stats_key(user.key())) or
+                 AuthorStats())
+        etag = self.make_etag('author-stats', user.name, stats.totals())
+        if self.not_modified(etag, stats.updated):
+            return
+        data = stats.to_dict()
+        data['author'] = user.name
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps(data, sort_keys=True))
@@ -1,26 +1,57 @@
 # Parent blog page handler
+import hashlib
+import itertools
 import os
+import time
 
-import jinja2
 import webapp2
-from google.appengine.ext import db
 
+import instrument
 import utils
+import templating
+from storage import db
 import decorator
 from models.user import User
 from models.post import BlogPost
-from models.comment import Comment
+from models.comment import Comment, COMMENT_PAGE_SIZE
+from models.paging import valid_page_size
+from models.prefetch import prefetch_refs
 
-# Set up Jinja Environment
+# Seconds a shared cache may serve a page to anonymous visitors before
+# checking back
+PUBLIC_MAX_AGE = 60
+# Whether pages are really streamed. App Engine's python27 runtime
+# buffers the whole response before sending it, so there pages are
+# rendered in full inside the handler instead, where render errors get
+# the usual error response and render time is counted. Streamed pages
+# are gzipped for clients that accept it, as App Engine's front end
+# only compresses the responses it sends itself.
+STREAM_PAGES = not templating.in_production()
+# Added to the ETag of gzipped pages
+GZIP_ETAG_SUFFIX = '-gzip'
 
-one_level_up_dir = os.path.join(os.path.dirname(__file__), '..', 'templates')
-template_dir = os.path.normpath(one_level_up_dir)
-jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir),
-                                autoescape = True)
+class Session(object):
+    """ Session class holding the logged in user's details from the
+    session cookie
+
+    Attributes:
+        uid - user id (int)
+        name - username (string)
+    """
+    def __init__(self, uid, name):
+        self.uid = uid
+        self.name = name
+
+    def key(self):
+        """ Returns the datastore key of the logged in user """
+        return db.Key.from_path('User', self.uid)
 
 
 class Handler(webapp2.RequestHandler):
     """ Parent page handler class """
+    # True for pages that show a post's like and comment counts
+    post_counts = False
+
     def write(self, *a, **kw):
         """ Boilerplate write method """
         self.response.write(*a, **kw)
@@ -28,27 +59,239 @@ class Handler(webapp2.RequestHandler):
     def render_str(self, template, **params):
         """ Boilerplate render_str method """
         # add user to the parameter list automatically
-        params['user'] = self.user
+        params['user'] = self.session
         # set template and call render like before
-        t = jinja_env.get_template(template)
-        return t.render(params)
+        t = templating.get_environment().get_template(template)
+        start = time.time()
+        html = t.render(params)
+        instrument.record_render(time.time() - start)
+        return html
+
+    def render(self, template, stream=False, **kw):
+        """ Boilerplace render method. With stream=True the page is sent
+        in chunks as it is rendered, instead of being built as one
+        string first, when pages are streamed (see STREAM_PAGES).
+        """
+        if stream and STREAM_PAGES:
+            self.stream(template, **kw)
+        else:
+            self.write(self.render_str(template, **kw))
 
-    def render(self, template, **kw):
-        """ Boilerplace render method """
-        self.write(self.render_str(template, **kw))
+    def stream(self, template, **params):
+        """ Renders template into the response in chunks as they are
+        produced (see send_chunks). Note: Nothing can be written after it.
+        """
+        # add user to the parameter list automatically
+        params['user'] = self.session
+        self.send_chunks(instrument.timed_chunks(
+            templating.stream_template(template, params)))
 
-    def get_uid_from_cookie(self):
-        """ Get user_id from cookie and check if valid. Returns valid id. """
-        user_id = self.request.cookies.get('user_id')
-        return user_id and utils.check_secure_cookie(user_id)
+    def send_chunks(self, chunks):
+        """ Sends an iterator of encoded chunks as the response body. If
+        pages are streamed, they are sent as they are produced, gzipped
+        if the client accepts it, and nothing can be written after them.
+        Otherwise they are all produced and written here.
+        """
+        if not STREAM_PAGES:
+            self.write(''.join(chunks))
+            return
+        # Produce the first chunk now, so a template that fails to start
+        # rendering still gets an error response
+        chunks = iter(chunks)
+        first = next(chunks, '')
+        chunks = templating.logged_chunks(itertools.chain([first], chunks))
+        accepted = self.request.headers.get('Accept-Encoding', '')
+        if 'gzip' in accepted:
+            chunks = templating.gzip_chunks(chunks)
+            self.response.headers['Content-Encoding'] = 'gzip'
+            # The gzipped page is a different representation, so it
+            # needs its own ETag
+            etag = self.response.etag
+            if etag:
+                self.response.etag = etag + GZIP_ETAG_SUFFIX
+        self.add_vary('Accept-Encoding')
+        self.response.app_iter = chunks
+
+    def add_vary(self, header):
+        """ Adds a request header to the response's Vary header """
+        vary = self.response.headers.get('Vary')
+        if not vary:
+            self.response.headers['Vary'] = header
+        elif header not in vary.split(', '):
+            self.response.headers['Vary'] = vary + ', ' + header
+
+    def make_etag(self, *parts):
+        """ Returns a strong ETag for a page, given parts that change
+        whenever the rendered page does. The app version is added, so a
+        deploy with changed templates changes every ETag.
+        """
+        version = os.environ.get('CURRENT_VERSION_ID', '')
+        return hashlib.md5(repr((version,) + parts)).hexdigest()
+
+    def not_modified(self, etag, last_modified=None):
+        """ Sets the ETag, Last-Modified and caching headers of a page
+        and checks them against the request's If-None-Match and
+        If-Modified-Since headers. Returns True, with the response set
+        to 304, if the client's copy is current and the page need not
+        be rendered.
+        """
+        response = self.response
+        response.etag = etag
+        if last_modified:
+            response.last_modified = last_modified
+        # Pages differ by who is logged in, so only anonymous pages may
+        # be kept by shared caches
+        self.add_vary('Cookie')
+        if self.session or 'Set-Cookie' in response.headers:
+            response.headers['Cache-Control'] = 'private, no-cache'
+        else:
+            response.headers['Cache-Control'] = (
+                'public, max-age=%d' % PUBLIC_MAX_AGE)
+        request = self.request
+        if 'If-None-Match' in request.headers:
+            # The ETag takes precedence over the date. A client may hold
+            # the gzipped page, which is just as current.
+            current = (etag in request.if_none_match or
+                       etag + GZIP_ETAG_SUFFIX in request.if_none_match)
+        else:
+            since = request.if_modified_since
+            current = bool(since and last_modified and
+                           last_modified.replace(microsecond=0) <=
+                           since.replace(tzinfo=None))
+        if current:
+            response.set_status(304)
+        return current
+
+    def is_conditional(self):
+        """ Returns True if the client sent a copy of the page to check,
+        so it may get a 304 response instead
+        """
+        headers = self.request.headers
+        return 'If-None-Match' in headers or 'If-Modified-Since' in headers
+
+    def set_session(self, uid, name):
+        """ Sets the signed session cookie for this user """
+        token = utils.make_session_token(uid, name)
+        self.response.headers.add_header('Set-Cookie',
+                                         'user_id=%s; Path=/' % token)
+
+    def get_session(self):
+        """ Get user id and name from the session cookie and check if
+        valid. Returns a Session, or None if no one is logged in.
+        """
+        token = self.request.cookies.get('user_id')
+        fields = token and utils.check_session_token(token)
+        if not fields:
+            return None
+        uid, name = fields
+        if name is None:
+            # Older cookie without the username, so look it up and
+            # reissue the cookie
+            user = User.by_id(uid)
+            if not user:
+                return None
+            name = user.name
+            self.set_session(uid, name)
+        return Session(uid, name)
 
     def initialize(self, *a, **kw):
         """ Overwrites standard initialize method to also check for and
         load user info from cookie
         """
         webapp2.RequestHandler.initialize(self, *a, **kw)
-        uid = self.get_uid_from_cookie()
-        self.user = uid and User.get_by_id(int(uid))
+        # Per-request identity map of entities, keyed by datastore key
+        self.entities = {}
+        self.session = self.get_session()
+
+    @property
+    def user(self):
+        """ The logged in User object, or None. It is only looked up
+        when first used, since most pages just need self.session.
+        """
+        if self.session is None:
+            return None
+        key = self.session.key()
+        if key not in self.entities:
+            self.entities[key] = User.by_id(self.session.uid)
+        return self.entities[key]
+
+    def get_entity(self, key):
+        """ Looks up an entity by its key. Each key is fetched from the
+        datastore at most once per request. Returns None if not found.
+        """
+        if key not in self.entities:
+            self.entities[key] = db.get(key)
+        return self.entities[key]
+
+    def put_entity(self, entity):
+        """ Stores entity in the datastore and in the request's
+        identity map. Returns the entity's key.
+        """
+        key = entity.put()
+        self.entities[key] = entity
+        return key
+
+    def set_entity(self, entity):
+        """ Stores an entity that was saved elsewhere (e.g. in a
+        transaction) in the request's identity map.
+        """
+        self.entities[entity.key()] = entity
+
+    def delete_entity(self, entity):
+        """ Deletes entity from the datastore and marks it as missing
+        in the request's identity map.
+        """
+        key = entity.key()
+        entity.delete()
+        self.entities[key] = None
+
+    def comment_page_size(self):
+        """ Returns the comment page size given by the request """
+        return valid_page_size(self.request.get('size'), COMMENT_PAGE_SIZE)
+
+    def start_comment_page(self, blog_id):
+        """ Starts looking up the page of comments on the post with this
+        id given by the request's cursor and size. Returns a Pending to
+        pass to get_comment_page.
+        """
+        cursor = self.request.get('cursor') or None
+        return Comment.post_page_async(blog_id, cursor,
+                                       self.comment_page_size())
+
+    def get_comment_page(self, entry, page=None):
+        """ Looks up the page of comments on entry given by the request's
+        cursor and size, or waits for page if start_comment_page already
+        started it. Returns a tuple (entry, comments, next_cursor,
+        page_size).
+        """
+        legacy = []
+        if entry.comments and not self.request.get('cursor'):
+            # Comments still listed on the post aren't moved under it
+            # by a page view. They are all shown on the first page, as
+            # before paging, until a write to the post or the
+            # migrate-comments job moves them.
+            legacy = Comment.get_comments(entry.comments)
+        if page is None:
+            page = self.start_comment_page(entry.get_id())
+        comments, next_cursor, prev_cursor = page.get_result()
+        return (entry, legacy + comments, next_cursor,
+                self.comment_page_size())
+
+    def render_permalink(self, entry, page=None, **kw):
+        """ Renders the permalink page for entry with its first page of
+        comments, which may already have been started. The post's
+        counts are looked up while the comments are, then the post and
+        comment authors in one batch.
+        """
+        if page is None:
+            page = self.start_comment_page(entry.get_id())
+        BlogPost.prefetch_counts([entry])
+        entry, comments, next_cursor, page_size = self.get_comment_page(
+            entry, page)
+        prefetch_refs([entry] + comments, known=self.entities)
+        self.render('permalink.html', stream=True, entry=entry,
+                    comments=comments, next_cursor=next_cursor,
+                    page_size=page_size, **kw)
 
     def get_post_id(self):
         """ Queries page input for blog_id and returns it as an integer. """
@@ -58,8 +301,20 @@ class Handler(webapp2.RequestHandler):
         """ Queries page input for comment id and returns it as an int. """
         return int(self.request.get('cid'))
 
-    def get_valid_comment(self, cid):
-        """ Looks up comment by its id and returns comment """
-        key = db.Key.from_path('Comment',int(cid))
-        cmt = db.get(key)
-        return cmt
+    def get_post(self, blog_id):
+        """ Looks up blog post by its id and returns post. Pages that
+        show its counts look them up in the same batch.
+        """
+        key = db.Key.from_path('BlogPost', int(blog_id))
+        if self.post_counts and key not in self.entities:
+            self.entities[key] = BlogPost.get_with_counts(blog_id)
+        return self.get_entity(key)
+
+    def get_valid_comment(self, blog_id, cid):
+        """ Looks up comment by its id on the blog post with this id and
+        returns comment
+        """
+        blog_post = self.get_post(blog_id)
+        if not blog_post:
+            return None
+        return self.get_entity(Comment.comment_key(blog_post, cid))
@@ -0,0 +1,58 @@
+# Comments fragment page
+import json
+
+import bloghandler
+from models.prefetch import prefetch_refs
+
+
+class CommentsHandler(bloghandler.Handler):
+    """ Comments handler returns one page of the comments on a blog
+    post, for the permalink page to load after its first page. The page
+    is an HTML fragment, or JSON when the format parameter is "json".
+    Each page is one query of at most page size comments, however long
+    the thread is.
+    """
+    post_counts = True
+
+    def get(self, blog_id):
+        # Start on the comments while the post is looked up, unless the
+        # client has a copy that may still be current
+        page = None
+        if not self.is_conditional():
+            page = self.start_comment_page(blog_id)
+        entry = self.get_post(blog_id)
+        if not entry:
+            self.error(404)
+            return
+        fmt = self.request.get('format')
+        # Comment controls depend on who is logged in
+        viewer = self.session and self.session.name
+        etag = self.make_etag('comments', viewer, entry.version(),
+                              self.request.get('cursor'),
+                              self.request.get('size'), fmt)
+        if self.not_modified(etag, entry.last_modified()):
+            return
+        entry, comments, next_cursor, page_size = self.get_comment_page(
+            entry, page)
+        # Load all the comment authors in one batch
+        prefetch_refs(comments, known=self.entities)
+        if fmt == 'json':
+            self.write_json(comments, next_cursor)
+        else:
+            self.render('comments.html', entry=entry, comments=comments,
+                        next_cursor=next_cursor, page_size=page_size)
+
+    def write_json(self, comments, next_cursor):
+        """ Writes the page of comments as a JSON object """
+        viewer = self.session and self.session.name
+        page = {
+            'comments': [{'id': cmt.get_id(),
+                          'author': cmt.get_author(),
+                          'text': cmt.text,
+                          'created': cmt.created.isoformat(),
+                          'editable': viewer == cmt.get_author()}
+                         for cmt in comments],
+            'next_cursor': next_cursor
+        }
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps(page))
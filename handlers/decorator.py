@@ -1,14 +1,11 @@
 # Define decorator functions for checking pages
-from google.appengine.ext import db
-
-from models.comment import Comment
 
 def user_logged_in(function):
     """ Decorator function to check that the user is logged in.
     If not, redirects to login page.
     """
     def login_wrapper(self, *args):
-        if self.user:
+        if self.session:
             function(self, *args)
         else:
             self.redirect('/blog/login')
@@ -19,8 +16,7 @@ def post_exists(function):
     print error message if not valid
     """
     def post_wrapper(self, blog_id):
-        key = db.Key.from_path('BlogPost', int(blog_id))
-        blog_post = db.get(key)
+        blog_post = self.get_post(blog_id)
         if blog_post:
             return function(self, blog_id)
         else:
@@ -35,8 +31,7 @@ def post_exists2(function):
     """
     def post2_wrapper(self, *args):
         blog_id = self.request.get('blog_id')
-        key = db.Key.from_path('BlogPost', int(blog_id))
-        blog_post = db.get(key)
+        blog_post = self.get_post(blog_id)
         if blog_post:
             return function(self, *args)
         else:
@@ -46,15 +41,15 @@ def post_exists2(function):
 def comment_exists(function):
     """ Decorator function to check for valid comment_id and
     print error message if not valid. This function extracts
-    the comment id from the page request.
+    the comment id from the page request, and looks for the comment
+    on the post with this blog_id.
     """
-    def comment_wrapper(self, *args):
+    def comment_wrapper(self, blog_id):
         # Get comment id from request
         cid = self.request.get('cid')
-        key = db.Key.from_path('Comment', int(cid))
-        cmt = db.get(key)
+        cmt = self.get_valid_comment(blog_id, cid)
         if cmt:
-            return function(self, *args)
+            return function(self, blog_id)
         else:
             self.error(404)
             return
@@ -68,17 +63,14 @@ def user_owns_post(function):
     def post_owner_wrapper(self):
         # Get blog id
         blog_id = self.request.get('blog_id')
-        key = db.Key.from_path('BlogPost', int(blog_id))
-        blog_post = db.get(key)
+        blog_post = self.get_post(blog_id)
         # Check for author of post
-        if blog_post.valid_author(self.user):
+        if blog_post.valid_author(self.session):
             return function(self)
         else:
             # Invalid user
             msg = "Users can only edit or delete their own posts"
-            comments = Comment.get_comments(blog_post.comments)
-            self.render('permalink.html', entry=blog_post,
-                    comments=comments, error=msg)
+            self.render_permalink(blog_post, error=msg)
     return post_owner_wrapper
 
 def user_owns_comment(function):
@@ -88,19 +80,15 @@ def user_owns_comment(function):
     """
     def cmt_owner_wrapper(self, blog_id):
         # Get post from id
-        key = db.Key.from_path('BlogPost', int(blog_id))
-        blog_post = db.get(key)
+        blog_post = self.get_post(blog_id)
         # Get comment from page request
         cid = self.request.get('cid')
-        key = db.Key.from_path('Comment', int(cid))
-        cmt = db.get(key)
+        cmt = self.get_valid_comment(blog_id, cid)
         # Check user
-        if cmt.valid_author(self.user):
+        if cmt.valid_author(self.session):
             return function(self, blog_id)
         else:
             # Invalid user
             msg = "Users can only edit or delete comments they have made."
-            comments = Comment.get_comments(blog_post.comments)
-            self.render('permalink.html', entry=blog_post,
-                    comments=comments, error=msg)
+            self.render_permalink(blog_post, error=msg)
     return cmt_owner_wrapper
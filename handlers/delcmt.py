@@ -1,7 +1,9 @@
 # Delete comment handler
 import bloghandler
+import cache
 import decorator
-from models.post import BlogPost
+from storage import defer
+from models import search
 from models.comment import Comment
 
 
@@ -16,14 +18,17 @@ class DeleteComment(bloghandler.Handler):
     @decorator.user_owns_comment
     def get(self, blog_id):
         # Get post from id
-        blog_post = BlogPost.get_by_id(int(blog_id))
-        # Get comment from id
+        blog_post = self.get_post(blog_id)
+        # Get comment id
         cid = self.request.get('cid')
-        cmt = self.get_valid_comment(cid)
-        # remove comment from blog
-        blog_post.delete_comment(int(cid))
-        blog_post.put()
-        # Delete comment
-        cmt.delete()
+        # Move any comments still listed on the post under it
+        if blog_post.comments:
+            blog_post = Comment.migrate(blog_id)
+            self.set_entity(blog_post)
+        # Delete comment from under the blog post
+        Comment.remove(blog_id, cid)
+        self.entities[Comment.comment_key(blog_post, cid)] = None
+        defer(search.unindex_comment, blog_id, cid)
+        cache.bump_front_page()
         # redirect to permalink page
         self.redirect('/blog/%d' % int(blog_id))
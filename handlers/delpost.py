@@ -1,8 +1,10 @@
 # Delete post handler
 import bloghandler
+import cache
 import decorator
-from models.post import BlogPost
-from models.comment import Comment
+from storage import defer
+from models import search
+from models.purge import PostPurge
 
 
 class DeletePost(bloghandler.Handler):
@@ -15,9 +17,11 @@ class DeletePost(bloghandler.Handler):
     def get(self):
         # Get post from id
         blog_id = self.get_post_id()
-        blog_post = BlogPost.get_by_id(blog_id)
-        # Delete all comments associated with this post
-        Comment.delete_comments(blog_post.comments)
-        # Delete the post
-        blog_post.delete()
+        blog_post = self.get_post(blog_id)
+        # Delete the post, along with its comments and likes. Posts
+        # with many comments or likes are cleaned up in the background.
+        PostPurge.start(blog_post)
+        self.entities[blog_post.key()] = None
+        defer(search.unindex_post, blog_id)
+        cache.bump_front_page()
         self.redirect('/blog/welcome')
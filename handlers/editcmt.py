@@ -1,7 +1,8 @@
 # Edit comment page handler
 import bloghandler
 import decorator
-from models.post import BlogPost
+from storage import defer
+from models import search
 from models.comment import Comment
 
 
@@ -15,10 +16,10 @@ class EditComment(bloghandler.Handler):
     @decorator.user_owns_comment
     def get(self, blog_id):
         # Get post from id
-        blog_post = BlogPost.get_by_id(int(blog_id))
+        blog_post = self.get_post(blog_id)
         # Get comment from id
         cid = self.request.get('cid')
-        cmt = self.get_valid_comment(cid)
+        cmt = self.get_valid_comment(blog_id, cid)
         # Render comment form with previous content filled in
         self.render('comment.html', entry=blog_post,
                         comment=cmt.text)
@@ -29,19 +30,23 @@ class EditComment(bloghandler.Handler):
     @decorator.user_owns_comment
     def post(self, blog_id):
         # Get post from id
-        blog_post = BlogPost.get_by_id(int(blog_id))
+        blog_post = self.get_post(blog_id)
         # Get comment from id
         cid = self.request.get('cid')
-        cmt = self.get_valid_comment(cid)
+        cmt = self.get_valid_comment(blog_id, cid)
         # Get action
         action = self.request.get('action')
         if action and action == 'Save':
             # get new comment
             cmt_text = self.request.get('comment')
             if cmt_text:
+                # Move any comments still listed on the post under it
+                if blog_post.comments:
+                    self.set_entity(Comment.migrate(blog_id))
                 # Udpate comment with new content
-                cmt.update_text(cmt_text)
-                cmt.put()
+                cmt = Comment.edit(blog_id, cid, cmt_text)
+                self.set_entity(cmt)
+                defer(search.index_comment, blog_id, cid)
                 # Redirect to permalink page
                 self.redirect('/blog/%d' % int(blog_id))
             else:
@@ -1,8 +1,10 @@
 # Edit blog post page
 import bloghandler
+import cache
 import decorator
+from storage import defer
+from models import search
 from models.post import BlogPost
-from models.comment import Comment
 
 
 class EditPost(bloghandler.Handler):
@@ -15,7 +17,7 @@ class EditPost(bloghandler.Handler):
     def get(self):
         # Get post from id
         blog_id = self.get_post_id()
-        blog_post = BlogPost.get_by_id(blog_id)
+        blog_post = self.get_post(blog_id)
         # render the form with the old content inserted
         subject = blog_post.subject
         content = blog_post.content
@@ -25,9 +27,8 @@ class EditPost(bloghandler.Handler):
     @decorator.post_exists2
     @decorator.user_owns_post
     def post(self):
-        # Get post from id
+        # Get post id
         blog_id = self.get_post_id()
-        blog_post = BlogPost.get_by_id(blog_id)
         # Get action
         action = self.request.get('action')
         if action and action == 'Save':
@@ -37,8 +38,11 @@ class EditPost(bloghandler.Handler):
             # Error checking on input
             if subject and content:
                 # Update existing Blog Post
-                blog_post.update_post_content(subject, content)
-                blog_post.put()
+                blog_post = BlogPost.update(blog_id,
+                    BlogPost.update_post_content, subject, content)
+                self.set_entity(blog_post)
+                defer(search.index_post, blog_id)
+                cache.bump_front_page()
                 # Redirect to permalink page
                 self.redirect('/blog/%d' % blog_id)
             else:
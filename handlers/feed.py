@@ -0,0 +1,125 @@
+# Atom feeds of the blog's posts
+import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+import bloghandler
+import cache
+import instrument
+from models.user import User
+from models.summary import PostSummary
+
+# Most entries listed in a feed
+FEED_ENTRIES = 20
+# Most bytes of entries in a feed. Entries that don't fit are left out,
+# so a feed stays small however many readers poll it.
+FEED_MAX_BYTES = 128 * 1024
+
+ATOM_TYPE = 'application/atom+xml'
+ATOM_DATE = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def atom_date(stamp):
+    """ Returns a (UTC) datetime in the Atom date format """
+    return stamp.strftime(ATOM_DATE)
+
+def entry_xml(entry, site_url):
+    """ Returns the Atom entry for a post summary, as unicode """
+    url = u'%s/blog/%d' % (site_url, entry.get_id())
+    summary = entry.excerpt or u''
+    if entry.truncated:
+        summary += u'...'
+    return (u'<entry>\n'
+            u'<title>%s</title>\n'
+            u'<link href=%s/>\n'
+            u'<id>%s</id>\n'
+            u'<published>%s</published>\n'
+            u'<updated>%s</updated>\n'
+            u'<author><name>%s</name></author>\n'
+            u'<summary>%s</summary>\n'
+            u'</entry>\n') % (
+                escape(entry.subject), quoteattr(url), escape(url),
+                atom_date(entry.created),
+                atom_date(entry.updated or entry.created),
+                escape(entry.author_name or u''), escape(summary))
+
+def feed_chunks(title, feed_url, site_url, updated, entries,
+                max_bytes=FEED_MAX_BYTES):
+    """ Generates an Atom feed of post summaries as UTF-8 encoded
+    chunks: the feed header, then one chunk per entry until max_bytes
+    of entries have been sent, then the end of the feed
+    """
+    yield (u'<?xml version="1.0" encoding="utf-8"?>\n'
+           u'<feed xmlns="http://www.w3.org/2005/Atom">\n'
+           u'<title>%s</title>\n'
+           u'<link rel="self" href=%s/>\n'
+           u'<link href=%s/>\n'
+           u'<id>%s</id>\n'
+           u'<updated>%s</updated>\n' % (
+               escape(title), quoteattr(feed_url),
+               quoteattr(site_url + u'/blog'), escape(feed_url),
+               atom_date(updated))).encode('utf-8')
+    size = 0
+    for entry in entries:
+        chunk = entry_xml(entry, site_url).encode('utf-8')
+        size += len(chunk)
+        if size > max_bytes:
+            break
+        yield chunk
+    yield '</feed>\n'
+
+def cache_chunks(key, etag, last_modified, chunks):
+    """ Passes on an iterator of chunks, then caches the whole feed
+    under key with its ETag and last modified date
+    """
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    cache.get_backend().set(key, (etag, last_modified, ''.join(parts)),
+                            time=cache.fill_ttl(cache.FEED_TTL))
+
+
+class FeedHandler(bloghandler.Handler):
+    """ Feed handler serves an Atom feed of the most recent posts, or of
+    one author's posts when given their username. Feeds are built from
+    post summaries and streamed where pages are, then cached until the
+    next write that changes the front page, so polling a current feed
+    costs one cache lookup. Clients with a current copy get a 304
+    response.
+    """
+    def get(self, name=None):
+        variant = '%s:%s' % (self.request.host, name or '')
+        key = cache.feed_key(variant)
+        feed = cache.get_backend().get(key)
+        if feed is not None:
+            etag, last_modified, body = feed
+            if not self.not_modified(etag, last_modified):
+                self.response.content_type = ATOM_TYPE
+                self.response.charset = 'utf-8'
+                self.write(body)
+            return
+
+        if name:
+            user = User.by_name(name)
+            if not user:
+                self.error(404)
+                return
+            entries = PostSummary.author_page(user.key(), None,
+                                              FEED_ENTRIES)[0]
+            title = u'Multi-User Blog: posts by %s' % user.name
+        else:
+            entries = PostSummary.recent_page(None, FEED_ENTRIES)[0]
+            title = u'Multi-User Blog'
+        etag = self.make_etag('feed', variant,
+                              [entry.version() for entry in entries])
+        last_modified = max([entry.updated for entry in entries] or [None])
+        if self.not_modified(etag, last_modified):
+            return
+        self.response.content_type = ATOM_TYPE
+        self.response.charset = 'utf-8'
+        site_url = self.request.host_url
+        chunks = feed_chunks(title, site_url + self.request.path, site_url,
+                             last_modified or datetime.datetime.utcnow(),
+                             entries)
+        self.send_chunks(instrument.timed_chunks(
+            cache_chunks(key, etag, last_modified, chunks)))
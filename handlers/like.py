@@ -1,8 +1,9 @@
 # Like post handler
 import bloghandler
 import decorator
+from models import likebuffer
 from models.post import BlogPost
-from models.comment import Comment
+from models.summary import PostSummary
 
 class LikeHandler(bloghandler.Handler):
     """ Like handler processes a user request to "like" a blog post """
@@ -10,22 +11,28 @@ class LikeHandler(bloghandler.Handler):
     @decorator.post_exists
     def get(self, blog_id):
         # get blog entry
-        entry = BlogPost.get_by_id(int(blog_id))
+        entry = self.get_post(blog_id)
         # get user id
-        uid = self.user and self.user.key().id()
+        uid = self.session.uid
         # Check if this user is allowed to like this post
-        if entry.valid_author(self.user):
+        if entry.valid_author(self.session):
             error = "Authors aren't permitted to like their own posts"
-            comments = Comment.get_comments(entry.comments)
-            self.render('permalink.html', entry=entry,
-                    comments=comments, error=error)
+            self.render_permalink(entry, error=error)
         elif entry.user_already_liked(uid):
             error = "Users are only permitted to like a post once"
-            comments = Comment.get_comments(entry.comments)
-            self.render('permalink.html', entry=entry,
-                    comments=comments, error=error)
+            self.render_permalink(entry, error=error)
+        elif not entry.add_like(uid):
+            # A duplicate request liked the post first
+            error = "Users are only permitted to like a post once"
+            self.render_permalink(entry, error=error)
         else:
-            # like the post
-            entry.add_like(uid)
-            entry.put()
+            # the like was added, so move any likes still in the
+            # post's legacy list
+            if entry.likes:
+                BlogPost.migrate_likes(blog_id)
+            # The list pages' like count is brought up to date by a
+            # task, which buffered likes queue when they are flushed.
+            # It changes the front page once it has run.
+            if not likebuffer.enabled():
+                PostSummary.queue_update_likes(blog_id)
             self.redirect('/blog/%d' % int(blog_id))
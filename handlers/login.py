@@ -19,11 +19,8 @@ class LoginHandler(bloghandler.Handler):
         u = User.by_name(username)
         if u and utils.valid_pw(username, password, u.hashed_pw):
             # Process a valid input
-            # Set cookie to user_id
-            uid = u.key().id()
-            user_id = utils.make_secure_cookie(str(uid))
-            self.response.headers.add_header('Set-Cookie',
-                                    'user_id=%s; Path=/' % user_id)
+            # Set session cookie to user id and name
+            self.set_session(u.key().id(), u.name)
             # Redirect to welcome page
             self.redirect('/blog/welcome')
         else:
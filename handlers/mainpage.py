@@ -1,16 +1,50 @@
 # Front Blog page
-from google.appengine.ext import db
-
 import bloghandler
+import cache
+from models.summary import PostSummary
+from models.paging import decode_cursor, valid_page_size
 
 
 class MainPage(bloghandler.Handler):
     """ Main page handler for the blog loads the front HTML template.
-    This page displays the most recent 10 blog posts with links to their
-    corresponding permalink pages.
+    This page displays an excerpt of the most recent blog posts, a page
+    at a time, with links to their corresponding permalink pages. It
+    reads post summaries only, never the posts themselves. The rendered
+    page and its ETag are cached until the next write that changes it,
+    and clients with a current copy get a 304 response.
     """
     def get(self):
-        # Get blog entries
-        entries = db.GqlQuery("SELECT * FROM BlogPost "
-                           "ORDER BY created DESC LIMIT 10")
-        self.render('front.html', entries=entries)
+        # Get paging input, ignoring cursors we can't read
+        cursor = self.request.get('cursor')
+        if not decode_cursor(cursor):
+            cursor = ''
+        page_size = valid_page_size(self.request.get('size'))
+        # The page header depends on whether a user is logged in
+        variant = '%s:%s:%d' % (self.session and 'user' or 'anon', cursor,
+                                page_size)
+        key = cache.front_page_key(variant)
+        page = cache.get_backend().get(key)
+        if page is None:
+            # Get blog entry summaries
+            entries, next_cursor, prev_cursor = PostSummary.recent_page(
+                cursor, page_size)
+            # The page changes with the newest change to its entries
+            etag = self.make_etag('front', variant, next_cursor,
+                                  prev_cursor,
+                                  [entry.version() for entry in entries])
+            last_modified = max([entry.updated
+                                 for entry in entries] or [None])
+            if self.not_modified(etag, last_modified):
+                return
+            html = self.render_str('front.html', entries=entries,
+                                   next_cursor=next_cursor,
+                                   prev_cursor=prev_cursor,
+                                   page_size=page_size, pager_url='/blog')
+            page = (etag, last_modified, html)
+            ttl = cache.fill_ttl(cache.FRONT_PAGE_TTL)
+            cache.get_backend().set(key, page, time=ttl)
+        else:
+            etag, last_modified, html = page
+            if self.not_modified(etag, last_modified):
+                return
+        self.write(html)
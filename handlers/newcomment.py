@@ -1,41 +1,43 @@
 # New comment page
 import bloghandler
+import cache
 import decorator
-from models.post import BlogPost
+from storage import defer
+from models import search
 from models.comment import Comment
 
 
 class NewComment(bloghandler.Handler):
     """ New Comment handler loads the comment HTML template and
     processes user input to create a new comment. The new comment is
-    added to the Comment database and linked with the blog post.
+    stored in the Comment database as a child of the blog post.
     """
     @decorator.user_logged_in
     @decorator.post_exists
     def get(self, blog_id):
         # Get post from id
-        blog_post = BlogPost.get_by_id(int(blog_id))
+        blog_post = self.get_post(blog_id)
         self.render('comment.html', entry=blog_post)
 
     @decorator.user_logged_in
     @decorator.post_exists
     def post(self, blog_id):
         # Get post from id
-        blog_post = BlogPost.get_by_id(int(blog_id))
+        blog_post = self.get_post(blog_id)
         # Get action
         action = self.request.get('action')
         if action and action == 'Save':
             # get comment text
             cmt_text = self.request.get('comment')
             if cmt_text:
-                # Create new Comment object
-                c = Comment(blog_post=blog_post, author=self.user,
-                            text=cmt_text)
-                c.put()
-                # Add comment to blog_post
-                cid = c.key().id()
-                blog_post.add_comment(cid)
-                blog_post.put()
+                # Move any comments still listed on the post under it
+                if blog_post.comments:
+                    self.set_entity(Comment.migrate(blog_id))
+                # Create new Comment under blog_post
+                c = Comment.create(blog_id, self.session.key(), cmt_text)
+                self.set_entity(c)
+                defer(search.index_comment, blog_id, c.get_id())
+                cache.bump_front_page()
                 # Redirect to permalink page
                 self.redirect('/blog/%d' % int(blog_id))
             else:
@@ -1,6 +1,9 @@
 # New blog post entry page
 import bloghandler
+import cache
 import decorator
+from storage import defer
+from models import search
 from models.post import BlogPost
 
 
@@ -21,10 +24,12 @@ class NewPost(bloghandler.Handler):
             content = self.request.get('content')
             # Error checking on input
             if subject and content:
-                # Create new Blog Post
-                b = BlogPost(author=self.user, subject=subject,
-                            content=content)
-                b.put()
+                # Create new Blog Post, with its summary for list pages
+                b = BlogPost.create(self.session.key(), self.session.name,
+                                    subject, content)
+                self.set_entity(b)
+                defer(search.index_post, b.get_id())
+                cache.bump_front_page()
                 # Redirect to permalink page
                 blog_id = b.key().id()
                 self.redirect('/blog/%d' % blog_id)
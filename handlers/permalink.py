@@ -1,19 +1,32 @@
 # Permalink blog page
 import bloghandler
-import decorator
-from models.post import BlogPost
-from models.comment import Comment
 
 
 class PermalinkHandler(bloghandler.Handler):
     """ Permalink page handler loads the permalink HTML template which
     displays a single blog post, including the blog content,
-    number of likes, and all associated comments. It also allows
+    number of likes, and the first page of its comments. Further pages
+    are loaded from the comments fragment page. It also allows
     registered users to like this post and create, edit, and delete
-    user-owned comments.
+    user-owned comments. Clients with a current copy of the page get
+    a 304 response, without it being rendered.
     """
-    @decorator.post_exists
+    post_counts = True
+
     def get(self, blog_id):
-        entry = BlogPost.get_by_id(int(blog_id))
-        comments = Comment.get_comments(entry.comments)
-        self.render('permalink.html', entry=entry, comments=comments)
+        # Start on the comments while the post is looked up, unless the
+        # client has a copy that may still be current
+        page = None
+        if not self.is_conditional():
+            page = self.start_comment_page(blog_id)
+        entry = self.get_post(blog_id)
+        if not entry:
+            self.error(404)
+            return
+        # Comment controls depend on who is logged in
+        viewer = self.session and self.session.name
+        etag = self.make_etag('permalink', viewer, entry.version(),
+                              self.request.get('cursor'),
+                              self.request.get('size'))
+        if not self.not_modified(etag, entry.last_modified()):
+            self.render_permalink(entry, page)
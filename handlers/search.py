@@ -0,0 +1,24 @@
+# Search page
+import bloghandler
+from models import search
+from models.paging import valid_page_size
+
+
+class SearchHandler(bloghandler.Handler):
+    """ Search page handler loads the search HTML template, which lists
+    the posts and comments that best match the q parameter, a page at
+    a time. The cursor parameter is the number of results to skip.
+    """
+    def get(self):
+        query = self.request.get('q').strip()
+        page_size = valid_page_size(self.request.get('size'))
+        try:
+            offset = max(int(self.request.get('cursor') or 0), 0)
+        except ValueError:
+            offset = 0
+        results, has_more = search.search(query, offset, page_size)
+        next_cursor = has_more and offset + page_size or None
+        prev_cursor = offset and max(offset - page_size, 0)
+        self.render('search.html', query=query, results=results,
+                    offset=offset, next_cursor=next_cursor,
+                    prev_cursor=prev_cursor, page_size=page_size)
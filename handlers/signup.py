@@ -43,15 +43,17 @@ class SignupHandler(bloghandler.Handler):
             input_error = True
 
         if not input_error:
-            # Create user entry in database
+            # Create user entry in database, claiming the username
             hashed_pw = utils.make_pw_hash(username, password)
-            u = User(name=username, hashed_pw=hashed_pw, email=email)
-            u.put()
-            # Set cookie to user_id
-            uid = u.key().id()
-            user_id = utils.make_secure_cookie(str(uid))
-            self.response.headers.add_header('Set-Cookie',
-                                    'user_id=%s; Path=/' % user_id)
+            u = User.register(username, hashed_pw, email)
+            if not u:
+                # Someone else registered this name in the meantime
+                user_error = "The user already exists"
+                self.render('signup.html', username=username, email=email,
+                            user_error=user_error)
+                return
+            # Set session cookie to user id and name
+            self.set_session(u.key().id(), u.name)
             # Redirect to welcome page
             self.redirect('/blog/welcome')
         else:
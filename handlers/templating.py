@@ -0,0 +1,173 @@
+# Jinja environment for the blog pages.
+#
+# In production the templates are loaded from Python modules that
+# compile_templates.py builds from templates/ before deploying, so an
+# instance never parses a template. Compiled modules older than any
+# template are stale, and are ignored with a warning. Without them,
+# templates are loaded from templates/ and their compiled bytecode is
+# shared through the cache backend, so a cold instance can skip parsing
+# them. Either way, templates are only checked for changes on disk when
+# developing.
+#
+# jinja2 is only imported, and the environment only created, when the
+# first page is rendered, so instances start without paying for it.
+#
+# Pages can also be streamed: rendered piece by piece with generate()
+# and sent in chunks as they are produced, so a large page is never
+# held in memory whole. App Engine's python27 runtime buffers the whole
+# response anyway, so pages are only streamed by the development and
+# local servers (see bloghandler.STREAM_PAGES).
+import logging
+import os
+import zlib
+
+import cache
+
+base_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..'))
+template_dir = os.path.join(base_dir, 'templates')
+compiled_dir = os.path.join(base_dir, 'compiled_templates')
+
+# Options the templates are compiled with. Precompiled templates must be
+# built with the same options they are loaded with.
+TEMPLATE_OPTIONS = {'autoescape': True}
+
+# Bytes of rendered output gathered into each chunk of a streamed page
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+def in_production():
+    """ Returns True when running on App Engine rather than locally """
+    return os.environ.get('SERVER_SOFTWARE', '').startswith(
+        'Google App Engine')
+
+def compiled_current():
+    """ Returns True if there is a compiled module for every template,
+    and none of the templates changed after they were compiled
+    """
+    try:
+        compiled = [os.path.getmtime(os.path.join(compiled_dir, name))
+                    for name in os.listdir(compiled_dir)
+                    if name.endswith('.py')]
+    except OSError:
+        return False
+    names = template_names()
+    if len(compiled) < len(names):
+        return False
+    newest = max(os.path.getmtime(os.path.join(template_dir, name))
+                 for name in names)
+    return newest <= min(compiled)
+
+def use_compiled():
+    """ Returns True if the precompiled templates should be loaded. They
+    are used in production when present and current, or anywhere when
+    the BLOG_TEMPLATES environment variable is "compiled".
+    """
+    mode = os.environ.get('BLOG_TEMPLATES')
+    if mode == 'source':
+        return False
+    if mode != 'compiled' and not in_production():
+        return False
+    if not os.path.isdir(compiled_dir):
+        logging.warning('No compiled templates, loading templates/ '
+                        'instead; run compile_templates.py')
+        return False
+    if not compiled_current():
+        logging.warning('Compiled templates are out of date, loading '
+                        'templates/ instead; run compile_templates.py')
+        return False
+    return True
+
+def make_environment(compiled=None):
+    """ Returns a new Jinja environment, loading precompiled templates
+    if compiled is True (or, by default, if use_compiled() says so)
+    """
+    import jinja2
+    if compiled is None:
+        compiled = use_compiled()
+    if compiled:
+        return jinja2.Environment(loader=jinja2.ModuleLoader(compiled_dir),
+                                  auto_reload=False, **TEMPLATE_OPTIONS)
+    bytecode_cache = jinja2.MemcachedBytecodeCache(
+        cache.get_backend(), prefix='jinja2/bytecode/')
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                              bytecode_cache=bytecode_cache,
+                              auto_reload=not in_production(),
+                              **TEMPLATE_OPTIONS)
+
+_jinja_env = None
+
+def get_environment():
+    """ Returns the shared Jinja environment, creating it on first use """
+    global _jinja_env
+    if _jinja_env is None:
+        _jinja_env = make_environment()
+    return _jinja_env
+
+
+def stream_template(name, params, chunk_size=STREAM_CHUNK_SIZE):
+    """ Renders the named template with params as an iterator of UTF-8
+    encoded chunks of about chunk_size bytes, each produced as the
+    template gets to it
+    """
+    template = get_environment().get_template(name)
+    return buffer_chunks(template.generate(params), chunk_size)
+
+def buffer_chunks(pieces, chunk_size=STREAM_CHUNK_SIZE):
+    """ Gathers an iterator of small unicode pieces into UTF-8 encoded
+    chunks of at least chunk_size bytes (except the last)
+    """
+    parts = []
+    size = 0
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        parts.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+    if parts:
+        yield ''.join(parts)
+
+def logged_chunks(chunks):
+    """ Passes on an iterator of chunks, logging any error raised while
+    producing them. The response has been started by then, so the page
+    is cut short instead of being replaced by an error page.
+    """
+    try:
+        for chunk in chunks:
+            yield chunk
+    except Exception:
+        logging.exception('Rendering a streamed page failed')
+
+def gzip_chunks(chunks, level=6):
+    """ Compresses an iterator of chunks into gzip format as it goes.
+    Each chunk is flushed, so the client can decode it on arrival.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def template_names():
+    """ Returns the names of all the page templates """
+    return sorted(name for name in os.listdir(template_dir)
+                  if name.endswith('.html'))
+
+def warm_templates():
+    """ Loads every template into the environment, so no page pays for
+    it on its first request. Returns the number of templates loaded.
+    """
+    env = get_environment()
+    names = template_names()
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+def compile_templates(target=compiled_dir):
+    """ Compiles every template into a Python module in target """
+    import jinja2
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                             **TEMPLATE_OPTIONS)
+    env.compile_templates(target, zip=None, ignore_errors=False)
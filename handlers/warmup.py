@@ -0,0 +1,14 @@
+# Warmup request handler
+import bloghandler
+import templating
+
+
+class WarmupHandler(bloghandler.Handler):
+    """ Warmup handler is called by App Engine when it starts a new
+    instance, before the instance serves traffic. It loads all the
+    templates so user requests don't pay for it.
+    """
+    def get(self):
+        count = templating.warm_templates()
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.write('Loaded %d templates\n' % count)
@@ -1,19 +1,39 @@
 # Welcome page
 import bloghandler
-from models.post import BlogPost
+from storage import db
+from models.authorstats import AuthorStats
+from models.summary import PostSummary
+from models.paging import valid_page_size
 
 
 class WelcomeHandler(bloghandler.Handler):
     """ Welcome page handler loads the welcome HTML template. This page
     displays a welcome message and control panel for this User. It
-    contains a table of all the user's posts and allows them to create,
-    edit, or delete their posts.
+    shows the totals of the user's posts, likes and comments, and
+    contains a table of the user's posts, a page at a time, and allows
+    them to create, edit, or delete their posts.
     """
     def get(self):
         # if user is logged in
-        if self.user:
-            # Look up blog posts for this user
-            entries = BlogPost.all().filter('author =', self.user).order('-created')
-            self.render('welcome.html', username=self.user.name, entries=entries)
+        if self.session:
+            # Look up a page of this user's post summaries, while their
+            # totals are looked up
+            cursor = self.request.get('cursor')
+            page_size = valid_page_size(self.request.get('size'))
+            found = db.get_async(AuthorStats.stats_key(self.session.key()))
+            entries, next_cursor, prev_cursor = PostSummary.author_page(
+                self.session.key(), cursor, page_size)
+            stats = found.get_result() or AuthorStats()
+            etag = self.make_etag('welcome', self.session.uid,
+                                  self.session.name, cursor, page_size,
+                                  next_cursor, prev_cursor, stats.totals(),
+                                  [(entry.get_id(), entry.subject,
+                                    entry.created) for entry in entries])
+            if self.not_modified(etag):
+                return
+            self.render('welcome.html', username=self.session.name,
+                        stats=stats, entries=entries,
+                        next_cursor=next_cursor, prev_cursor=prev_cursor,
+                        page_size=page_size, pager_url='/blog/welcome')
         else:
             self.redirect('/blog/signup')
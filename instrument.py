@@ -0,0 +1,366 @@
+# Request instrumentation for the blog.
+#
+# When the BLOG_STATS environment variable is "on", blog.py wraps the
+# app in StatsMiddleware, which records for each route pattern:
+#   - the number of requests, server errors and their wall time
+#   - the time spent rendering templates
+#   - the calls, items and time of each kind of storage operation
+# The totals are shown on /blog/_stats, and every request is also
+# logged as one "request_stats" line of JSON. If BLOG_PROFILE_RATE is
+# set to a fraction such as 0.01, that share of requests are run under
+# cProfile and their slowest functions logged.
+#
+# Whether or not the middleware is on, op_budget() counts the storage
+# operations made by a block of code, and assert_op_budget() checks the
+# operations of a request, so tests can catch N+1 query regressions.
+import collections
+import contextlib
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from storage import add_hook
+
+# Number of recent wall times kept per route for percentiles
+RECENT_SIZE = 1000
+# Number of functions listed for a profiled request
+PROFILE_LIMIT = 25
+# Name under which requests that match no route are recorded
+UNMATCHED = '(unmatched)'
+
+
+def enabled():
+    """ Returns True if requests should be instrumented """
+    return os.environ.get('BLOG_STATS') == 'on'
+
+def profile_rate():
+    """ Returns the fraction of requests to profile, from 0 to 1 """
+    try:
+        return float(os.environ.get('BLOG_PROFILE_RATE', 0))
+    except ValueError:
+        return 0.0
+
+
+class OpCounter(object):
+    """ OpCounter class for totalling the storage operations and render
+    time of a request or block of code
+
+    Attributes:
+        ops - dict of operation name to [calls, items, seconds]
+        render - seconds spent rendering templates
+    """
+    def __init__(self):
+        self.ops = {}
+        self.render = 0.0
+
+    def add_op(self, op, count, elapsed):
+        """ Counts one storage call """
+        totals = self.ops.setdefault(op, [0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += count
+        totals[2] += elapsed
+
+    def calls(self, op=None):
+        """ Returns the number of calls of op, or of all operations """
+        if op is None:
+            return sum(totals[0] for totals in self.ops.values())
+        return self.ops.get(op, [0])[0]
+
+    def summary(self):
+        """ Returns a dict of operation name to its calls, items and
+        milliseconds
+        """
+        return dict((op, {'calls': calls, 'items': items,
+                          'ms': round(seconds * 1000, 3)})
+                    for op, (calls, items, seconds) in self.ops.items())
+
+
+# Counters currently recording in this thread
+_local = threading.local()
+_hook_lock = threading.Lock()
+_hook_installed = False
+
+def _active():
+    """ Returns the list of counters recording in this thread """
+    if not hasattr(_local, 'counters'):
+        _local.counters = []
+    return _local.counters
+
+def _on_storage_op(op, count, elapsed):
+    """ Storage hook that counts an operation for every active counter """
+    for counter in _active():
+        counter.add_op(op, count, elapsed)
+
+def install_hook():
+    """ Registers the storage hook, once """
+    global _hook_installed
+    with _hook_lock:
+        if not _hook_installed:
+            add_hook(_on_storage_op)
+            _hook_installed = True
+
+def record_render(elapsed):
+    """ Adds elapsed seconds of template rendering to the active
+    counters
+    """
+    for counter in _active():
+        counter.render += elapsed
+
+def timed_chunks(chunks):
+    """ Passes on an iterator of rendered chunks, recording the time
+    spent producing them as render time
+    """
+    chunks = iter(chunks)
+    while True:
+        start = time.time()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            record_render(time.time() - start)
+            return
+        record_render(time.time() - start)
+        yield chunk
+
+@contextlib.contextmanager
+def counting():
+    """ Counts the storage operations and render time of the block.
+    Yields the OpCounter.
+    """
+    install_hook()
+    counter = OpCounter()
+    active = _active()
+    active.append(counter)
+    try:
+        yield counter
+    finally:
+        active.remove(counter)
+
+
+# Totals per route
+
+class RouteStats(object):
+    """ RouteStats class for totalling the requests to one route
+
+    Attributes:
+        requests - number of requests served (int)
+        errors - number of requests that failed with a server error (int)
+        wall - total wall time in seconds (float)
+        wall_max - longest wall time in seconds (float)
+        recent - wall times of the most recent requests (deque)
+        render - total render time in seconds (float)
+        ops - OpCounter of the storage operations of all requests
+    """
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.wall = 0.0
+        self.wall_max = 0.0
+        self.recent = collections.deque(maxlen=RECENT_SIZE)
+        self.render = 0.0
+        self.ops = OpCounter()
+
+    def add(self, wall, counter, status):
+        """ Adds one finished request """
+        self.requests += 1
+        if status >= 500:
+            self.errors += 1
+        self.wall += wall
+        self.wall_max = max(self.wall_max, wall)
+        self.recent.append(wall)
+        self.render += counter.render
+        for op, (calls, items, seconds) in counter.ops.items():
+            totals = self.ops.ops.setdefault(op, [0, 0, 0.0])
+            totals[0] += calls
+            totals[1] += items
+            totals[2] += seconds
+
+    def summary(self):
+        """ Returns the totals as a dict, with times in milliseconds and
+        storage operations averaged per request
+        """
+        recent = sorted(self.recent)
+        per_request = {}
+        for op, (calls, items, seconds) in self.ops.ops.items():
+            per_request[op] = {
+                'calls': round(float(calls) / self.requests, 2),
+                'items': round(float(items) / self.requests, 2),
+                'ms': round(seconds * 1000 / self.requests, 3)}
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'wall_ms': round(self.wall * 1000 / self.requests, 3),
+            'p50_ms': round(percentile(recent, 50) * 1000, 3),
+            'p95_ms': round(percentile(recent, 95) * 1000, 3),
+            'max_ms': round(self.wall_max * 1000, 3),
+            'render_ms': round(self.render * 1000 / self.requests, 3),
+            'ops_per_request': per_request}
+
+
+_routes = {}
+_routes_lock = threading.Lock()
+
+def percentile(values, pct):
+    """ Returns the pct percentile of a sorted list of values """
+    if not values:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def record_request(route, wall, counter, status):
+    """ Adds a finished request to its route's totals """
+    with _routes_lock:
+        if route not in _routes:
+            _routes[route] = RouteStats()
+        _routes[route].add(wall, counter, status)
+
+def get_stats():
+    """ Returns a dict of route pattern to its summary """
+    with _routes_lock:
+        return dict((route, stats.summary())
+                    for route, stats in _routes.items())
+
+def reset():
+    """ Clears the totals of every route """
+    with _routes_lock:
+        _routes.clear()
+
+
+# Middleware
+
+class StatsMiddleware(object):
+    """ WSGI middleware that records the wall time, render time and
+    storage operations of every request under its route pattern, and
+    logs them as a line of JSON
+    """
+    def __init__(self, app):
+        self.app = app
+        self.router = app.router
+        install_hook()
+
+    def route_name(self, environ):
+        """ Returns the pattern of the route the request will match """
+        import webapp2
+        try:
+            match = self.router.match(webapp2.Request(environ))
+        except Exception:
+            return UNMATCHED
+        return match and match[0].template or UNMATCHED
+
+    def __call__(self, environ, start_response):
+        route = self.route_name(environ)
+        status = []
+
+        def recording_start_response(status_line, headers, *args):
+            status.append(int(status_line.split()[0]))
+            return start_response(status_line, headers, *args)
+
+        profiler = None
+        rate = profile_rate()
+        if rate and random.random() < rate:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        counter = OpCounter()
+        _active().append(counter)
+        start = time.time()
+        try:
+            result = self.app(environ, recording_start_response)
+        except Exception:
+            status.append(500)
+            self.finish(environ, route, start, counter, status, profiler)
+            raise
+        done = functools.partial(self.finish, environ, route, start,
+                                 counter, status, profiler)
+        if isinstance(result, (list, tuple)):
+            # The body is already rendered
+            done()
+            return result
+        # The body is still being rendered, so record the request once
+        # it has all been sent
+        return ClosingBody(result, done)
+
+    def finish(self, environ, route, start, counter, status, profiler):
+        """ Records and logs a finished request """
+        wall = time.time() - start
+        if profiler:
+            profiler.disable()
+        active = _active()
+        if counter in active:
+            active.remove(counter)
+        code = status and status[-1] or 500
+        record_request(route, wall, counter, code)
+        logging.info('request_stats %s', json.dumps({
+            'route': route,
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO'),
+            'status': code,
+            'wall_ms': round(wall * 1000, 3),
+            'render_ms': round(counter.render * 1000, 3),
+            'ops': counter.summary()}, sort_keys=True))
+        if profiler:
+            log_profile(profiler, route, environ.get('PATH_INFO'))
+
+class ClosingBody(object):
+    """ Response body that passes on the chunks of another, and calls
+    on_close once the server has sent them and closes it
+    """
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close()
+
+def log_profile(profiler, route, path):
+    """ Logs the functions of a profiled request with the most
+    cumulative time
+    """
+    import pstats
+    import StringIO
+    output = StringIO.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats('cumulative').print_stats(PROFILE_LIMIT)
+    logging.info('request_profile %s %s\n%s', route, path, output.getvalue())
+
+
+# Test helpers
+
+@contextlib.contextmanager
+def op_budget(**limits):
+    """ Fails with an AssertionError if the block makes more storage
+    calls than its budget. Limits are given per operation, or for all
+    of them as total, e.g. op_budget(get=2, query=1, total=4).
+    Yields the OpCounter.
+    """
+    with counting() as counter:
+        yield counter
+    for op, limit in sorted(limits.items()):
+        used = counter.calls(None if op == 'total' else op)
+        if used > limit:
+            raise AssertionError(
+                '%d %s storage calls made, budget is %d (%s)' %
+                (used, op, limit, json.dumps(counter.summary(),
+                                             sort_keys=True)))
+
+def assert_op_budget(app, path, budget, **request_args):
+    """ Requests path from the WSGI app and fails with an AssertionError
+    if it made more storage calls than budget, a dict of limits as for
+    op_budget. Extra arguments are passed to webapp2.Request.blank.
+    Returns the response.
+    """
+    import webapp2
+    with op_budget(**budget):
+        response = webapp2.Request.blank(path, **request_args).get_response(
+            app)
+    return response
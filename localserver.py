@@ -0,0 +1,43 @@
+# Runs the blog on a plain machine, without the App Engine SDK, using
+# the local SQLite storage engine and Python's built-in WSGI server.
+#
+# Usage: python localserver.py [port]
+#
+# webapp2 and jinja2 must be installed. The database is kept in
+# local-blog.db unless BLOG_STORAGE_PATH says otherwise.
+import mimetypes
+import os
+import sys
+from wsgiref.simple_server import make_server
+
+# Select the local backends before the app is imported
+os.environ.setdefault('BLOG_STORAGE', 'local')
+os.environ.setdefault('BLOG_STORAGE_PATH', 'local-blog.db')
+
+import blog
+
+static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'static')
+
+
+def application(environ, start_response):
+    """ Serves files under /static like app.yaml does, and passes
+    everything else to the blog
+    """
+    path = environ.get('PATH_INFO', '')
+    if not path.startswith('/static/'):
+        return blog.app(environ, start_response)
+    filename = os.path.normpath(os.path.join(static_dir, path[8:]))
+    if not filename.startswith(static_dir) or not os.path.isfile(filename):
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['Not found']
+    content_type = mimetypes.guess_type(filename)[0] or 'text/plain'
+    start_response('200 OK', [('Content-Type', content_type)])
+    with open(filename, 'rb') as f:
+        return [f.read()]
+
+
+if __name__ == '__main__':
+    port = len(sys.argv) > 1 and int(sys.argv[1]) or 8080
+    print 'Serving the blog at http://localhost:%d/blog' % port
+    make_server('', port, application).serve_forever()
@@ -0,0 +1,181 @@
+# Create our author statistics database
+import datetime
+import uuid
+
+from storage import db, defer
+
+from models.user import User
+from models.txn import run_in_txn
+
+# Key name of the statistics under each user
+KEY_NAME = 'stats'
+# How long an applied change is remembered, so a task that runs again
+# later than that would count it twice
+CHANGE_TTL = datetime.timedelta(days=1)
+# Number of old change records deleted per reconcile batch
+FORGET_BATCH_SIZE = 500
+# Seconds an author's totals and summaries must have been left alone
+# before reconcile_author_stats corrects the totals, so changes still
+# queued for them aren't counted twice
+RECONCILE_SETTLE = 60
+
+
+class AuthorStats(db.Model):
+    """ AuthorStats class for keeping the totals of an author's posts.
+    It is stored as a child of the user and holds the sums of the
+    author's post summaries. Whenever one of them is added, changed or
+    deleted, a task to change it by the difference is queued in the
+    same transaction, so the likes and comments on all of a busy
+    author's posts don't contend for this one record. The totals can
+    lag by a few seconds. Each change is recorded by an AuthorChange
+    as it is applied, so a task that runs twice counts it once. The
+    reconcile-author-stats admin job recomputes the totals from the
+    summaries and corrects any drift.
+
+    Attributes:
+        post_count - number of posts by the author (int)
+        like_count - number of likes of the author's posts (int)
+        comment_count - number of comments on the author's posts (int)
+        updated - date last changed (date/time, automatically generated)
+    """
+    post_count = db.IntegerProperty(default = 0, indexed = False)
+    like_count = db.IntegerProperty(default = 0, indexed = False)
+    comment_count = db.IntegerProperty(default = 0, indexed = False)
+    updated = db.DateTimeProperty(auto_now = True)
+
+    @classmethod
+    def stats_key(cls, user_key):
+        """ Returns the key of the statistics of this user """
+        return db.Key.from_path(cls.kind(), KEY_NAME, parent=user_key)
+
+    @classmethod
+    def add(cls, user_key, posts=0, likes=0, comments=0):
+        """ Queues a task that adds to the totals of this user, if there
+        is one. Inside a transaction, the task is only queued if the
+        transaction succeeds.
+        """
+        if user_key is None or not (posts or likes or comments):
+            return
+        defer(cls.apply, user_key, posts, likes, comments,
+              change_id=uuid.uuid4().hex,
+              _transactional=db.is_in_transaction())
+
+    @classmethod
+    def apply(cls, user_key, posts, likes, comments, change_id=None):
+        """ Task that adds to the totals of this user, unless the change
+        with this id was already applied. Returns False if it was.
+        """
+        keys = [cls.stats_key(user_key)]
+        if change_id:
+            keys.append(AuthorChange.change_key(user_key, change_id))
+
+        def txn():
+            found = db.get(keys)
+            if change_id and found[1]:
+                return False
+            stats = found[0] or cls(key=keys[0])
+            stats.post_count += posts
+            stats.like_count += likes
+            stats.comment_count += comments
+            changed = [stats]
+            if change_id:
+                changed.append(AuthorChange(key=keys[1]))
+            db.put(changed)
+            return True
+        return run_in_txn(txn)
+
+    def totals(self):
+        """ Returns a tuple (posts, likes, comments) of the totals """
+        return self.post_count, self.like_count, self.comment_count
+
+    def to_dict(self):
+        """ Returns the totals and update date as a dict for JSON """
+        return {'posts': self.post_count, 'likes': self.like_count,
+                'comments': self.comment_count,
+                'updated': self.updated and self.updated.isoformat()}
+
+
+class AuthorChange(db.Model):
+    """ AuthorChange class for recording that a change to an author's
+    totals was applied. It is stored as a child of the user, in the same
+    entity group as the AuthorStats, with the change id as key name.
+    Records older than CHANGE_TTL are deleted by reconcile_author_stats.
+
+    Attributes:
+        created - date applied (date/time, automatically generated)
+    """
+    created = db.DateTimeProperty(auto_now_add = True)
+
+    @classmethod
+    def change_key(cls, user_key, change_id):
+        """ Returns the key recording this change to this user's totals """
+        return db.Key.from_path(cls.kind(), change_id, parent=user_key)
+
+    @classmethod
+    def forget_old(cls, batch_size=FORGET_BATCH_SIZE):
+        """ Deletes a batch of records older than CHANGE_TTL. Returns
+        the number deleted.
+        """
+        cutoff = datetime.datetime.utcnow() - CHANGE_TTL
+        keys = cls.all(keys_only=True).filter('created <', cutoff).fetch(
+            batch_size)
+        if keys:
+            db.delete(keys)
+        return len(keys)
+
+
+def reconcile_author_stats(cursor=None, batch_size=10):
+    """ Recomputes the AuthorStats of a batch of users from their post
+    summaries, starting from cursor, and corrects those that drifted.
+    A record that changes while it is being recomputed, or whose author
+    had a total or summary change in the last RECONCILE_SETTLE seconds,
+    is left for the next run. Each batch also forgets a batch of old
+    AuthorChange records. Returns a tuple (checked, drifts,
+    next_cursor), where drifts lists (username, stored totals,
+    recomputed totals, fixed) tuples and next_cursor is None once every
+    user has been checked.
+    """
+    # Summaries keep the author totals up to date, so they import this
+    # module
+    from models.summary import PostSummary
+    AuthorChange.forget_old()
+    query = User.all()
+    if cursor:
+        query.with_cursor(cursor)
+    users = query.fetch(batch_size)
+    found = db.get([AuthorStats.stats_key(user.key()) for user in users])
+    drifts = []
+    settled = (datetime.datetime.utcnow() -
+               datetime.timedelta(seconds=RECONCILE_SETTLE))
+    for user, stats in zip(users, found):
+        posts = likes = comments = 0
+        stamp = stats and stats.updated
+        latest = stamp
+        summaries = PostSummary.all().filter('author =', user.key())
+        for summary in summaries.run(batch_size=100):
+            posts += 1
+            likes += summary.like_count
+            comments += summary.comment_count
+            latest = max(latest, summary.updated)
+        totals = (posts, likes, comments)
+        stored = stats and stats.totals() or (0, 0, 0)
+        if totals == stored:
+            continue
+        if latest and latest > settled:
+            # Changes to the totals may still be queued
+            drifts.append((user.name, stored, totals, False))
+            continue
+
+        def txn():
+            key = AuthorStats.stats_key(user.key())
+            current = db.get(key)
+            if (current and current.updated) != stamp:
+                return False
+            current = current or AuthorStats(key=key)
+            (current.post_count, current.like_count,
+             current.comment_count) = totals
+            current.put()
+            return True
+        drifts.append((user.name, stored, totals, run_in_txn(txn)))
+    next_cursor = len(users) == batch_size and query.cursor() or None
+    return len(users), drifts, next_cursor
@@ -1,11 +1,23 @@
 # Create our comment database
-from google.appengine.ext import db
+from storage import db
 
 from models.post import BlogPost
 from models.user import User
+from models.commentcount import CommentCount
+from models.summary import PostSummary
+from models.paging import fetch_page, fetch_page_async
+from models.txn import run_in_txn
+
+# Maximum number of comment ids to look up in a single datastore call
+BATCH_SIZE = 500
+# Number of comments shown per page on the permalink page
+COMMENT_PAGE_SIZE = 20
 
 class Comment(db.Model):
-    """ Comment class for storing user comments.
+    """ Comment class for storing user comments. Comments are stored as
+    children of their blog post, and counted in the post's CommentCount.
+    Comments made before that are stored on their own and listed in the
+    post's legacy comments list, until the post is migrated.
 
     Attributes:
         blog_post - blog post associated with this comment (reference to
@@ -19,16 +31,30 @@ class Comment(db.Model):
     text = db.TextProperty(required = True)
     created = db.DateTimeProperty(auto_now_add = True)
 
+    @classmethod
+    def load_comments(cls, cid_list):
+        """ Given a list of comment_ids, looks them up in batches of
+        BATCH_SIZE and returns a tuple (comment_list, stale_ids).
+        The comments keep the order of cid_list. Ids with no matching
+        comment are left out and reported in stale_ids.
+        """
+        comment_list = []
+        stale_ids = []
+        for start in range(0, len(cid_list), BATCH_SIZE):
+            chunk = [int(cid) for cid in cid_list[start:start + BATCH_SIZE]]
+            for cid, cmt in zip(chunk, cls.get_by_id(chunk)):
+                if cmt:
+                    comment_list.append(cmt)
+                else:
+                    stale_ids.append(cid)
+        return comment_list, stale_ids
+
     @classmethod
     def get_comments(cls, cid_list):
         """ Given a list of comment_ids, looks them up and returns the
         list of corresponding comment objects
         """
-        comment_list = []
-        for cid in cid_list:
-            cmt = cls.get_by_id(cid)
-            if cmt:
-                comment_list.append(cmt)
+        comment_list, stale_ids = cls.load_comments(cid_list)
         return comment_list
 
     def get_author(self):
@@ -50,22 +76,170 @@ class Comment(db.Model):
     def valid_author(self, user_obj):
         """ Returns True if this is a valid user and the author of
         this comment. """
-        return user_obj and self.author.name == user_obj.name
+        # Compare keys so the author reference isn't dereferenced
+        author_key = Comment.author.get_value_for_datastore(self)
+        return user_obj and author_key == user_obj.key()
 
     def update_text(self, text):
         """ Updates comment text attribute. Note: You still
         need to put() to update database. """
         self.text = text
 
+    @staticmethod
+    def post_key(blog_id):
+        """ Returns the key of the blog post with this id """
+        return db.Key.from_path(BlogPost.kind(), int(blog_id))
+
+    @classmethod
+    def comment_key(cls, blog_post, cid):
+        """ Returns the key of comment cid on blog_post, which is stored
+        on its own if it is still on the post's legacy comments list
+        """
+        if int(cid) in blog_post.comments:
+            return db.Key.from_path(cls.kind(), int(cid))
+        return db.Key.from_path(cls.kind(), int(cid),
+                                parent=blog_post.key())
+
+    @classmethod
+    def post_comments(cls, blog_id):
+        """ Returns the list of all comments stored under this post,
+        oldest first
+        """
+        query = cls.all().ancestor(cls.post_key(blog_id)).order('created')
+        return list(query.run(batch_size=BATCH_SIZE))
+
+    @classmethod
+    def post_page(cls, blog_id, cursor=None, page_size=COMMENT_PAGE_SIZE):
+        """ Returns one page of the comments stored under this post,
+        oldest first, as a tuple (comments, next_cursor, prev_cursor)
+        """
+        query = cls.all().ancestor(cls.post_key(blog_id))
+        return fetch_page(query, cursor, page_size, descending=False)
+
+    @classmethod
+    def post_page_async(cls, blog_id, cursor=None,
+                        page_size=COMMENT_PAGE_SIZE):
+        """ Starts looking up one page of the comments stored under this
+        post. Returns a Pending whose get_result() returns what
+        post_page would.
+        """
+        query = cls.all().ancestor(cls.post_key(blog_id))
+        return fetch_page_async(query, cursor, page_size, descending=False)
+
+    @classmethod
+    def create(cls, blog_id, author, text):
+        """ Creates a new comment under a blog post and counts it on the
+        post's CommentCount and summary, in one transaction, so the post
+        itself isn't rewritten. Returns the new comment.
+        """
+        post_key = cls.post_key(blog_id)
+
+        def txn():
+            cmt = cls(parent=post_key, blog_post=post_key, author=author,
+                      text=text)
+            cmt.put()
+            CommentCount.add(post_key, 1)
+            PostSummary.add_comments(post_key, 1)
+            return cmt
+        return run_in_txn(txn)
+
+    @classmethod
+    def edit(cls, blog_id, cid, text):
+        """ Changes the text of a comment stored under a blog post and
+        marks the post's comments as changed, in one transaction.
+        Returns the updated comment.
+        """
+        post_key = cls.post_key(blog_id)
+
+        def txn():
+            cmt = cls.get_by_id(int(cid), parent=post_key)
+            cmt.update_text(text)
+            cmt.put()
+            CommentCount.add(post_key, 0)
+            return cmt
+        return run_in_txn(txn)
+
+    @classmethod
+    def remove(cls, blog_id, cid):
+        """ Deletes a comment stored under a blog post and uncounts it on
+        the post's CommentCount and summary, in one transaction
+        """
+        post_key = cls.post_key(blog_id)
+
+        def txn():
+            key = db.Key.from_path(cls.kind(), int(cid), parent=post_key)
+            if db.get(key):
+                db.delete(key)
+                CommentCount.add(post_key, -1)
+                PostSummary.add_comments(post_key, -1)
+        run_in_txn(txn)
+
+    @classmethod
+    def migrate(cls, blog_id):
+        """ Moves the legacy comments of this post under it, keeping their
+        ids, counts them and drops the post's comments list. Returns the
+        updated post.
+        """
+        post = BlogPost.get_by_id(int(blog_id))
+        if not post or not post.comments:
+            return post
+        post_key = post.key()
+        comments, stale_ids = cls.load_comments(post.comments)
+        # The copies have fixed keys, so this can be re-run if it fails
+        # before the post is updated
+        for start in range(0, len(comments), BATCH_SIZE):
+            db.put([cls(key=db.Key.from_path(cls.kind(), cmt.get_id(),
+                                             parent=post_key),
+                        blog_post=post_key,
+                        author=Comment.author.get_value_for_datastore(cmt),
+                        text=cmt.text, created=cmt.created)
+                    for cmt in comments[start:start + BATCH_SIZE]])
+
+        def txn():
+            post = BlogPost.get_by_id(int(blog_id))
+            if post.comments:
+                CommentCount.add(post_key, len(comments))
+                # Ids with no comment were counted on the summary
+                PostSummary.add_comments(post_key,
+                                         len(comments) - len(post.comments))
+                post.comments = []
+                post.put()
+            return post
+        # The copies are counted and shown together
+        post = run_in_txn(txn)
+        cls.delete_comments([cmt.get_id() for cmt in comments])
+        return post
+
     @classmethod
     def delete_comment(cls, cid):
-        """ Looks up comment by id and deletes it """
-        cmt = cid and cls.get_by_id(int(cid))
-        if cmt:
-            cmt.delete()
+        """ Deletes the legacy comment with this id """
+        if cid:
+            db.delete(db.Key.from_path(cls.kind(), int(cid)))
 
     @classmethod
     def delete_comments(cls, cid_list):
-        """ Deletes the comments on the given list of ids """
-        for cid in cid_list:
-            cls.delete_comment(cid)
+        """ Deletes the legacy comments on the given list of ids in
+        batches of BATCH_SIZE, without loading them first
+        """
+        for start in range(0, len(cid_list), BATCH_SIZE):
+            db.delete([db.Key.from_path(cls.kind(), int(cid))
+                       for cid in cid_list[start:start + BATCH_SIZE]])
+
+
+def migrate_comments(cursor=None, batch_size=20):
+    """ Moves the legacy comments of a batch of posts under their posts,
+    starting from cursor. Returns a tuple (migrated, next_cursor), where
+    migrated is the number of posts that had legacy comments and
+    next_cursor is None once every post has been processed.
+    """
+    query = BlogPost.all()
+    if cursor:
+        query.with_cursor(cursor)
+    posts = query.fetch(batch_size)
+    migrated = 0
+    for post in posts:
+        if post.comments:
+            Comment.migrate(post.get_id())
+            migrated += 1
+    next_cursor = len(posts) == batch_size and query.cursor() or None
+    return migrated, next_cursor
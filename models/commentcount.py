@@ -0,0 +1,62 @@
+# Create our comment count database
+from storage import db
+
+# Maximum number of counts to look up in a single datastore call
+BATCH_SIZE = 500
+
+# Key name of the count under each post
+KEY_NAME = 'comments'
+
+
+class CommentCount(db.Model):
+    """ CommentCount class for keeping the number of comments on a blog
+    post. It is stored as a child of the post, like the comments, so it
+    is updated in the same transaction as they are, without rewriting
+    the post itself.
+
+    Attributes:
+        count - number of comments stored under the post (int)
+        updated - date a comment on the post was last added, changed or
+            removed (date/time, automatically generated)
+    """
+    count = db.IntegerProperty(default = 0, indexed = False)
+    updated = db.DateTimeProperty(auto_now = True)
+
+    @classmethod
+    def count_key(cls, post_key):
+        """ Returns the key of the comment count of this post """
+        return db.Key.from_path(cls.kind(), KEY_NAME, parent=post_key)
+
+    @classmethod
+    def get_totals(cls, post_keys):
+        """ Given a list of post keys, looks up their counts in batches
+        and returns a dict of post key to a tuple (count, last_updated).
+        last_updated is None for a post with no comments stored under it.
+        """
+        totals = {}
+        for start in range(0, len(post_keys), BATCH_SIZE):
+            chunk = post_keys[start:start + BATCH_SIZE]
+            counts = db.get([cls.count_key(key) for key in chunk])
+            for key, counter in zip(chunk, counts):
+                if counter:
+                    totals[key] = (counter.count, counter.updated)
+                else:
+                    totals[key] = (0, None)
+        return totals
+
+    @classmethod
+    def add(cls, post_key, delta):
+        """ Adds delta to the comment count of this post and marks its
+        comments as changed. A delta of 0 just marks the change, such as
+        a comment edit. This should be called inside a transaction.
+        """
+        counter = db.get(cls.count_key(post_key))
+        if counter is None:
+            counter = cls(key_name=KEY_NAME, parent=post_key)
+        counter.count += delta
+        counter.put()
+
+    @classmethod
+    def delete_count(cls, post_key):
+        """ Deletes the comment count of this post """
+        db.delete(cls.count_key(post_key))
@@ -0,0 +1,98 @@
+# Create our sharded counter database
+import random
+
+from storage import db
+
+from models.txn import run_in_txn
+
+# Number of shards each counter is split across. Increments pick a
+# random shard, so a counter can take about NUM_SHARDS times the write
+# rate of a single entity.
+NUM_SHARDS = 10
+
+# Maximum number of shard keys to look up in a single datastore call
+BATCH_SIZE = 500
+
+
+class CounterShard(db.Model):
+    """ CounterShard class for storing one shard of a named counter.
+    The key name is '<name>:<shard index>'.
+
+    Attributes:
+        name - counter name (string, required)
+        count - this shard's part of the counter total (int)
+        updated - date last changed (date/time, automatically generated)
+    """
+    name = db.StringProperty(required = True)
+    count = db.IntegerProperty(default = 0, indexed = False)
+    updated = db.DateTimeProperty(auto_now = True)
+
+    @classmethod
+    def shard_keys(cls, name):
+        """ Returns the list of all shard keys for this counter """
+        return [db.Key.from_path(cls.kind(), '%s:%d' % (name, index))
+                for index in range(NUM_SHARDS)]
+
+    @classmethod
+    def get_totals(cls, names):
+        """ Given a list of counter names, looks up all their shards in
+        batches and returns a dict of counter name to a tuple (total,
+        last_updated). last_updated is None for a counter never changed.
+        """
+        totals = dict((name, (0, None)) for name in names)
+        keys = []
+        for name in totals:
+            keys.extend(cls.shard_keys(name))
+        for start in range(0, len(keys), BATCH_SIZE):
+            cls.add_shards(totals, db.get(keys[start:start + BATCH_SIZE]))
+        return totals
+
+    @staticmethod
+    def add_shards(totals, shards):
+        """ Adds the looked up shards (None for missing ones) to totals,
+        a dict of counter name to a tuple (total, last_updated)
+        """
+        for shard in shards:
+            if shard:
+                total, updated = totals.get(shard.name, (0, None))
+                if updated is None or shard.updated > updated:
+                    updated = shard.updated
+                totals[shard.name] = (total + shard.count, updated)
+        return totals
+
+    @classmethod
+    def get_counts(cls, names):
+        """ Given a list of counter names, looks up all their shards in
+        batches and returns a dict of counter name to total
+        """
+        totals = cls.get_totals(names)
+        return dict((name, total)
+                    for name, (total, updated) in totals.items())
+
+    @classmethod
+    def get_count(cls, name):
+        """ Returns the total of a single counter """
+        return cls.get_counts([name])[name]
+
+    @classmethod
+    def add_to_shard(cls, name, index, delta):
+        """ Adds delta to one shard of the counter. This should be called
+        inside a transaction.
+        """
+        key_name = '%s:%d' % (name, index)
+        shard = cls.get_by_key_name(key_name)
+        if shard is None:
+            shard = cls(key_name=key_name, name=name)
+        shard.count += delta
+        shard.put()
+
+    @classmethod
+    def increment(cls, name, delta=1):
+        """ Adds delta to the counter on a randomly chosen shard """
+        index = random.randrange(NUM_SHARDS)
+        run_in_txn(cls.add_to_shard, name, index, delta)
+
+    @classmethod
+    def delete_counter(cls, name):
+        """ Deletes all the shards of this counter """
+        db.delete(cls.shard_keys(name))
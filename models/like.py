@@ -0,0 +1,114 @@
+# Create our like database
+import random
+
+from storage import db
+
+from models.counter import CounterShard, NUM_SHARDS
+from models.txn import run_in_txn
+
+# Number of likes stored in one transaction by add_many. Each like is
+# its own entity group, and the counter shard is one more.
+LIKES_PER_TXN = 20
+
+
+class Like(db.Model):
+    """ Like class for recording that a user liked a blog post. The key
+    name is '<blog_id>:<user_id>', so checking whether a user liked a
+    post is a single key lookup. The number of likes on each post is
+    kept in a sharded counter.
+
+    Attributes:
+        blog_id - id of the liked blog post (int, required)
+        user_id - id of the user who liked it (int, required)
+        created - date created (date/time, automatically generated)
+    """
+    blog_id = db.IntegerProperty(required = True)
+    user_id = db.IntegerProperty(required = True)
+    created = db.DateTimeProperty(auto_now_add = True)
+
+    @staticmethod
+    def make_key_name(blog_id, user_id):
+        """ Returns the key name for a like of this post by this user """
+        return '%d:%d' % (int(blog_id), int(user_id))
+
+    @staticmethod
+    def counter_name(blog_id):
+        """ Returns the name of the like counter for this post """
+        return 'likes:%d' % int(blog_id)
+
+    @classmethod
+    def make(cls, blog_id, user_id):
+        """ Returns a new (unsaved) like of this post by this user """
+        return cls(key_name=cls.make_key_name(blog_id, user_id),
+                   blog_id=int(blog_id), user_id=int(user_id))
+
+    @classmethod
+    def exists(cls, blog_id, user_id):
+        """ Returns True if this user already liked this post """
+        key_name = cls.make_key_name(blog_id, user_id)
+        return cls.get_by_key_name(key_name) is not None
+
+    @classmethod
+    def add(cls, blog_id, user_id):
+        """ Records a like of this post by this user and counts it.
+        The check, the like record and the counter are updated in one
+        transaction, so concurrent likes are never lost or doubled.
+        Returns False if the user had already liked the post.
+        """
+        like = cls.make(blog_id, user_id)
+        index = random.randrange(NUM_SHARDS)
+
+        def txn():
+            if db.get(like.key()):
+                return False
+            like.put()
+            CounterShard.add_to_shard(cls.counter_name(blog_id), index, 1)
+            return True
+        return run_in_txn(txn)
+
+    @classmethod
+    def add_many(cls, blog_id, user_ids):
+        """ Records likes of this post by each of these users, counting
+        each batch of new likes with a single counter update. Users who
+        had already liked the post are skipped, so this can be re-run.
+        Returns the number of likes added.
+        """
+        likes = [cls.make(blog_id, uid) for uid in sorted(set(user_ids))]
+        added = 0
+        for start in range(0, len(likes), LIKES_PER_TXN):
+            chunk = likes[start:start + LIKES_PER_TXN]
+            index = random.randrange(NUM_SHARDS)
+
+            def txn():
+                found = db.get([like.key() for like in chunk])
+                new = [like for like, old in zip(chunk, found) if not old]
+                if new:
+                    db.put(new)
+                    CounterShard.add_to_shard(cls.counter_name(blog_id),
+                                              index, len(new))
+                return len(new)
+            added += run_in_txn(txn)
+        return added
+
+    @classmethod
+    def get_counts(cls, blog_ids):
+        """ Given a list of post ids, returns a dict of post id to its
+        number of likes, using one batch lookup of the counters
+        """
+        names = dict((cls.counter_name(bid), bid) for bid in blog_ids)
+        counts = CounterShard.get_counts(names.keys())
+        return dict((names[name], total) for name, total in counts.items())
+
+    @classmethod
+    def get_totals(cls, blog_ids):
+        """ Given a list of post ids, returns a dict of post id to a
+        tuple (number of likes, time of the last like)
+        """
+        names = dict((cls.counter_name(bid), bid) for bid in blog_ids)
+        totals = CounterShard.get_totals(names.keys())
+        return dict((names[name], total) for name, total in totals.items())
+
+    @classmethod
+    def delete_counter(cls, blog_id):
+        """ Deletes the like counter of this post """
+        CounterShard.delete_counter(cls.counter_name(blog_id))
@@ -0,0 +1,317 @@
+# Write-behind buffer for likes.
+#
+# When the BLOG_LIKE_BUFFER environment variable is "on", likes aren't
+# stored as they arrive. They are buffered, which drops repeated likes
+# of a post by the same user, and written in batches: the new likes of
+# each post are stored together and added to its counter with one shard
+# update per batch, so a post liked by many users at once costs a few
+# writes per flush instead of a few per like.
+#
+# On App Engine, the buffer is the "likes" pull queue (see queue.yaml),
+# with a task per like tagged with its post, so buffered likes outlive
+# the instance that took them. The flush-likes admin job, which
+# cron.yaml runs every minute, leases and stores them a post at a time.
+# Markers in memcache let pages count the likes still waiting, so users
+# see their own likes straight away. If the markers are evicted, only
+# the counts shown are late, not the likes themselves.
+#
+# With the local storage engine there is a single process, so likes are
+# buffered in memory instead. That buffer is flushed by the like that
+# fills it to FLUSH_SIZE, or that arrives FLUSH_INTERVAL seconds after
+# the oldest, by the flush-likes job, and when the process exits.
+import atexit
+import logging
+import os
+import threading
+import time
+
+import cache
+from storage import db
+
+from models.like import Like
+from models.summary import PostSummary
+
+# Number of buffered likes that triggers a flush, and the most likes of
+# a post stored in one batch
+FLUSH_SIZE = 100
+# Seconds a like may wait in the in-process buffer before it is flushed
+FLUSH_INTERVAL = 5
+
+# Name of the pull queue holding buffered likes on App Engine
+QUEUE_NAME = 'likes'
+# Seconds a flush leases a batch of likes for. Likes it hasn't stored
+# by then are leased again by a later flush.
+LEASE_SECONDS = 60
+# Seconds a flush of the pull queue works before leaving the rest for
+# the next one
+FLUSH_TIME_BUDGET = 20
+# Seconds the memcache markers of a waiting like are kept
+MARKER_TTL = 600
+
+
+def enabled():
+    """ Returns True if likes are buffered, i.e. BLOG_LIKE_BUFFER is "on" """
+    return os.environ.get('BLOG_LIKE_BUFFER') == 'on'
+
+def store_batch(blog_id, user_ids):
+    """ Stores a batch of buffered likes of an existing post and queues
+    the update of its summary. Returns the number of likes stored.
+    """
+    count = Like.add_many(blog_id, user_ids)
+    if count:
+        PostSummary.queue_update_likes(blog_id)
+    return count
+
+
+class LikeBuffer(object):
+    """ In-process buffer of likes waiting to be stored, used with the
+    local storage engine.
+
+    Attributes:
+        flush_size - number of buffered likes that triggers a flush
+        flush_interval - seconds a like may wait before a flush
+        pending - dict of post id to the set of ids of users whose likes
+            are waiting
+        flushing - the same, for likes being stored by a flush
+        size - number of likes in pending
+        oldest - time the oldest like in pending was added, or None
+        flushed - counter of likes stored by flushes
+    """
+    def __init__(self, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.flushing = {}
+        self.size = 0
+        self.oldest = None
+        self.flushed = 0
+        self.lock = threading.Lock()
+        # Held by the one flush that may run at a time
+        self.flush_lock = threading.Lock()
+
+    def add(self, blog_id, user_id):
+        """ Buffers a like of this post by this user, flushing the buffer
+        if it is due. Returns False if the like is already buffered.
+        """
+        blog_id, user_id = int(blog_id), int(user_id)
+        with self.lock:
+            if user_id in self.flushing.get(blog_id, ()):
+                return False
+            users = self.pending.setdefault(blog_id, set())
+            if user_id in users:
+                return False
+            users.add(user_id)
+            self.size += 1
+            if self.oldest is None:
+                self.oldest = time.time()
+        self.maybe_flush()
+        return True
+
+    def contains(self, blog_id, user_id):
+        """ Returns True if a like of this post by this user is waiting """
+        blog_id, user_id = int(blog_id), int(user_id)
+        with self.lock:
+            return (user_id in self.pending.get(blog_id, ()) or
+                    user_id in self.flushing.get(blog_id, ()))
+
+    def count(self, blog_id):
+        """ Returns the number of likes of this post that are waiting """
+        blog_id = int(blog_id)
+        with self.lock:
+            return (len(self.pending.get(blog_id, ())) +
+                    len(self.flushing.get(blog_id, ())))
+
+    def due(self):
+        """ Returns True if the buffer is full or its oldest like has
+        waited long enough
+        """
+        with self.lock:
+            return self.size >= self.flush_size or bool(
+                self.oldest and
+                time.time() - self.oldest >= self.flush_interval)
+
+    def maybe_flush(self):
+        """ Flushes the buffer if it is due, unless another thread is
+        already flushing it. A failed flush is logged, and retried by the
+        next one. Returns the number of likes stored.
+        """
+        if not self.due():
+            return 0
+        try:
+            return self.flush(blocking=False)
+        except Exception:
+            logging.exception('Flushing buffered likes failed')
+            return 0
+
+    def flush(self, blocking=True):
+        """ Stores every buffered like, a batch per post. Likes of posts
+        that have been deleted are dropped. If storing fails, the likes
+        that weren't stored are put back in the buffer and the error is
+        raised. Returns the number of likes stored.
+        """
+        if not self.flush_lock.acquire(blocking):
+            return 0
+        try:
+            with self.lock:
+                batch = self.flushing = self.pending
+                self.pending = {}
+                self.size = 0
+                self.oldest = None
+            added = 0
+            try:
+                blog_ids = sorted(batch)
+                posts = db.get([db.Key.from_path('BlogPost', blog_id)
+                                for blog_id in blog_ids])
+                for blog_id, post in zip(blog_ids, posts):
+                    if post:
+                        added += store_batch(blog_id, batch[blog_id])
+                    with self.lock:
+                        del batch[blog_id]
+            finally:
+                with self.lock:
+                    self.restore(batch)
+                    self.flushing = {}
+                    self.flushed += added
+            return added
+        finally:
+            self.flush_lock.release()
+
+    def restore(self, batch):
+        """ Puts likes that a flush didn't store back in the buffer. Must
+        be called with the lock held.
+        """
+        for blog_id, users in batch.items():
+            self.pending.setdefault(blog_id, set()).update(users)
+            self.size += len(users)
+        if batch and self.oldest is None:
+            self.oldest = time.time()
+
+    def get_stats(self):
+        """ Returns a dict of the buffer's counters """
+        with self.lock:
+            return {'pending': self.size, 'flushed': self.flushed}
+
+
+def _marker_key(blog_id, user_id):
+    """ Returns the memcache key marking a waiting like """
+    return 'likes:waiting:%d:%d' % (int(blog_id), int(user_id))
+
+def _count_key(blog_id):
+    """ Returns the memcache key counting a post's waiting likes """
+    return 'likes:waiting:%d' % int(blog_id)
+
+
+class LikeQueue(object):
+    """ Buffer of likes waiting to be stored, kept in App Engine's
+    "likes" pull queue. It has the same methods as LikeBuffer.
+
+    Attributes:
+        flushed - counter of likes stored by this instance's flushes
+    """
+    def __init__(self):
+        from google.appengine.api import taskqueue
+        self.taskqueue = taskqueue
+        self.queue = taskqueue.Queue(QUEUE_NAME)
+        self.flushed = 0
+
+    def add(self, blog_id, user_id):
+        """ Queues a like of this post by this user. Returns False if the
+        like is already waiting. Tasks are named after their like, so
+        the queue refuses a repeated one.
+        """
+        blog_id, user_id = int(blog_id), int(user_id)
+        task = self.taskqueue.Task(payload=str(user_id), method='PULL',
+                                   tag=str(blog_id),
+                                   name='like-%d-%d' % (blog_id, user_id))
+        try:
+            self.queue.add(task)
+        except (self.taskqueue.TaskAlreadyExistsError,
+                self.taskqueue.TombstonedTaskError):
+            return False
+        backend = cache.get_backend()
+        backend.set(_marker_key(blog_id, user_id), 1, time=MARKER_TTL)
+        backend.incr(_count_key(blog_id), initial_value=0)
+        return True
+
+    def contains(self, blog_id, user_id):
+        """ Returns True if a like of this post by this user is waiting """
+        marker = cache.get_backend().get(_marker_key(blog_id, user_id))
+        return marker is not None
+
+    def count(self, blog_id):
+        """ Returns the number of likes of this post that are waiting """
+        return cache.get_backend().get(_count_key(blog_id)) or 0
+
+    def flush(self, blocking=True):
+        """ Leases the waiting likes a post at a time and stores them,
+        until there are none left or the time budget runs out. Likes of
+        posts that have been deleted are dropped. Returns the number of
+        likes stored.
+        """
+        stop_time = time.time() + FLUSH_TIME_BUDGET
+        added = 0
+        while time.time() < stop_time:
+            # Leasing without a tag takes the oldest task's tag
+            tasks = self.queue.lease_tasks_by_tag(LEASE_SECONDS, FLUSH_SIZE)
+            if not tasks:
+                break
+            blog_id = int(tasks[0].tag)
+            user_ids = set(int(task.payload) for task in tasks)
+            if db.get(db.Key.from_path('BlogPost', blog_id)):
+                added += store_batch(blog_id, user_ids)
+            self.queue.delete_tasks(tasks)
+            backend = cache.get_backend()
+            backend.decr(_count_key(blog_id), len(user_ids))
+            for user_id in user_ids:
+                backend.delete(_marker_key(blog_id, user_id))
+        self.flushed += added
+        return added
+
+    def get_stats(self):
+        """ Returns a dict of the queue's counters """
+        return {'pending': self.queue.fetch_statistics().tasks,
+                'flushed': self.flushed}
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def get_buffer():
+    """ Returns the like buffer, creating it on first use: the pull
+    queue on App Engine, or with the local storage engine, an in-process
+    buffer that is flushed when the process exits
+    """
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            if os.environ.get('BLOG_STORAGE') == 'local':
+                _buffer = LikeBuffer()
+                atexit.register(_flush_at_exit, _buffer)
+            else:
+                _buffer = LikeQueue()
+    return _buffer
+
+def _flush_at_exit(buffer):
+    """ Stores the likes still buffered when the process exits """
+    try:
+        count = buffer.flush()
+    except Exception:
+        logging.exception('Lost %d buffered likes at exit',
+                          buffer.get_stats()['pending'])
+    else:
+        if count:
+            logging.info('Stored %d buffered likes at exit', count)
+
+def add(blog_id, user_id):
+    """ Buffers a like of this post by this user. Returns False if the
+    like is already buffered.
+    """
+    return get_buffer().add(blog_id, user_id)
+
+def is_pending(blog_id, user_id):
+    """ Returns True if a like of this post by this user is buffered """
+    return enabled() and get_buffer().contains(blog_id, user_id)
+
+def pending_count(blog_id):
+    """ Returns the number of buffered likes of this post """
+    return enabled() and get_buffer().count(blog_id) or 0
@@ -0,0 +1,108 @@
+# Helper functions for keyset (cursor) pagination of queries.
+#
+# A page is fetched by filtering on the sort property relative to the
+# first or last entry of the neighbouring page, so the cost of a page
+# stays the same however deep into the results it is. Cursors are
+# opaque, url-safe strings. Entries are assumed to have distinct sort
+# values, which holds for the microsecond 'created' timestamps we use.
+import base64
+import datetime
+
+from storage import Pending
+
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 50
+
+STAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(direction, value):
+    """ Returns an opaque cursor pointing 'next' (after) or 'prev'
+    (before) the given datetime sort value
+    """
+    raw = '%s|%s' % (direction, value.strftime(STAMP_FORMAT))
+    return base64.urlsafe_b64encode(raw)
+
+def decode_cursor(cursor):
+    """ Returns the (direction, value) tuple for a cursor string, or None
+    if the cursor isn't valid
+    """
+    try:
+        raw = base64.urlsafe_b64decode(str(cursor))
+        direction, stamp = raw.split('|')
+        value = datetime.datetime.strptime(stamp, STAMP_FORMAT)
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if direction not in ('next', 'prev'):
+        return None
+    return direction, value
+
+def valid_page_size(size, default=DEFAULT_PAGE_SIZE):
+    """ Converts a page size request parameter to an int between 1 and
+    MAX_PAGE_SIZE, using default for missing or invalid input
+    """
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+def fetch_page(query, cursor=None, page_size=DEFAULT_PAGE_SIZE,
+               prop='created', descending=True):
+    """ Fetches one page of an unordered query, sorted on prop.
+
+    Arguments:
+        query - query object with any equality filters already applied
+        cursor - cursor string from a previous page, or None for the
+            first page
+        page_size - number of entries per page
+        prop - name of the property to sort and page on
+        descending - True to list the largest values first
+
+    Returns a tuple (entries, next_cursor, prev_cursor). A cursor is None
+    when there is no page in that direction.
+    """
+    return fetch_page_async(query, cursor, page_size, prop,
+                            descending).get_result()
+
+def fetch_page_async(query, cursor=None, page_size=DEFAULT_PAGE_SIZE,
+                     prop='created', descending=True):
+    """ Starts fetching one page of an unordered query, with the same
+    arguments as fetch_page. Returns a Pending whose get_result()
+    returns the tuple fetch_page would.
+    """
+    position = cursor and decode_cursor(cursor)
+    forward_op, back_op = descending and ('<', '>') or ('>', '<')
+    forward_order = descending and '-' + prop or prop
+    backward_order = descending and prop or '-' + prop
+    backward = position and position[0] == 'prev'
+
+    if backward:
+        # Walk backwards from the cursor, then restore the page order
+        query.filter('%s %s' % (prop, back_op), position[1])
+        query.order(backward_order)
+    else:
+        if position:
+            query.filter('%s %s' % (prop, forward_op), position[1])
+        query.order(forward_order)
+    results = query.run(limit=page_size + 1, batch_size=page_size + 1)
+
+    def wait():
+        entries = list(results)
+        if backward:
+            has_prev = len(entries) > page_size
+            entries = entries[:page_size]
+            entries.reverse()
+            has_next = True
+        else:
+            has_next = len(entries) > page_size
+            entries = entries[:page_size]
+            has_prev = bool(position)
+
+        next_cursor = prev_cursor = None
+        if entries and has_next:
+            next_cursor = encode_cursor('next', getattr(entries[-1], prop))
+        if entries and has_prev:
+            prev_cursor = encode_cursor('prev', getattr(entries[0], prop))
+        return entries, next_cursor, prev_cursor
+    return Pending(wait)
@@ -1,7 +1,15 @@
 # Create our Blog database
-from google.appengine.ext import db
+from storage import db, defer
 
 from models.user import User
+from models import likebuffer
+from models.like import Like
+from models.commentcount import CommentCount
+from models.counter import CounterShard
+from models.summary import PostSummary, SummaryIndex
+from models.paging import fetch_page, DEFAULT_PAGE_SIZE
+from models.prefetch import prefetch_refs
+from models.txn import run_in_txn
 
 
 class BlogPost(db.Model):
@@ -12,16 +20,61 @@ class BlogPost(db.Model):
         subject - blog subject line (string, required)
         content - blog content (text block, required)
         created - date created (date/time, automatically generated)
-        likes - list of users who liked the post (list of user_ids (int))
-        comments - list of comments (list of comment_ids (int))
+        modified - date last changed (date/time, automatically
+            generated). Likes and comments are stamped on their counters
+            instead, so they don't rewrite the post.
+        likes - legacy list of users who liked the post (list of
+            user_ids (int)). New likes are stored as Like records and
+            counted in a sharded counter; this list is only read until
+            the post is migrated.
+        comments - legacy list of comments (list of comment_ids (int)).
+            New comments are stored as children of the post and counted
+            in its CommentCount; this list is only read until the post
+            is migrated.
     """
     author = db.ReferenceProperty(User)
     subject = db.StringProperty(required = True)
     content = db.TextProperty(required = True)
     created = db.DateTimeProperty(auto_now_add = True)
+    modified = db.DateTimeProperty(auto_now = True)
     likes = db.ListProperty(int, default=None)
     comments = db.ListProperty(int, default=None)
 
+    # Like and comment counter totals, and when each last changed,
+    # loaded on first use or by prefetch_counts
+    _like_total = None
+    _like_updated = None
+    _comment_total = None
+    _comment_updated = None
+
+    @classmethod
+    def create(cls, author, author_name, subject, content):
+        """ Creates and stores a new post with its summary, in one
+        transaction. Returns the new post.
+        """
+        def txn():
+            post = cls(author=author, subject=subject, content=content)
+            post.put()
+            summary = PostSummary.build(post, author_name)
+            summary.put()
+            summary.count_author()
+            return post
+        return run_in_txn(txn)
+
+    @classmethod
+    def update(cls, blog_id, change, *args):
+        """ Looks up the post by id, applies change(post, *args) and puts
+        it with its updated summary, all in one transaction so concurrent
+        updates aren't lost. Returns the updated post.
+        """
+        def txn():
+            post = cls.get_by_id(int(blog_id))
+            change(post, *args)
+            post.put()
+            PostSummary.refresh(post)
+            return post
+        return run_in_txn(txn)
+
     def get_id(self):
         """ Returns blog id """
         return self.key().id()
@@ -30,7 +83,9 @@ class BlogPost(db.Model):
         """ Returns True if this is a valid user and the author of
         this post.
         """
-        return user_obj and self.author.name == user_obj.name
+        # Compare keys so the author reference isn't dereferenced
+        author_key = BlogPost.author.get_value_for_datastore(self)
+        return user_obj and author_key == user_obj.key()
 
     def update_post_content(self, subject, content):
         """ Updates post subject and content fields.  Note: You still
@@ -41,24 +96,186 @@ class BlogPost(db.Model):
 
     def user_already_liked(self, user_id):
         """ Returns True if this user already liked this post """
-        return int(user_id) in self.likes
+        return (int(user_id) in self.likes or
+                likebuffer.is_pending(self.get_id(), user_id) or
+                Like.exists(self.get_id(), user_id))
 
     def add_like(self, user_id):
-        """ Add a like from this user """
-        self.likes.append(int(user_id))
+        """ Add a like from this user. This is stored straight away as a
+        Like record, or buffered if likes are (see models/likebuffer.py),
+        so there is no need to put() the post. Returns False if the user
+        had already liked the post.
+        """
+        if likebuffer.enabled():
+            return likebuffer.add(self.get_id(), user_id)
+        added = Like.add(self.get_id(), user_id)
+        if added and self._like_total is not None:
+            self._like_total += 1
+        return added
 
     def like_count(self):
-        """ Returns number of likes """
-        return len(self.likes)
+        """ Returns number of likes, counting any still buffered """
+        if self._like_total is None:
+            BlogPost.prefetch_counts([self])
+        return (len(self.likes) + self._like_total +
+                likebuffer.pending_count(self.get_id()))
+
+    def last_modified(self):
+        """ Returns the date the post, its comments or its likes last
+        changed. Posts saved before the modified date was kept fall back
+        to their created date.
+        """
+        if self._like_total is None:
+            BlogPost.prefetch_counts([self])
+        stamp = self.modified or self.created
+        for updated in (self._like_updated, self._comment_updated):
+            if updated and updated > stamp:
+                stamp = updated
+        return stamp
+
+    def version(self):
+        """ Returns a tuple that changes whenever the rendered post
+        would, for building page ETags
+        """
+        return (self.get_id(), self.last_modified(), self.like_count(),
+                self.comment_count())
+
+    @classmethod
+    def prefetch_counts(cls, posts):
+        """ Loads the like and comment counters of all the given posts
+        that haven't been loaded yet, in one batch each
+        """
+        pending = [post for post in posts if post._like_total is None]
+        likes = Like.get_totals([post.get_id() for post in pending])
+        comments = CommentCount.get_totals([post.key() for post in pending])
+        for post in pending:
+            post._like_total, post._like_updated = likes[post.get_id()]
+            post._comment_total, post._comment_updated = comments[post.key()]
+        return posts
 
-    def add_comment(self, cid):
-        """ Adds a comment id to the comments list """
-        self.comments.append(cid)
+    @classmethod
+    def get_with_counts(cls, blog_id):
+        """ Looks up a post together with its like and comment counters
+        in one batch, so showing its counts needs no further calls.
+        Returns None if there is no such post.
+        """
+        key = db.Key.from_path(cls.kind(), int(blog_id))
+        like_name = Like.counter_name(blog_id)
+        found = db.get([key, CommentCount.count_key(key)] +
+                       CounterShard.shard_keys(like_name))
+        post, counter, shards = found[0], found[1], found[2:]
+        if post:
+            totals = CounterShard.add_shards({}, shards)
+            post._like_total, post._like_updated = totals.get(like_name,
+                                                              (0, None))
+            if counter:
+                post._comment_total = counter.count
+                post._comment_updated = counter.updated
+            else:
+                post._comment_total, post._comment_updated = 0, None
+        return post
+
+    @classmethod
+    def migrate_likes(cls, blog_id):
+        """ Moves the legacy likes list of this post into Like records
+        and the post's like counter
+        """
+        post = cls.get_by_id(int(blog_id))
+        if not post or not post.likes:
+            return
+        # Like records are keyed by post and user, so this can be re-run
+        db.put([Like.make(blog_id, uid) for uid in post.likes])
+
+        def txn():
+            post = cls.get_by_id(int(blog_id))
+            if post.likes:
+                CounterShard.add_to_shard(Like.counter_name(blog_id), 0,
+                                          len(post.likes))
+                post.likes = []
+                post.put()
+        # The post and counter shard are updated together
+        run_in_txn(txn)
 
     def comment_count(self):
         """ Returns number of comments """
-        return len(self.comments)
+        if self._comment_total is None:
+            BlogPost.prefetch_counts([self])
+        return len(self.comments) + self._comment_total
+
+
+def add_summaries(posts):
+    """ Adds summaries to those of the given posts that have none, each
+    in its own transaction. Returns the number of summaries added.
+    """
+    summaries = posts and db.get([PostSummary.summary_key(post.key())
+                                  for post in posts]) or []
+    missing = [post for post, summary in zip(posts, summaries)
+               if summary is None]
+    BlogPost.prefetch_counts(missing)
+    added = 0
+    for post in missing:
+        def txn():
+            if db.get(PostSummary.summary_key(post.key())):
+                return False
+            # Read the post again, so its legacy comments are current
+            fresh = BlogPost.get_by_id(post.get_id())
+            if fresh is None:
+                return False
+            summary = PostSummary.build_missing(fresh, post.like_count())
+            summary.put()
+            summary.count_author()
+            return True
+        if run_in_txn(txn):
+            added += 1
+    return added
+
+def store_summaries(blog_ids):
+    """ Task that adds summaries to these posts, if they still have none
+    """
+    add_summaries([post for post in BlogPost.get_by_id(blog_ids) if post])
 
-    def delete_comment(self, cid):
-        """ Deletes this comment id from the comments list """
-        self.comments.remove(cid)
+def backfill_summaries(cursor=None, batch_size=20):
+    """ Adds summaries to a batch of posts saved before summaries were
+    kept, starting from cursor. Returns a tuple (added, next_cursor),
+    where next_cursor is None once every post has been processed, which
+    is then recorded in the SummaryIndex.
+    """
+    query = BlogPost.all()
+    if cursor:
+        query.with_cursor(cursor)
+    posts = query.fetch(batch_size)
+    added = add_summaries(posts)
+    next_cursor = len(posts) == batch_size and query.cursor() or None
+    if next_cursor is None:
+        SummaryIndex.mark_complete()
+    return added, next_cursor
+
+def summary_page(author=None, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """ Returns one page of post summaries like PostSummary.recent_page,
+    or like author_page when given an author, but paging through the
+    posts rather than their summaries. List pages are read this way
+    until backfill_summaries has given every post a summary. Posts that
+    have none yet are summarized on the fly, and a task is queued to
+    store their summaries.
+    """
+    query = BlogPost.all()
+    if author is not None:
+        query.filter('author =', author)
+    posts, next_cursor, prev_cursor = fetch_page(query, cursor, page_size)
+    summaries = posts and db.get([PostSummary.summary_key(post.key())
+                                  for post in posts]) or []
+    missing = [post for post, summary in zip(posts, summaries)
+               if summary is None]
+    if missing:
+        BlogPost.prefetch_counts(missing)
+        prefetch_refs(missing)
+        defer(store_summaries, [post.get_id() for post in missing])
+    entries = []
+    for post, summary in zip(posts, summaries):
+        if summary is None:
+            summary = PostSummary.build(post, post.author and post.author.name,
+                                        post.like_count(),
+                                        post.comment_count())
+            summary.updated = post.last_modified()
+        entries.append(summary)
+    return entries, next_cursor, prev_cursor
@@ -0,0 +1,33 @@
+# Helper functions for batch loading referenced entities
+from storage import db
+
+
+def prefetch_refs(entities, prop_name='author', known=None):
+    """ Resolves the ReferenceProperty prop_name on each of the given
+    entities (e.g. a list of posts and comments) using one batch
+    datastore get for all the unique referenced keys.
+
+    Arguments:
+        entities - list of model objects with a prop_name reference
+        prop_name - name of the reference property to resolve
+        known - optional dict of already loaded entities, keyed by
+            datastore key. Keys found there are not fetched again and
+            newly fetched entities are added to it.
+    """
+    if known is None:
+        known = {}
+    # Collect the referenced keys without dereferencing them
+    ref_keys = []
+    for entity in entities:
+        prop = getattr(type(entity), prop_name)
+        ref_keys.append(prop.get_value_for_datastore(entity))
+    # Fetch the unique keys we don't already have
+    missing = list(set(k for k in ref_keys if k and k not in known))
+    if missing:
+        known.update(zip(missing, db.get(missing)))
+    # Attach the resolved objects to their entities
+    for entity, key in zip(entities, ref_keys):
+        ref = key and known.get(key)
+        if ref:
+            setattr(entity, prop_name, ref)
+    return entities
@@ -0,0 +1,151 @@
+# Create our post purge database, which tracks the deletion of the
+# comments and likes of deleted blog posts
+import logging
+import time
+
+from storage import db, defer
+
+from models.comment import Comment
+from models.commentcount import CommentCount
+from models.like import Like
+from models.summary import PostSummary
+from models.txn import run_in_txn
+
+# Posts with more comments and likes than this are purged by a
+# background task
+INLINE_LIMIT = 200
+# Number of keys deleted per datastore call
+CHUNK_SIZE = 500
+# Seconds a purge task runs before handing over to a new task
+TIME_BUDGET = 60
+# Seconds a purge run inside the delete request may take, well within
+# the request deadline. A task carries on with whatever is left.
+INLINE_TIME_BUDGET = 10
+
+
+class PostPurge(db.Model):
+    """ PostPurge class for recording the progress of deleting the
+    comments and likes of a deleted blog post. The key name is the post
+    id. The record is deleted once the purge is finished.
+
+    Attributes:
+        comment_ids - ids of legacy comments still to delete (list of
+            ints). Comments stored under the post are found by query.
+        deleted - number of comments and likes deleted so far (int)
+        like_cursor - cursor of the likes query after the last chunk of
+            likes deleted (string)
+        created - date created (date/time, automatically generated)
+        updated - date of last progress (date/time, automatically generated)
+    """
+    comment_ids = db.ListProperty(int, indexed = False)
+    deleted = db.IntegerProperty(default = 0, indexed = False)
+    like_cursor = db.StringProperty(indexed = False)
+    created = db.DateTimeProperty(auto_now_add = True)
+    updated = db.DateTimeProperty(auto_now = True)
+
+    def get_id(self):
+        """ Returns the id of the deleted blog post """
+        return int(self.key().name())
+
+    @classmethod
+    def start(cls, blog_post):
+        """ Deletes blog_post and records the purge of its comments and
+        likes in one transaction, so nothing can be orphaned untracked.
+        Small purges are run straight away, handing what they don't
+        finish in time to a background task, and larger ones are handed
+        to the task from the start.
+        """
+        blog_id = blog_post.get_id()
+
+        def txn():
+            post = db.get(blog_post.key())
+            purge = cls(key_name=str(blog_id),
+                        comment_ids=post and post.comments or [])
+            purge.put()
+            count, updated = CommentCount.get_totals(
+                [blog_post.key()])[blog_post.key()]
+            if post:
+                post.delete()
+            PostSummary.delete_summary(blog_post.key())
+            return purge, len(purge.comment_ids) + count
+        purge, comment_count = run_in_txn(txn)
+        # The post is gone, so its likes can no longer grow
+        like_count = Like.get_counts([blog_id])[blog_id]
+        if comment_count + like_count > INLINE_LIMIT:
+            defer(run_purge, blog_id)
+            return
+        try:
+            run_purge(blog_id, INLINE_TIME_BUDGET)
+        except Exception:
+            logging.exception('Purging post %d failed, queuing a task',
+                              blog_id)
+            defer(run_purge, blog_id)
+
+    @classmethod
+    def resume_all(cls):
+        """ Starts a background task for every unfinished purge.
+        Returns the number of purges resumed.
+        """
+        count = 0
+        for purge in cls.all():
+            defer(run_purge, purge.get_id())
+            count += 1
+        return count
+
+
+def run_purge(blog_id, time_budget=TIME_BUDGET):
+    """ Deletes the remaining comments and likes of a deleted blog post
+    in chunks, saving progress after each one. If the time budget (in
+    seconds) runs out, a task is queued to carry on from the saved
+    progress.
+    """
+    stop_time = time.time() + time_budget
+    purge = PostPurge.get_by_key_name(str(blog_id))
+    if not purge:
+        return
+    # Delete the legacy comments first, since their ids are only
+    # recorded here
+    while purge.comment_ids:
+        if time.time() > stop_time:
+            defer(run_purge, blog_id)
+            return
+        chunk = purge.comment_ids[:CHUNK_SIZE]
+        Comment.delete_comments(chunk)
+        purge.comment_ids = purge.comment_ids[CHUNK_SIZE:]
+        purge.deleted += len(chunk)
+        purge.put()
+    # Then the comments stored under the post. This ancestor query is
+    # strongly consistent, so it never returns comments just deleted.
+    post_key = Comment.post_key(blog_id)
+    query = Comment.all(keys_only=True).ancestor(post_key)
+    keys = query.fetch(CHUNK_SIZE)
+    while keys:
+        if time.time() > stop_time:
+            defer(run_purge, blog_id)
+            return
+        db.delete(keys)
+        purge.deleted += len(keys)
+        purge.put()
+        keys = query.fetch(CHUNK_SIZE)
+    # Then the likes. Their query is only eventually consistent, so it
+    # carries on from its saved cursor rather than starting over, which
+    # could return likes already deleted.
+    while True:
+        query = Like.all(keys_only=True).filter('blog_id =', int(blog_id))
+        if purge.like_cursor:
+            query.with_cursor(purge.like_cursor)
+        keys = query.fetch(CHUNK_SIZE)
+        if not keys:
+            break
+        if time.time() > stop_time:
+            defer(run_purge, blog_id)
+            return
+        db.delete(keys)
+        purge.deleted += len(keys)
+        purge.like_cursor = query.cursor()
+        purge.put()
+    CommentCount.delete_count(post_key)
+    Like.delete_counter(blog_id)
+    logging.info('Purged %d comments and likes of post %d',
+                 purge.deleted, int(blog_id))
+    purge.delete()
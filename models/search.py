@@ -0,0 +1,508 @@
+# Full-text search over posts and comments, using an inverted index
+# kept in the datastore, so no outside search service is needed.
+#
+# Each post and each comment is a search document, numbered from a
+# dense range of ids. For every term, the index holds a posting list of
+# (document number, term frequency, document length) entries, sorted by
+# number and stored as varints, with each number as the gap from the
+# one before. That takes a few bytes per posting. Posting lists are
+# split into partitions of PART_SIZE document numbers, and each
+# partition into TERM_SHARDS shards by document number, each in its own
+# SearchTerm entity. So no entity outgrows the datastore's limits, an
+# update only rewrites one shard per term, and the documents indexed
+# one after another write to different shards of a common term.
+# Postings indexed before partitions were sharded stay in shard 0, and
+# move to their own shards as they change.
+#
+# Results are ranked with BM25. A search reads one batch of terms, one
+# batch of their further shards, and one batch of the documents shown,
+# whatever the size of the blog. It decodes at most MAX_SCORED_POSTINGS
+# postings, rarest terms and newest documents first.
+#
+# The handlers that change posts and comments queue index updates with
+# defer, and the reindex admin job rebuilds the index for every post.
+import heapq
+import json
+import math
+import random
+import re
+
+from storage import db
+
+from models.post import BlogPost
+from models.comment import Comment
+from models.counter import CounterShard, NUM_SHARDS
+from models.txn import run_in_txn
+
+# BM25 parameters: term frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Subject terms count this many times over content terms
+SUBJECT_WEIGHT = 3
+# Number of document numbers covered by each posting list partition
+PART_BITS = 16
+PART_SIZE = 1 << PART_BITS
+# Number of shards each partition is split into. Document num goes in
+# shard num % TERM_SHARDS.
+TERM_SHARDS = 8
+# Number of terms whose postings are updated in one transaction. Each
+# term may touch three entity groups, its shard, shard 0 of the same
+# partition and its first shard, and a transaction may touch 25.
+TERMS_PER_TXN = 8
+# Limits on queries, documents and result pages
+MAX_QUERY_TERMS = 8
+MAX_TERM_LENGTH = 40
+MAX_DOC_TERMS = 20000
+MAX_RESULTS = 1000
+SNIPPET_LENGTH = 200
+# Most postings decoded and scored per search. Once a search has scored
+# this many, it skips the remaining shards of its commoner terms, which
+# add little to the ranking.
+MAX_SCORED_POSTINGS = 20000
+
+# Names of the counters of indexed documents and their total length
+DOCS_COUNTER = 'search:docs'
+LENGTH_COUNTER = 'search:length'
+
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have he her his i if in into
+is it its me my no not of on or our she so that the their them then
+there these they this to was we were what when which who will with you
+your
+""".split())
+
+_WORD_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def tokenize(text):
+    """ Returns the list of index terms in text: lower case words,
+    leaving out stopwords and very long words
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return [word for word in _WORD_RE.findall(text.lower())
+            if word not in STOPWORDS and len(word) <= MAX_TERM_LENGTH]
+
+def count_terms(subject, text):
+    """ Returns a tuple (term frequencies, length) of a document """
+    freqs = {}
+    terms = tokenize(text)[:MAX_DOC_TERMS]
+    for term in terms:
+        freqs[term] = freqs.get(term, 0) + 1
+    subject_terms = tokenize(subject or '')
+    for term in subject_terms:
+        freqs[term] = freqs.get(term, 0) + SUBJECT_WEIGHT
+    return freqs, len(terms) + SUBJECT_WEIGHT * len(subject_terms)
+
+
+# Posting lists
+
+def _put_varint(out, value):
+    """ Appends value to the bytearray out as a varint """
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def encode_postings(postings):
+    """ Encodes a list of (number, frequency, length) postings, sorted
+    by number, as a byte string
+    """
+    out = bytearray()
+    last = 0
+    for num, freq, length in postings:
+        _put_varint(out, num - last)
+        _put_varint(out, freq)
+        _put_varint(out, length)
+        last = num
+    return str(out)
+
+def decode_postings(data):
+    """ Returns the list of (number, frequency, length) postings encoded
+    in the byte string data
+    """
+    data = bytearray(data or '')
+    postings = []
+    values = []
+    value = shift = 0
+    num = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value)
+        value = shift = 0
+        if len(values) == 3:
+            num += values[0]
+            postings.append((num, values[1], values[2]))
+            values = []
+    return postings
+
+
+class SearchTerm(db.Model):
+    """ SearchTerm class for one shard of a partition of the posting
+    list of a term. The key name is the term for shard 0 of partition
+    0, '<term> <part>' for shard 0 of the others, and
+    '<term> <part>.<shard>' for the other shards.
+
+    Attributes:
+        postings - encoded postings (bytes, see encode_postings)
+        count - number of postings in this shard (int)
+        last - highest document number in this shard (int)
+        parts - the term's other partitions' shard 0, kept on the first
+            shard only (list of ints)
+        shards - the term's other shards, as '<part>.<shard>', kept on
+            the first shard only (list of strings)
+    """
+    postings = db.BlobProperty()
+    count = db.IntegerProperty(default = 0, indexed = False)
+    last = db.IntegerProperty(indexed = False)
+    parts = db.ListProperty(int, indexed = False)
+    shards = db.ListProperty(str, indexed = False)
+
+    @classmethod
+    def term_key(cls, term, part=0, shard=0):
+        """ Returns the key of this shard of a term's postings """
+        if shard:
+            name = u'%s %d.%d' % (term, part, shard)
+        else:
+            name = part and u'%s %d' % (term, part) or term
+        return db.Key.from_path(cls.kind(), name)
+
+    def other_shards(self):
+        """ Returns the (part, shard) tuples of the term's other shards.
+        This is called on the first shard.
+        """
+        return ([(part, 0) for part in self.parts] +
+                [tuple(int(n) for n in name.split('.'))
+                 for name in self.shards])
+
+    def listing(self, part, shard):
+        """ Returns a tuple (list, entry) of the list of the first shard
+        that holds this shard, and its entry in it
+        """
+        if shard:
+            return self.shards, '%d.%d' % (part, shard)
+        return self.parts, part
+
+
+class SearchDoc(db.Model):
+    """ SearchDoc class for an indexed post or comment, keyed by its
+    document number. It holds what a result shows and the terms it was
+    indexed under, so it can be unindexed.
+
+    Attributes:
+        name - document name, 'p:<blog_id>' or 'c:<blog_id>:<cid>'
+            (string, required)
+        blog_id - id of the post, or of the commented post (int)
+        cid - comment id, for comments (int)
+        title - subject of the post (string)
+        snippet - start of the text (text block)
+        length - number of terms, counting subject terms SUBJECT_WEIGHT
+            times (int)
+        freqs - JSON object of term to frequency (text block)
+    """
+    name = db.StringProperty(required = True, indexed = False)
+    blog_id = db.IntegerProperty()
+    cid = db.IntegerProperty(indexed = False)
+    title = db.StringProperty(indexed = False)
+    snippet = db.TextProperty()
+    length = db.IntegerProperty(default = 0, indexed = False)
+    freqs = db.TextProperty()
+
+    def get_id(self):
+        """ Returns the document number """
+        return self.key().id()
+
+    def term_freqs(self):
+        """ Returns the dict of term to frequency """
+        return self.freqs and json.loads(self.freqs) or {}
+
+    def is_comment(self):
+        """ Returns True if the document is a comment """
+        return self.cid is not None
+
+
+class SearchName(db.Model):
+    """ SearchName class for looking up a document's number by its name,
+    which is the key name
+
+    Attributes:
+        num - document number (int, required)
+    """
+    num = db.IntegerProperty(required = True, indexed = False)
+
+
+# Index updates
+
+def _set_posting(entity, num, posting):
+    """ Sets or, if posting is None, removes the posting of document num
+    in this shard. Returns False if there was nothing to remove.
+    """
+    last = entity.last
+    if posting and entity.postings and last and num > last:
+        # New documents get the highest numbers, so their postings can
+        # be added at the end without decoding the others
+        entity.postings += encode_postings([(num - last,) + posting[1:]])
+        entity.count += 1
+        entity.last = num
+        return True
+    postings = [p for p in decode_postings(entity.postings) if p[0] != num]
+    if posting is None and len(postings) == entity.count:
+        return False
+    if posting:
+        postings.append(posting)
+        postings.sort()
+    entity.postings = encode_postings(postings)
+    entity.count = len(postings)
+    entity.last = postings and postings[-1][0] or None
+    return True
+
+def _update_partition(term, part, num, posting):
+    """ Sets or, if posting is None, removes the posting of document num
+    in its shard of this partition of the term. This should be called
+    inside a transaction.
+    """
+    shard = num % TERM_SHARDS
+    changes = [((part, shard), posting)]
+    if shard:
+        # Indexes built before partitions were sharded hold all of a
+        # partition's postings in shard 0
+        changes.append(((part, 0), None))
+    # The first shard lists the others, so it is read with them
+    slots = [slot for slot, value in changes]
+    if (0, 0) not in slots:
+        slots.append((0, 0))
+    entities = dict(zip(slots, db.get([SearchTerm.term_key(term, *slot)
+                                       for slot in slots])))
+    base = entities[(0, 0)]
+    if base is None:
+        base = entities[(0, 0)] = SearchTerm(key=SearchTerm.term_key(term))
+    changed = set()
+    for slot, value in changes:
+        entity = entities[slot]
+        if entity is None:
+            if value is None:
+                continue
+            entity = entities[slot] = SearchTerm(
+                key=SearchTerm.term_key(term, *slot))
+        if not _set_posting(entity, num, value):
+            continue
+        changed.add(slot)
+        if slot != (0, 0):
+            listed, entry = base.listing(*slot)
+            if entity.count and entry not in listed:
+                listed.append(entry)
+                changed.add((0, 0))
+            elif not entity.count and entry in listed:
+                listed.remove(entry)
+                changed.add((0, 0))
+    puts, deletes = [], []
+    for slot in changed:
+        entity = entities[slot]
+        if entity.count or entity.parts or entity.shards:
+            puts.append(entity)
+        elif entity.is_saved():
+            deletes.append(entity)
+    if puts:
+        db.put(puts)
+    if deletes:
+        db.delete(deletes)
+
+def _update_postings(num, changes):
+    """ Applies a dict of term to posting (or None, to remove it) for
+    document num, a few terms per transaction
+    """
+    part = num >> PART_BITS
+    terms = sorted(changes)
+    for start in range(0, len(terms), TERMS_PER_TXN):
+        chunk = terms[start:start + TERMS_PER_TXN]
+
+        def txn():
+            for term in chunk:
+                _update_partition(term, part, num, changes[term])
+        run_in_txn(txn)
+
+def _count_docs(docs, length):
+    """ Adds to the counters of documents and their total length. This
+    should be called inside a transaction.
+    """
+    index = random.randrange(NUM_SHARDS)
+    if docs:
+        CounterShard.add_to_shard(DOCS_COUNTER, index, docs)
+    if length:
+        CounterShard.add_to_shard(LENGTH_COUNTER, index, length)
+
+def index_doc(name, blog_id, cid, title, text):
+    """ Indexes or reindexes a document, updating only the postings that
+    changed
+    """
+    freqs, length = count_terms(title if cid is None else None, text)
+    found = db.get(db.Key.from_path(SearchName.kind(), name))
+    old = found and SearchDoc.get_by_id(found.num)
+    if old:
+        num = old.get_id()
+        old_freqs, old_length = old.term_freqs(), old.length
+    else:
+        num = found and found.num or db.allocate_ids(
+            db.Key.from_path(SearchDoc.kind(), 1), 1)[0]
+        old_freqs, old_length = {}, 0
+    changes = {}
+    for term in set(old_freqs) | set(freqs):
+        if term not in freqs:
+            changes[term] = None
+        elif length != old_length or freqs[term] != old_freqs.get(term):
+            changes[term] = (num, freqs[term], length)
+    _update_postings(num, changes)
+    doc = SearchDoc(key=db.Key.from_path(SearchDoc.kind(), num), name=name,
+                    blog_id=int(blog_id), cid=cid, title=title,
+                    snippet=text[:SNIPPET_LENGTH], length=length,
+                    freqs=json.dumps(freqs))
+
+    def txn():
+        db.put([doc, SearchName(key_name=name, num=num)])
+        _count_docs(old is None and 1 or 0, length - old_length)
+    run_in_txn(txn)
+
+def unindex_doc(name):
+    """ Removes a document from the index, if it is in it """
+    found = db.get(db.Key.from_path(SearchName.kind(), name))
+    if not found:
+        return
+    doc = SearchDoc.get_by_id(found.num)
+    if doc:
+        _update_postings(found.num, dict((term, None)
+                                         for term in doc.term_freqs()))
+
+    def txn():
+        db.delete([found.key(), db.Key.from_path(SearchDoc.kind(),
+                                                  found.num)])
+        if doc:
+            _count_docs(-1, -doc.length)
+    run_in_txn(txn)
+
+def post_doc_name(blog_id):
+    """ Returns the document name of a post """
+    return 'p:%d' % int(blog_id)
+
+def comment_doc_name(blog_id, cid):
+    """ Returns the document name of a comment """
+    return 'c:%d:%d' % (int(blog_id), int(cid))
+
+def index_post(blog_id):
+    """ Indexes the post with this id, or unindexes it if it is gone """
+    post = BlogPost.get_by_id(int(blog_id))
+    if post is None:
+        unindex_doc(post_doc_name(blog_id))
+        return
+    index_doc(post_doc_name(blog_id), blog_id, None, post.subject,
+              post.content)
+
+def index_comment(blog_id, cid):
+    """ Indexes comment cid on the post with this id, or unindexes it if
+    it is gone
+    """
+    post = BlogPost.get_by_id(int(blog_id))
+    cmt = post and db.get(Comment.comment_key(post, cid))
+    if cmt is None:
+        unindex_doc(comment_doc_name(blog_id, cid))
+        return
+    index_doc(comment_doc_name(blog_id, cid), blog_id, int(cid),
+              post.subject, cmt.text)
+
+def unindex_comment(blog_id, cid):
+    """ Removes comment cid on the post with this id from the index """
+    unindex_doc(comment_doc_name(blog_id, cid))
+
+def unindex_post(blog_id):
+    """ Removes the post with this id and all its comments from the
+    index
+    """
+    query = SearchDoc.all().filter('blog_id =', int(blog_id))
+    for doc in query.run(batch_size=100):
+        unindex_doc(doc.name)
+    unindex_doc(post_doc_name(blog_id))
+
+def reindex_posts(cursor=None, batch_size=5):
+    """ Indexes a batch of posts and their comments, starting from
+    cursor. Returns a tuple (indexed, next_cursor), where next_cursor is
+    None once every post has been processed.
+    """
+    query = BlogPost.all()
+    if cursor:
+        query.with_cursor(cursor)
+    posts = query.fetch(batch_size)
+    for post in posts:
+        blog_id = post.get_id()
+        index_doc(post_doc_name(blog_id), blog_id, None, post.subject,
+                  post.content)
+        comments, stale_ids = Comment.load_comments(post.comments)
+        for cmt in comments + Comment.post_comments(blog_id):
+            index_doc(comment_doc_name(blog_id, cmt.get_id()), blog_id,
+                      cmt.get_id(), post.subject, cmt.text)
+    next_cursor = len(posts) == batch_size and query.cursor() or None
+    return len(posts), next_cursor
+
+
+# Searching
+
+def search(text, offset=0, limit=10):
+    """ Returns a tuple (documents, has_more) of the limit best matches
+    for the terms of text after skipping offset, best first
+    """
+    terms = []
+    for term in tokenize(text):
+        if term not in terms:
+            terms.append(term)
+    terms = terms[:MAX_QUERY_TERMS]
+    if not terms or offset >= MAX_RESULTS:
+        return [], False
+    # The corpus statistics are read while the postings are
+    stats = db.get_async(CounterShard.shard_keys(DOCS_COUNTER) +
+                         CounterShard.shard_keys(LENGTH_COUNTER))
+    bases = db.get([SearchTerm.term_key(term) for term in terms])
+    extra = []
+    for term, base in zip(terms, bases):
+        if base:
+            extra.extend((term, part, shard)
+                         for part, shard in base.other_shards())
+    shards = extra and db.get([SearchTerm.term_key(term, part, shard)
+                               for term, part, shard in extra]) or []
+    by_term = dict((term, [base]) for term, base in zip(terms, bases)
+                   if base)
+    for (term, part, shard), entity in zip(extra, shards):
+        if entity:
+            by_term[term].append(entity)
+
+    totals = CounterShard.add_shards({}, stats.get_result())
+    doc_count = max(totals.get(DOCS_COUNTER, (0, None))[0], 1)
+    total_length = totals.get(LENGTH_COUNTER, (0, None))[0]
+    avg_length = max(float(total_length) / doc_count, 1.0)
+
+    # Score the rarest terms first, each from its newest documents, so
+    # the postings skipped once the budget is spent matter least
+    ranked = sorted((sum(entity.count for entity in entities), term)
+                    for term, entities in by_term.items())
+    budget = MAX_SCORED_POSTINGS
+    scores = {}
+    for df, term in ranked:
+        if not df:
+            continue
+        idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+        entities = sorted(by_term[term], reverse=True,
+                          key=lambda entity: entity.last or 0)
+        for entity in entities:
+            if budget <= 0:
+                break
+            budget -= entity.count
+            for num, freq, length in decode_postings(entity.postings):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                scores[num] = scores.get(num, 0.0) + (
+                    idf * freq * (BM25_K1 + 1) / (freq + norm))
+    best = heapq.nlargest(offset + limit + 1, scores.items(),
+                          key=lambda item: (item[1], -item[0]))
+    page = best[offset:offset + limit]
+    docs = db.get([db.Key.from_path(SearchDoc.kind(), num)
+                   for num, score in page])
+    return [doc for doc in docs if doc], len(best) > offset + limit
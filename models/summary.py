@@ -0,0 +1,271 @@
+# Create our post summary database
+import time
+
+import cache
+from storage import db, defer
+
+from models.user import User
+from models.authorstats import AuthorStats
+from models.like import Like
+from models.commentcount import CommentCount
+from models.paging import fetch_page, DEFAULT_PAGE_SIZE
+from models.txn import run_in_txn
+
+# Number of characters of a post's content kept for list pages
+EXCERPT_LENGTH = 300
+
+# Key name of the summary under each post
+KEY_NAME = 'summary'
+
+# Seconds a like waits for the task that updates its post's summary, so
+# the likes that arrive meanwhile share one task
+LIKES_UPDATE_DELAY = 5
+# Seconds a queued summary update is remembered, in case its task is
+# lost
+LIKES_UPDATE_TTL = 60
+# Seconds between checks of whether every post has a summary
+STATE_CHECK_INTERVAL = 60
+
+# Whether every post is known to have a summary, and when that was last
+# checked
+_summaries_complete = False
+_summaries_checked = 0
+
+
+def make_excerpt(content, length=EXCERPT_LENGTH):
+    """ Returns a tuple (excerpt, truncated) of the start of content,
+    cut at a word break where there is one
+    """
+    if len(content) <= length:
+        return content, False
+    excerpt = content[:length]
+    space = excerpt.rfind(' ')
+    if space > length / 2:
+        excerpt = excerpt[:space]
+    return excerpt.rstrip(), True
+
+def _likes_update_key(blog_id):
+    """ Returns the shared cache key marking that an update of this
+    post's like count is queued
+    """
+    return 'summary:likes:%d' % int(blog_id)
+
+
+class SummaryIndex(db.Model):
+    """ SummaryIndex class for recording that every post has a summary,
+    so list pages can be read from the summaries alone. There is a
+    single record, with the key name 'state', written by
+    backfill_summaries.
+
+    Attributes:
+        complete - True once every post has a summary (boolean)
+    """
+    complete = db.BooleanProperty(default = False, indexed = False)
+
+    @classmethod
+    def is_complete(cls):
+        """ Returns True if every post has a summary. Once it has, that
+        is remembered for the life of the instance.
+        """
+        global _summaries_complete, _summaries_checked
+        if not _summaries_complete and (time.time() - _summaries_checked >
+                                        STATE_CHECK_INTERVAL):
+            state = cls.get_by_key_name('state')
+            _summaries_complete = bool(state and state.complete)
+            _summaries_checked = time.time()
+        return _summaries_complete
+
+    @classmethod
+    def mark_complete(cls):
+        """ Records that every post has a summary """
+        cls(key_name='state', complete=True).put()
+
+
+class PostSummary(db.Model):
+    """ PostSummary class for the parts of a blog post shown on list
+    pages, so they never load post bodies. It is stored as a child of
+    the post, in the same transactions as the post and its comments,
+    and its like count is refreshed by a task shortly after likes are
+    stored. The author's
+    AuthorStats is kept as the sum of their summaries.
+
+    Attributes:
+        author - post author (reference to User object)
+        author_name - the author's username (string)
+        subject - blog subject line (string, required)
+        excerpt - start of the blog content (text block)
+        truncated - True if the content is longer than the excerpt
+            (boolean)
+        created - date the post was created (date/time, required)
+        like_count - number of likes on the post (int)
+        comment_count - number of comments on the post (int)
+        updated - date the summary last changed (date/time,
+            automatically generated)
+    """
+    author = db.ReferenceProperty(User)
+    author_name = db.StringProperty(indexed = False)
+    subject = db.StringProperty(required = True, indexed = False)
+    excerpt = db.TextProperty()
+    truncated = db.BooleanProperty(default = False, indexed = False)
+    created = db.DateTimeProperty(required = True)
+    like_count = db.IntegerProperty(default = 0, indexed = False)
+    comment_count = db.IntegerProperty(default = 0, indexed = False)
+    updated = db.DateTimeProperty(auto_now = True)
+
+    @classmethod
+    def summary_key(cls, post_key):
+        """ Returns the key of the summary of this post """
+        return db.Key.from_path(cls.kind(), KEY_NAME, parent=post_key)
+
+    @classmethod
+    def build(cls, post, author_name, like_count=0, comment_count=0):
+        """ Returns a new summary of post. You still need to put() it. """
+        summary = cls(key_name=KEY_NAME, parent=post.key(),
+                      author=type(post).author.get_value_for_datastore(post),
+                      author_name=author_name, subject=post.subject,
+                      created=post.created, like_count=like_count,
+                      comment_count=comment_count)
+        summary.set_content(post.content)
+        return summary
+
+    @classmethod
+    def build_missing(cls, post, like_count):
+        """ Returns a new summary of a post saved before summaries were
+        kept, counting its comments. This should be called inside a
+        transaction, so the comment count is consistent.
+        """
+        counter = db.get(CommentCount.count_key(post.key()))
+        comment_count = len(post.comments) + (counter and counter.count or 0)
+        return cls.build(post, post.author and post.author.name,
+                         like_count, comment_count)
+
+    @classmethod
+    def refresh(cls, post):
+        """ Updates the summary of post after it changed, creating it if
+        it is missing. This should be called inside a transaction.
+        """
+        summary = db.get(cls.summary_key(post.key()))
+        if summary is None:
+            summary = cls.build_missing(post, post.like_count())
+            summary.count_author()
+        summary.subject = post.subject
+        summary.set_content(post.content)
+        summary.put()
+
+    @classmethod
+    def add_comments(cls, post_key, delta):
+        """ Adds delta to the comment count of this post's summary, if
+        it has one. This should be called inside a transaction.
+        """
+        summary = db.get(cls.summary_key(post_key))
+        if summary and delta:
+            summary.comment_count += delta
+            summary.put()
+            AuthorStats.add(summary.author_key(), comments=delta)
+
+    @classmethod
+    def queue_update_likes(cls, blog_id):
+        """ Queues update_likes for this post, to run in a few seconds,
+        unless one is already queued, which will count these likes too.
+        Call it once new likes are stored. A busy post's likes then cost
+        one summary update every few seconds, instead of one each.
+        """
+        key = _likes_update_key(blog_id)
+        if not cache.get_backend().add(key, 1, time=LIKES_UPDATE_TTL):
+            return
+        try:
+            defer(cls.update_likes, blog_id, _countdown=LIKES_UPDATE_DELAY)
+        except Exception:
+            cache.get_backend().delete(key)
+            raise
+
+    @classmethod
+    def update_likes(cls, blog_id):
+        """ Sets the like count of this post's summary from its like
+        counter. Run as a task queued by queue_update_likes. Likes are
+        never taken back, so an update that read the counter before
+        another one did leaves the larger count in place.
+        """
+        # Likes stored from now on may not be counted, so they must
+        # queue another update
+        cache.get_backend().delete(_likes_update_key(blog_id))
+        like_count = Like.get_counts([blog_id])[blog_id]
+        post_key = db.Key.from_path('BlogPost', int(blog_id))
+
+        def txn():
+            summary = db.get(cls.summary_key(post_key))
+            if summary is None:
+                return False
+            legacy = db.get(post_key)
+            total = like_count + (legacy and len(legacy.likes) or 0)
+            if total <= summary.like_count:
+                return False
+            AuthorStats.add(summary.author_key(),
+                            likes=total - summary.like_count)
+            summary.like_count = total
+            summary.put()
+            return True
+        if run_in_txn(txn):
+            cache.bump_front_page()
+
+    @classmethod
+    def delete_summary(cls, post_key):
+        """ Deletes the summary of this post, taking it off its author's
+        totals. This should be called inside a transaction.
+        """
+        summary = db.get(cls.summary_key(post_key))
+        if summary:
+            summary.count_author(-1)
+            summary.delete()
+
+    @classmethod
+    def recent_page(cls, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+        """ Returns one page of the summaries of the most recent posts as
+        a tuple (entries, next_cursor, prev_cursor). Until every post has
+        a summary, the page is read from the posts instead.
+        """
+        if not SummaryIndex.is_complete():
+            # Imported here, as models.post imports this module
+            from models.post import summary_page
+            return summary_page(None, cursor, page_size)
+        return fetch_page(cls.all(), cursor, page_size)
+
+    @classmethod
+    def author_page(cls, author, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+        """ Returns one page of the summaries of this author's posts,
+        most recent first, as a tuple (entries, next_cursor, prev_cursor).
+        Until every post has a summary, the page is read from the posts
+        instead.
+        """
+        if not SummaryIndex.is_complete():
+            from models.post import summary_page
+            return summary_page(author, cursor, page_size)
+        query = cls.all().filter('author =', author)
+        return fetch_page(query, cursor, page_size)
+
+    def set_content(self, content):
+        """ Sets the excerpt from the post's content """
+        self.excerpt, self.truncated = make_excerpt(content)
+
+    def author_key(self):
+        """ Returns the key of the post's author, without looking it up """
+        return PostSummary.author.get_value_for_datastore(self)
+
+    def count_author(self, sign=1):
+        """ Adds this summary's post, likes and comments to its author's
+        totals, or takes them off with sign=-1. This should be called
+        inside a transaction.
+        """
+        AuthorStats.add(self.author_key(), sign, sign * self.like_count,
+                        sign * self.comment_count)
+
+    def get_id(self):
+        """ Returns the blog id of the summarized post """
+        return self.key().parent().id()
+
+    def version(self):
+        """ Returns a tuple that changes whenever the summary does, for
+        building page ETags
+        """
+        return (self.get_id(), self.updated, self.like_count,
+                self.comment_count)
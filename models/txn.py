@@ -0,0 +1,54 @@
+# Helper functions for running datastore transactions
+import logging
+import random
+import threading
+import time
+
+from storage import db
+
+# Number of times a transaction is attempted before giving up
+MAX_ATTEMPTS = 5
+# Base delay in seconds before retrying a transaction. It doubles on
+# every retry and is randomized to spread out competing writers.
+RETRY_DELAY = 0.01
+
+# Transaction outcome counters, for monitoring contention:
+#   committed - transactions that succeeded
+#   conflicts - attempts that collided with another write
+#   failed - transactions that gave up after MAX_ATTEMPTS
+stats = {'committed': 0, 'conflicts': 0, 'failed': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    """ Increments one of the transaction stats counters """
+    with _stats_lock:
+        stats[name] += 1
+
+def get_stats():
+    """ Returns a copy of the transaction stats counters """
+    with _stats_lock:
+        return dict(stats)
+
+def run_in_txn(function, *args, **kwargs):
+    """ Runs function(*args, **kwargs) in a cross-group transaction and
+    returns its result. The transaction is retried with backoff up to
+    MAX_ATTEMPTS times if it collides with another write, after which
+    db.TransactionFailedError is raised.
+    """
+    options = db.create_transaction_options(xg=True, retries=0)
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(random.uniform(0.5, 1.5) * RETRY_DELAY * 2 ** attempt)
+        try:
+            result = db.run_in_transaction_options(options, function,
+                                                   *args, **kwargs)
+        except db.TransactionFailedError:
+            _count('conflicts')
+        else:
+            _count('committed')
+            return result
+    _count('failed')
+    logging.warning('Transaction %s failed after %d attempts',
+                    getattr(function, '__name__', function), MAX_ATTEMPTS)
+    raise db.TransactionFailedError('Too much contention, please retry')
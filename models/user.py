@@ -1,5 +1,98 @@
 # Create our User registry database
-from google.appengine.ext import db
+import time
+
+from storage import db
+
+import cache
+from models.txn import run_in_txn
+
+# Seconds a looked up user stays in the in-process user cache
+USER_CACHE_TTL = 60
+# Seconds an unknown username is remembered in the shared cache, to
+# absorb repeated failed logins
+UNKNOWN_NAME_TTL = 60
+# Seconds between checks of whether the username index is complete
+INDEX_CHECK_INTERVAL = 60
+
+_user_cache = cache.LRUCache(max_items=1000)
+
+# Whether the username index is known to be complete, and when that was
+# last checked
+_index_complete = False
+_index_checked = 0
+
+
+class Username(db.Model):
+    """ Username class for claiming unique usernames. The key name is
+    the normalized username, so looking up a name is a strongly
+    consistent key get, and claiming one is a transactional check.
+
+    Attributes:
+        user_id - id of the User holding this name (int, required)
+    """
+    user_id = db.IntegerProperty(required = True, indexed = False)
+
+    @staticmethod
+    def normalize(name):
+        """ Returns the normalized form of a username. Names that only
+        differ in case are treated as the same name.
+        """
+        return name.lower()
+
+    @classmethod
+    def lookup(cls, name):
+        """ Returns the id of the user holding this name, or None """
+        entry = cls.get_by_key_name(cls.normalize(name))
+        return entry and entry.user_id
+
+    @classmethod
+    def claim(cls, name, uid):
+        """ Claims this name for the user with this id. This should be
+        called inside a transaction. Returns False if another user
+        already holds the name.
+        """
+        key_name = cls.normalize(name)
+        entry = cls.get_by_key_name(key_name)
+        if entry:
+            return entry.user_id == int(uid)
+        cls(key_name=key_name, user_id=int(uid)).put()
+        return True
+
+
+class UsernameIndex(db.Model):
+    """ UsernameIndex class for recording that every user has been added
+    to the Username index, so a name missing from it is unknown. There
+    is a single record, with the key name 'state', written by
+    backfill_usernames.
+
+    Attributes:
+        complete - True once every user has been indexed (boolean)
+    """
+    complete = db.BooleanProperty(default = False, indexed = False)
+
+    @classmethod
+    def is_complete(cls):
+        """ Returns True if every user is in the Username index. Once it
+        is, that is remembered for the life of the instance.
+        """
+        global _index_complete, _index_checked
+        if not _index_complete and (time.time() - _index_checked >
+                                    INDEX_CHECK_INTERVAL):
+            state = cls.get_by_key_name('state')
+            _index_complete = bool(state and state.complete)
+            _index_checked = time.time()
+        return _index_complete
+
+    @classmethod
+    def mark_complete(cls):
+        """ Records that every user is in the Username index """
+        cls(key_name='state', complete=True).put()
+
+
+def _unknown_name_key(name):
+    """ Returns the shared cache key marking this username as unknown """
+    return 'user:unknown:%s' % Username.normalize(name).encode('utf-8')
+
 
 class User(db.Model):
     """ User class for our blog registry database
@@ -13,9 +106,98 @@ class User(db.Model):
     hashed_pw = db.StringProperty(required = True)
     email = db.StringProperty()
 
+    def put(self, **kwargs):
+        """ Stores the user and drops any cached copy of it """
+        key = db.Model.put(self, **kwargs)
+        User.invalidate(key.id())
+        return key
+
+    @classmethod
+    def by_id(cls, uid):
+        """ Looks up a user by id. Users are kept in a short-lived
+        in-process cache, so the returned object must not be changed
+        without a put().
+        """
+        cache_key = 'user:%d' % int(uid)
+        user = _user_cache.get(cache_key)
+        if user is None:
+            user = cls.get_by_id(int(uid))
+            if user:
+                _user_cache.set(cache_key, user, time=USER_CACHE_TTL)
+        return user
+
+    @classmethod
+    def invalidate(cls, uid):
+        """ Drops this user from the in-process user cache """
+        _user_cache.delete('user:%d' % int(uid))
+
     @classmethod
     def by_name(cls, name):
-        """ Searches the User database for a given username and
-        returns the first matching entry
+        """ Looks up a user by username through the Username index and
+        returns the matching entry, or None. Until every user has been
+        indexed (see backfill_usernames), users that aren't in the index
+        are found by query and added to it.
+        """
+        client = cache.get_backend()
+        if not name or client.get(_unknown_name_key(name)):
+            return None
+        uid = Username.lookup(name)
+        user = uid and cls.by_id(uid)
+        if (user and user.name != name) or (
+                not user and not UsernameIndex.is_complete()):
+            # Not indexed yet, or the index holds a name differing in
+            # case only, so fall back to searching the User database
+            user = cls.all().filter('name =', name).get()
+            if user:
+                run_in_txn(Username.claim, name, user.key().id())
+        if not user and not uid:
+            # No user holds the name in any case
+            client.set(_unknown_name_key(name), True, time=UNKNOWN_NAME_TTL)
+        return user
+
+    @classmethod
+    def register(cls, name, hashed_pw, email=None):
+        """ Creates and stores a new user, claiming the username in the
+        same transaction so two users can't register the same name.
+        Returns the new User, or None if the name is already taken.
         """
-        return cls.all().filter('name =', name).get()
+        start, end = db.allocate_ids(db.Key.from_path(cls.kind(), 1), 1)
+        key = db.Key.from_path(cls.kind(), start)
+
+        def txn():
+            if not Username.claim(name, start):
+                return None
+            user = cls(key=key, name=name, hashed_pw=hashed_pw,
+                       email=email)
+            user.put()
+            return user
+        user = run_in_txn(txn)
+        if user:
+            # The cache is shared, so this reaches every instance
+            cache.get_backend().delete(_unknown_name_key(name))
+        return user
+
+
+def backfill_usernames(cursor=None, batch_size=100):
+    """ Adds a batch of existing users to the Username index, starting
+    from cursor. Returns a tuple (claimed, conflicts, next_cursor), where
+    conflicts lists the names already held by another user and
+    next_cursor is None once every user has been processed. Then the
+    index is marked complete, and unknown names are no longer searched
+    for.
+    """
+    query = User.all()
+    if cursor:
+        query.with_cursor(cursor)
+    users = query.fetch(batch_size)
+    claimed = 0
+    conflicts = []
+    for user in users:
+        if run_in_txn(Username.claim, user.name, user.key().id()):
+            claimed += 1
+        else:
+            conflicts.append(user.name)
+    next_cursor = len(users) == batch_size and query.cursor() or None
+    if next_cursor is None:
+        UsernameIndex.mark_complete()
+    return claimed, conflicts, next_cursor
@@ -0,0 +1,24 @@
+// Loads further pages of comments on the permalink page in place,
+// replacing the "More comments" link with the next page.
+document.addEventListener('click', function(event) {
+    var link = event.target;
+    var nav = link.parentNode;
+    if (!nav || nav.className !== 'more-comments') {
+        return;
+    }
+    event.preventDefault();
+    var request = new XMLHttpRequest();
+    request.open('GET', link.href);
+    request.onload = function() {
+        if (request.status !== 200) {
+            return;
+        }
+        var page = document.createElement('div');
+        page.innerHTML = request.responseText;
+        while (page.firstChild) {
+            nav.parentNode.insertBefore(page.firstChild, nav);
+        }
+        nav.parentNode.removeChild(nav);
+    };
+    request.send();
+});
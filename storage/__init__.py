@@ -0,0 +1,58 @@
+# Storage backend for our blog.
+#
+# Models and handlers import db (and defer, for background tasks) from
+# this package rather than from the App Engine SDK, so the backend can
+# be switched in one place:
+#   - By default, db is App Engine's datastore API and defer queues
+#     tasks with the deferred library.
+#   - When the BLOG_STORAGE environment variable is "local", db is the
+#     SQLite engine in storage/local.py, which has the same interface,
+#     and tasks run in-process. BLOG_STORAGE_PATH names the database
+#     file (in memory by default).
+#
+# add_hook(hook) registers hook(op, count, elapsed) to be called after
+# every storage operation, with either backend.
+#
+# Reads can be started before their results are needed: db.get_async()
+# returns an object whose get_result() waits for the entities, and
+# Query.run() starts fetching straight away. Pending wraps such calls
+# with the work that turns their results into what the caller wants.
+import os
+
+if os.environ.get('BLOG_STORAGE') == 'local':
+    from storage import local as db
+    defer = db.defer
+
+    def add_hook(hook):
+        """ Registers a hook to be called after every storage call """
+        db.hooks.append(hook)
+else:
+    from google.appengine.ext import db
+
+    def defer(obj, *args, **kwargs):
+        """ Queues a deferred task. The deferred library is only
+        imported by requests that queue one.
+        """
+        from google.appengine.ext import deferred
+        return deferred.defer(obj, *args, **kwargs)
+
+    def add_hook(hook):
+        """ Registers a hook to be called after every datastore RPC """
+        from storage import rpc_hooks
+        rpc_hooks.add_hook(hook)
+
+
+class Pending(object):
+    """ Result of storage calls that have been started but not waited
+    for. The first get_result() calls wait() to finish them, and the
+    result is kept for later calls.
+    """
+    def __init__(self, wait):
+        self._wait = wait
+        self._result = None
+
+    def get_result(self):
+        if self._wait:
+            self._result = self._wait()
+            self._wait = None
+        return self._result
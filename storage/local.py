@@ -0,0 +1,1102 @@
+# Local storage engine for our blog.
+#
+# This module has the same interface as the parts of App Engine's db
+# module that the blog uses (models, properties, keys, batch get/put/
+# delete, queries, cursors and transactions), so the app can run and be
+# benchmarked on a plain machine. Entities are stored in SQLite, in
+# memory by default. Every indexed property value is also written to an
+# index table, so queries filter and sort in SQL much like the datastore
+# serves queries from its indexes.
+#
+# Differences from the datastore worth knowing about:
+#   - Transactions are serialized by a lock, so they never collide and
+#     TransactionFailedError is never raised. Like the datastore's, they
+#     may touch at most MAX_TXN_GROUPS entity groups.
+#   - Query cursors hold the sort values and key of the last result, as
+#     the datastore's do, so a query continued from a cursor neither
+#     skips nor repeats results when earlier ones have been deleted.
+#   - Queries are strongly consistent.
+#   - get_async() and Query.run() do their reads on a small pool of
+#     worker threads, so they overlap with the caller's other work.
+#     SQLite reads still take the engine lock one at a time.
+import atexit
+import base64
+import datetime
+import json
+import os
+import pickle
+import Queue
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Error(Exception):
+    """ Base class for storage errors """
+
+class BadValueError(Error):
+    """ Raised when a property is given an invalid value """
+
+class BadArgumentError(Error):
+    """ Raised when a query or key is given invalid arguments """
+
+class NotSavedError(Error):
+    """ Raised when the key of an unsaved entity is requested """
+
+class KindError(Error):
+    """ Raised when an entity kind has no model class """
+
+class ReferencePropertyResolveError(Error):
+    """ Raised when a reference points to a missing entity """
+
+class TransactionFailedError(Error):
+    """ Raised when a transaction can't be committed """
+
+class BadRequestError(Error):
+    """ Raised when a call breaks one of the datastore's limits """
+
+class Rollback(Error):
+    """ Raised inside a transaction function to roll it back quietly """
+
+# Most entity groups a transaction may read or write, as on App Engine
+MAX_TXN_GROUPS = 25
+
+
+# Operation hooks. Each hook is called as hook(op, count, elapsed) after
+# every storage call, where op is 'get', 'put', 'delete', 'query' or
+# 'allocate_ids', count is the number of keys or results, and elapsed
+# is the call's duration in seconds.
+hooks = []
+
+def _record(op, count, start):
+    """ Reports a finished storage call to the registered hooks """
+    if hooks:
+        elapsed = time.time() - start
+        for hook in list(hooks):
+            hook(op, count, elapsed)
+
+
+# Keys
+
+class Key(object):
+    """ Datastore-style entity key, made of a path of (kind, id or name)
+    pairs from the root entity down to this one.
+    """
+    def __init__(self, path):
+        self._path = tuple(tuple(pair) for pair in path)
+
+    @classmethod
+    def from_path(cls, *args, **kwargs):
+        """ Builds a key from alternating kinds and ids or names, below
+        an optional parent key
+        """
+        if len(args) % 2:
+            raise BadArgumentError('from_path needs kind, id pairs')
+        parent = kwargs.get('parent')
+        path = list(parent._path) if parent else []
+        for i in range(0, len(args), 2):
+            kind, ident = args[i], args[i + 1]
+            if isinstance(kind, type) and issubclass(kind, Model):
+                kind = kind.kind()
+            if not isinstance(ident, (int, long, basestring)):
+                raise BadArgumentError('Invalid id or name %r' % (ident,))
+            path.append((kind, ident))
+        return cls(path)
+
+    def kind(self):
+        return self._path[-1][0]
+
+    def id(self):
+        ident = self._path[-1][1]
+        return ident if isinstance(ident, (int, long)) else None
+
+    def name(self):
+        ident = self._path[-1][1]
+        return ident if isinstance(ident, basestring) else None
+
+    def id_or_name(self):
+        return self._path[-1][1]
+
+    def has_id_or_name(self):
+        return self._path[-1][1] is not None
+
+    def parent(self):
+        if len(self._path) > 1:
+            return Key(self._path[:-1])
+        return None
+
+    def to_path(self):
+        return [item for pair in self._path for item in pair]
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self._path == other._path
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._path)
+
+    def __str__(self):
+        return base64.urlsafe_b64encode(_encode_key(self))
+
+    def __repr__(self):
+        return 'Key(%s)' % ', '.join(repr(item) for item in self.to_path())
+
+
+def _encode_key(key):
+    """ Returns the string stored for a key in the database """
+    return json.dumps(key._path, separators=(',', ':'))
+
+def _decode_key(text):
+    """ Rebuilds a key from its stored string """
+    return Key(json.loads(text))
+
+def _to_key(value):
+    """ Returns the key of a model object, or value if already a key """
+    if isinstance(value, Model):
+        return value.key()
+    if isinstance(value, basestring):
+        return _decode_key(base64.urlsafe_b64decode(str(value)))
+    return value
+
+
+# Properties
+
+class Property(object):
+    """ Base class for model properties """
+    def __init__(self, verbose_name=None, name=None, default=None,
+                 required=False, indexed=True, **kwargs):
+        self.name = name
+        self.default = default
+        self.required = required
+        self.indexed = indexed
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._values.get(self.name)
+
+    def __set__(self, instance, value):
+        instance._values[self.name] = self.validate(value)
+
+    def default_value(self):
+        return self.default
+
+    def empty(self, value):
+        return not value
+
+    def validate(self, value):
+        if self.required and self.empty(value):
+            raise BadValueError('Property %s is required' % self.name)
+        return value
+
+    def get_value_for_datastore(self, instance):
+        return instance._values.get(self.name)
+
+    def make_value_from_datastore(self, value):
+        return value
+
+
+class StringProperty(Property):
+    """ Short, indexed string """
+    def validate(self, value):
+        value = Property.validate(self, value)
+        if value is not None and not isinstance(value, basestring):
+            raise BadValueError('Property %s must be a string' % self.name)
+        return value
+
+
+class TextProperty(StringProperty):
+    """ Long, unindexed text """
+    def __init__(self, *args, **kwargs):
+        kwargs['indexed'] = False
+        StringProperty.__init__(self, *args, **kwargs)
+
+
+class BlobProperty(Property):
+    """ Unindexed byte string """
+    def __init__(self, *args, **kwargs):
+        kwargs['indexed'] = False
+        Property.__init__(self, *args, **kwargs)
+
+
+class IntegerProperty(Property):
+    """ Integer value """
+    def empty(self, value):
+        return value is None
+
+    def validate(self, value):
+        value = Property.validate(self, value)
+        if value is not None and (isinstance(value, bool) or
+                                  not isinstance(value, (int, long))):
+            raise BadValueError('Property %s must be an int' % self.name)
+        return value
+
+
+class BooleanProperty(Property):
+    """ True or False value """
+    def empty(self, value):
+        return value is None
+
+
+class DateTimeProperty(Property):
+    """ Date and time value, optionally set automatically on creation
+    (auto_now_add) or on every put (auto_now). Like App Engine, which
+    runs in UTC, automatic values are in UTC.
+    """
+    def __init__(self, verbose_name=None, auto_now=False,
+                 auto_now_add=False, **kwargs):
+        Property.__init__(self, verbose_name, **kwargs)
+        self.auto_now = auto_now
+        self.auto_now_add = auto_now_add
+
+    def default_value(self):
+        if self.auto_now or self.auto_now_add:
+            return datetime.datetime.utcnow()
+        return Property.default_value(self)
+
+    def empty(self, value):
+        return value is None
+
+    def get_value_for_datastore(self, instance):
+        if self.auto_now:
+            instance._values[self.name] = datetime.datetime.utcnow()
+        return Property.get_value_for_datastore(self, instance)
+
+
+class ListProperty(Property):
+    """ List of values of one type. A default of None means an empty
+    list, as in the datastore.
+    """
+    def __init__(self, item_type, verbose_name=None, default=None,
+                 **kwargs):
+        Property.__init__(self, verbose_name, default=default, **kwargs)
+        self.item_type = item_type
+
+    def default_value(self):
+        return list(self.default or [])
+
+    def empty(self, value):
+        return value is None
+
+    def make_value_from_datastore(self, value):
+        return list(value or [])
+
+
+class ReferenceProperty(Property):
+    """ Reference to another entity. The key is stored, and the entity
+    is looked up when the attribute is first read.
+    """
+    def __init__(self, reference_class=None, verbose_name=None,
+                 collection_name=None, **kwargs):
+        Property.__init__(self, verbose_name, **kwargs)
+        self.reference_class = reference_class
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        key = instance._values.get(self.name)
+        if key is None:
+            return None
+        resolved = instance._resolved.get(self.name)
+        if resolved is None:
+            resolved = get(key)
+            if resolved is None:
+                raise ReferencePropertyResolveError(
+                    'Referenced entity %r not found' % key)
+            instance._resolved[self.name] = resolved
+        return resolved
+
+    def __set__(self, instance, value):
+        if isinstance(value, Model):
+            instance._resolved[self.name] = value
+            value = value.key()
+        else:
+            instance._resolved.pop(self.name, None)
+        Property.__set__(self, instance, value)
+
+    def empty(self, value):
+        return value is None
+
+
+# Models
+
+# Map of kind name to model class
+_kind_map = {}
+
+
+class PropertiedClass(type):
+    """ Metaclass that collects a model's properties and registers its
+    kind
+    """
+    def __init__(cls, name, bases, dct):
+        super(PropertiedClass, cls).__init__(name, bases, dct)
+        properties = {}
+        for base in reversed(cls.__mro__[1:]):
+            properties.update(getattr(base, '_properties', {}))
+        for attr, value in dct.items():
+            if isinstance(value, Property):
+                value.name = attr
+                properties[attr] = value
+        cls._properties = properties
+        if dct.get('__module__') != __name__:
+            _kind_map[cls.kind()] = cls
+
+
+class Model(object):
+    """ Base class for stored entities """
+    __metaclass__ = PropertiedClass
+
+    def __init__(self, parent=None, key_name=None, key=None, **kwargs):
+        self._values = {}
+        self._resolved = {}
+        if key is None:
+            parent_key = _to_key(parent)
+            path = list(parent_key._path) if parent_key else []
+            path.append((self.kind(), key_name))
+            key = Key(path)
+        elif key.kind() != self.kind():
+            raise BadArgumentError('Key kind %s is not %s' %
+                                   (key.kind(), self.kind()))
+        self._key = key
+        for name, prop in self._properties.items():
+            if name in kwargs:
+                value = kwargs[name]
+            else:
+                value = prop.default_value()
+            prop.__set__(self, value)
+
+    @classmethod
+    def kind(cls):
+        return cls.__name__
+
+    @classmethod
+    def properties(cls):
+        return dict(cls._properties)
+
+    def key(self):
+        if not self._key.has_id_or_name():
+            raise NotSavedError('Entity has not been saved')
+        return self._key
+
+    def has_key(self):
+        return self._key.has_id_or_name()
+
+    def is_saved(self):
+        return self._key.has_id_or_name()
+
+    def parent_key(self):
+        return self._key.parent()
+
+    def put(self, **kwargs):
+        return put(self)
+
+    def delete(self, **kwargs):
+        delete(self.key())
+
+    @classmethod
+    def get(cls, keys, **kwargs):
+        return get(keys)
+
+    @classmethod
+    def get_by_id(cls, ids, parent=None, **kwargs):
+        parent_key = _to_key(parent)
+        if isinstance(ids, (list, tuple)):
+            return get([Key.from_path(cls.kind(), int(i), parent=parent_key)
+                        for i in ids])
+        return get(Key.from_path(cls.kind(), int(ids), parent=parent_key))
+
+    @classmethod
+    def get_by_key_name(cls, key_names, parent=None, **kwargs):
+        parent_key = _to_key(parent)
+        if isinstance(key_names, (list, tuple)):
+            return get([Key.from_path(cls.kind(), name, parent=parent_key)
+                        for name in key_names])
+        return get(Key.from_path(cls.kind(), key_names, parent=parent_key))
+
+    @classmethod
+    def all(cls, **kwargs):
+        return Query(cls, **kwargs)
+
+    def _to_entity(self):
+        """ Returns a dict of property name to stored value """
+        return dict((name, prop.get_value_for_datastore(self))
+                    for name, prop in self._properties.items())
+
+    @classmethod
+    def _from_entity(cls, key, values):
+        """ Builds a model object from its stored values """
+        instance = cls.__new__(cls)
+        instance._key = key
+        instance._values = {}
+        instance._resolved = {}
+        for name, prop in cls._properties.items():
+            value = values.get(name, prop.default_value())
+            instance._values[name] = prop.make_value_from_datastore(value)
+        return instance
+
+
+# Engine
+
+class Engine(object):
+    """ SQLite database holding entities, their index rows, their
+    ancestor paths and the id counters for each kind. All access goes
+    through one lock, which also serializes transactions. Each thread
+    keeps its own transaction depth, so only the thread that opened a
+    transaction is in it.
+    """
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS entities ('
+        ' key TEXT PRIMARY KEY, kind TEXT NOT NULL, data BLOB NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS entities_kind ON entities (kind)',
+        'CREATE TABLE IF NOT EXISTS idx ('
+        ' kind TEXT NOT NULL, name TEXT NOT NULL, value, key TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS idx_value ON idx (kind, name, value)',
+        'CREATE INDEX IF NOT EXISTS idx_key ON idx (key)',
+        'CREATE TABLE IF NOT EXISTS anc ('
+        ' ancestor TEXT NOT NULL, key TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS anc_ancestor ON anc (ancestor)',
+        'CREATE INDEX IF NOT EXISTS anc_key ON anc (key)',
+        'CREATE TABLE IF NOT EXISTS ids ('
+        ' kind TEXT PRIMARY KEY, next INTEGER NOT NULL)',
+    ]
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None)
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+
+    @contextmanager
+    def transaction(self):
+        """ Runs the enclosed block in a database transaction. Nested
+        blocks join the outer transaction.
+        """
+        with self.lock:
+            depth = self.get_depth()
+            if depth == 0:
+                self.conn.execute('BEGIN')
+            self.local.depth = depth + 1
+            try:
+                yield
+            except:
+                self.local.depth = depth
+                if depth == 0:
+                    self.conn.execute('ROLLBACK')
+                raise
+            else:
+                self.local.depth = depth
+                if depth == 0:
+                    self.conn.execute('COMMIT')
+
+    def get_depth(self):
+        """ Returns the calling thread's transaction nesting depth """
+        return getattr(self.local, 'depth', 0)
+
+    def in_transaction(self):
+        return self.get_depth() > 0
+
+    def touch(self, keys):
+        """ Adds the entity groups of these keys to those used by the
+        calling thread's transaction, if it is in one. Raises
+        BadRequestError if that makes more than MAX_TXN_GROUPS.
+        """
+        groups = getattr(self.local, 'groups', None)
+        if groups is None:
+            return
+        groups.update(key._path[0] for key in keys)
+        if len(groups) > MAX_TXN_GROUPS:
+            raise BadRequestError('operating on too many entity groups in '
+                                  'a single transaction')
+
+    def allocate(self, kind, size):
+        """ Reserves size ids for kind and returns the first one """
+        with self.transaction():
+            row = self.conn.execute('SELECT next FROM ids WHERE kind = ?',
+                                    (kind,)).fetchone()
+            start = row and row[0] or 1
+            self.conn.execute('INSERT OR REPLACE INTO ids VALUES (?, ?)',
+                              (kind, start + size))
+        return start
+
+    def write(self, key, values, index_rows):
+        """ Stores an entity with its index and ancestor rows """
+        encoded = _encode_key(key)
+        data = sqlite3.Binary(pickle.dumps(values, 2))
+        self.conn.execute('DELETE FROM idx WHERE key = ?', (encoded,))
+        self.conn.execute('DELETE FROM anc WHERE key = ?', (encoded,))
+        self.conn.execute('INSERT OR REPLACE INTO entities VALUES (?, ?, ?)',
+                          (encoded, key.kind(), data))
+        self.conn.executemany('INSERT INTO idx VALUES (?, ?, ?, ?)',
+                              [(key.kind(), name, value, encoded)
+                               for name, value in index_rows])
+        ancestors = [_encode_key(Key(key._path[:i]))
+                     for i in range(1, len(key._path) + 1)]
+        self.conn.executemany('INSERT INTO anc VALUES (?, ?)',
+                              [(ancestor, encoded) for ancestor in ancestors])
+
+    def read(self, encoded_keys):
+        """ Returns a dict of encoded key to stored values """
+        found = {}
+        for start in range(0, len(encoded_keys), 500):
+            chunk = encoded_keys[start:start + 500]
+            rows = self.conn.execute(
+                'SELECT key, data FROM entities WHERE key IN (%s)' %
+                ','.join('?' * len(chunk)), chunk)
+            for encoded, data in rows:
+                found[encoded] = pickle.loads(str(data))
+        return found
+
+    def remove(self, encoded_keys):
+        """ Deletes entities with their index and ancestor rows """
+        for start in range(0, len(encoded_keys), 500):
+            chunk = encoded_keys[start:start + 500]
+            marks = ','.join('?' * len(chunk))
+            for table in ('entities', 'idx', 'anc'):
+                self.conn.execute('DELETE FROM %s WHERE key IN (%s)' %
+                                  (table, marks), chunk)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """ Returns the storage engine, opening the database named by the
+    BLOG_STORAGE_PATH environment variable (in memory by default) on
+    first use
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = Engine(os.environ.get('BLOG_STORAGE_PATH', ':memory:'))
+        return _engine
+
+def reset(path=':memory:'):
+    """ Replaces the storage engine with a fresh one using this
+    database path. Returns the new engine.
+    """
+    global _engine
+    with _engine_lock:
+        _engine = Engine(path)
+        return _engine
+
+
+def _index_value(value):
+    """ Converts a property value to its sortable database form """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+    if isinstance(value, Key):
+        return _encode_key(value)
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def _index_rows(model, values):
+    """ Returns the (name, value) index rows for an entity """
+    rows = []
+    for name, prop in model._properties.items():
+        if not prop.indexed:
+            continue
+        value = values.get(name)
+        items = value if isinstance(value, list) else [value]
+        rows.extend((name, _index_value(item)) for item in items)
+    return rows
+
+
+# Batch operations
+
+def _as_list(values):
+    """ Returns (list, multiple) for a single value or a list """
+    if isinstance(values, (list, tuple)):
+        return list(values), True
+    return [values], False
+
+def get(keys, **kwargs):
+    """ Looks up one key or a list of keys in one call. Returns the
+    model object (or list of them), with None for missing keys.
+    """
+    return _start_get(keys, False).get_result()
+
+def get_async(keys, **kwargs):
+    """ Starts looking up one key or a list of keys on a worker thread.
+    Returns a Future whose get_result() returns what get() would.
+    """
+    return _start_get(keys, True)
+
+def _start_get(keys, background):
+    """ Returns a Future for a get of these keys """
+    start = time.time()
+    keys, multiple = _as_list(keys)
+    keys = [_to_key(key) for key in keys]
+    engine = get_engine()
+    engine.touch(keys)
+    encoded = [_encode_key(key) for key in keys]
+
+    def read():
+        with engine.lock:
+            return engine.read(encoded)
+
+    def finish(found):
+        results = []
+        for key, code in zip(keys, encoded):
+            values = found.get(code)
+            if values is None:
+                results.append(None)
+                continue
+            model_class = _kind_map.get(key.kind())
+            if model_class is None:
+                raise KindError('No model class for kind %s' % key.kind())
+            results.append(model_class._from_entity(key, values))
+        _record('get', len(keys), start)
+        return results if multiple else results[0]
+    return _submit(read, finish, background)
+
+def put(models, **kwargs):
+    """ Stores one model object or a list of them in one call. New
+    entities without a key name are given an id. Returns the key (or
+    list of keys).
+    """
+    start = time.time()
+    models, multiple = _as_list(models)
+    engine = get_engine()
+    keys = []
+    with engine.transaction():
+        for model in models:
+            if not model._key.has_id_or_name():
+                new_id = engine.allocate(model.kind(), 1)
+                model._key = Key(model._key._path[:-1] +
+                                 ((model.kind(), new_id),))
+            engine.touch([model._key])
+            values = model._to_entity()
+            engine.write(model._key, values, _index_rows(model, values))
+            keys.append(model._key)
+    _record('put', len(keys), start)
+    return keys if multiple else keys[0]
+
+def delete(models, **kwargs):
+    """ Deletes one key or model object, or a list of them, in one call """
+    start = time.time()
+    keys, multiple = _as_list(models)
+    keys = [_to_key(key) for key in keys]
+    encoded = [_encode_key(key) for key in keys]
+    engine = get_engine()
+    engine.touch(keys)
+    with engine.transaction():
+        engine.remove(encoded)
+    _record('delete', len(encoded), start)
+
+def allocate_ids(model, size):
+    """ Reserves size ids for the kind of this key or model class.
+    Returns the (first, last) ids of the range.
+    """
+    start = time.time()
+    if isinstance(model, Key):
+        kind = model.kind()
+    elif isinstance(model, type):
+        kind = model.kind()
+    else:
+        kind = model.key().kind()
+    first = get_engine().allocate(kind, size)
+    _record('allocate_ids', size, start)
+    return first, first + size - 1
+
+
+# Transactions
+
+class TransactionOptions(object):
+    """ Transaction settings. They are accepted for compatibility, since
+    local transactions are serialized and never need retrying.
+    """
+    def __init__(self, xg=False, retries=3, **kwargs):
+        self.xg = xg
+        self.retries = retries
+
+def create_transaction_options(**kwargs):
+    return TransactionOptions(**kwargs)
+
+def run_in_transaction_options(options, function, *args, **kwargs):
+    """ Runs function in a transaction and returns its result. If it
+    raises Rollback, the transaction is rolled back and None returned.
+    A transaction run inside another joins it.
+    """
+    engine = get_engine()
+    outer = getattr(engine.local, 'groups', None) is None
+    try:
+        with engine.transaction():
+            if outer:
+                engine.local.groups = set()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if outer:
+                    engine.local.groups = None
+    except Rollback:
+        return None
+
+def run_in_transaction(function, *args, **kwargs):
+    return run_in_transaction_options(None, function, *args, **kwargs)
+
+def is_in_transaction():
+    return get_engine().in_transaction()
+
+
+# Queries
+
+_OPERATORS = {'=': '=', '==': '=', '<': '<', '<=': '<=', '>': '>',
+              '>=': '>=', 'in': 'IN'}
+
+
+class Query(object):
+    """ Query over one kind of model, with equality and inequality
+    filters, sort orders, an optional ancestor and cursors
+    """
+    def __init__(self, model_class, keys_only=False, **kwargs):
+        self._model_class = model_class
+        self._keys_only = keys_only
+        self._filters = []
+        self._orders = []
+        self._ancestor = None
+        self._start_position = None
+        self._end_position = None
+        self._ran = False
+
+    def filter(self, property_operator, value):
+        parts = property_operator.split()
+        name = parts[0]
+        op = _OPERATORS.get(len(parts) > 1 and parts[1].lower() or '=')
+        if op is None:
+            raise BadArgumentError('Unsupported filter %r' %
+                                   property_operator)
+        if op == 'IN':
+            value = [_index_value(_to_key(v) if isinstance(v, Model) else v)
+                     for v in value]
+        else:
+            value = _index_value(value.key() if isinstance(value, Model)
+                                 else value)
+        self._filters.append((name, op, value))
+        return self
+
+    def order(self, prop):
+        descending = prop.startswith('-')
+        self._orders.append((prop.lstrip('-'), descending))
+        return self
+
+    def ancestor(self, ancestor):
+        self._ancestor = _to_key(ancestor)
+        return self
+
+    def with_cursor(self, start_cursor=None, end_cursor=None):
+        self._start_position = (start_cursor and
+                                _decode_cursor(start_cursor) or None)
+        return self
+
+    def cursor(self):
+        if not self._ran:
+            raise AssertionError('No cursor until the query has run')
+        return _encode_cursor(self._end_position)
+
+    def _sql(self, select, limit=None, offset=0):
+        """ Returns the SQL statement and parameters for this query. The
+        sort values of each result follow the selected columns.
+        """
+        kind = self._model_class.kind()
+        joins = []
+        params = []
+        if self._ancestor is not None:
+            joins.append('JOIN anc a ON a.key = e.key AND a.ancestor = ?')
+            params.append(_encode_key(self._ancestor))
+        for i, (name, op, value) in enumerate(self._filters):
+            alias = 'f%d' % i
+            join = ('JOIN idx %s ON %s.key = e.key AND %s.kind = ? '
+                    'AND %s.name = ? ' % (alias, alias, alias, alias))
+            params.extend([kind, name])
+            if op == 'IN':
+                join += 'AND %s.value IN (%s)' % (alias,
+                                                   ','.join('?' * len(value)))
+                params.extend(value)
+            elif value is None and op == '=':
+                join += 'AND %s.value IS NULL' % alias
+            else:
+                join += 'AND %s.value %s ?' % (alias, op)
+                params.append(value)
+            joins.append(join)
+        terms = []
+        for i, (name, descending) in enumerate(self._orders):
+            alias = 'o%d' % i
+            joins.append('JOIN idx %s ON %s.key = e.key AND %s.kind = ? '
+                         'AND %s.name = ?' % (alias, alias, alias, alias))
+            params.extend([kind, name])
+            # List properties sort on their smallest or largest value
+            terms.append((descending and 'MAX(%s.value)' % alias or
+                          'MIN(%s.value)' % alias, descending))
+        terms.append(('e.key', False))
+        having = ''
+        if self._start_position is not None:
+            condition, values = _after_position(terms,
+                                                self._start_position)
+            having = ' HAVING ' + condition
+        sql = ('SELECT %s, %s FROM entities e %s WHERE e.kind = ? '
+               'GROUP BY e.key%s ORDER BY %s' %
+               (select, ', '.join(expr for expr, descending in terms),
+                ' '.join(joins), having,
+                ', '.join('%s %s' % (expr, descending and 'DESC' or 'ASC')
+                          for expr, descending in terms)))
+        params.append(kind)
+        if having:
+            params.extend(values)
+        if limit is not None or offset:
+            sql += ' LIMIT ? OFFSET ?'
+            params.extend([limit is None and -1 or limit, offset])
+        return sql, params
+
+    def fetch(self, limit, offset=0, **kwargs):
+        """ Returns a list of up to limit results, skipping offset """
+        return self._start_fetch(limit, offset, False).get_result()
+
+    def run(self, limit=None, offset=0, batch_size=None, **kwargs):
+        """ Starts fetching the results on a worker thread, as the
+        datastore prefetches the first batch, and returns an iterator
+        over them
+        """
+        return _FutureIterator(self._start_fetch(limit, offset, True))
+
+    def _start_fetch(self, limit, offset, background):
+        """ Returns a Future for a list of up to limit results """
+        start = time.time()
+        select = self._keys_only and 'e.key' or 'e.key, e.data'
+        sql, params = self._sql(select, limit, offset)
+        engine = get_engine()
+
+        def read():
+            with engine.lock:
+                return engine.conn.execute(sql, params).fetchall()
+
+        def finish(rows):
+            results = []
+            for row in rows:
+                key = _decode_key(row[0])
+                if self._keys_only:
+                    results.append(key)
+                else:
+                    results.append(self._model_class._from_entity(
+                        key, pickle.loads(str(row[1]))))
+            if rows:
+                self._end_position = list(rows[-1][-len(self._orders) - 1:])
+            else:
+                self._end_position = self._start_position
+            self._ran = True
+            _record('query', len(results), start)
+            return results
+        return _submit(read, finish, background)
+
+    def __iter__(self):
+        # Nothing else runs while a loop waits, so fetch in this thread
+        return iter(self.fetch(None))
+
+    def get(self, **kwargs):
+        results = self.fetch(1)
+        return results and results[0] or None
+
+    def count(self, limit=None, **kwargs):
+        start = time.time()
+        sql, params = self._sql('e.key', limit)
+        engine = get_engine()
+        with engine.lock:
+            total = engine.conn.execute(
+                'SELECT COUNT(*) FROM (%s)' % sql, params).fetchone()[0]
+        _record('query', 1, start)
+        return total
+
+
+def _after_position(terms, position):
+    """ Returns a SQL condition, and its parameters, selecting the rows
+    that sort after position, the list of sort values (ending with the
+    key) of a result. terms lists the (expression, descending) sort
+    terms.
+    """
+    if len(position) != len(terms):
+        raise BadArgumentError('Cursor does not match the query')
+    clauses = []
+    values = []
+    for i, (expr, descending) in enumerate(terms):
+        parts = []
+        for earlier, value in zip(terms[:i], position):
+            parts.append('%s IS ?' % earlier[0])
+            values.append(value)
+        # NULLs sort first
+        if position[i] is None:
+            if descending:
+                continue
+            parts.append('%s IS NOT NULL' % expr)
+        elif descending:
+            parts.append('(%s < ? OR %s IS NULL)' % (expr, expr))
+            values.append(position[i])
+        else:
+            parts.append('%s > ?' % expr)
+            values.append(position[i])
+        clauses.append('(%s)' % ' AND '.join(parts))
+    return '(%s)' % (' OR '.join(clauses) or '0'), values
+
+def _encode_cursor(position):
+    """ Returns a cursor holding a result position (or None, for the
+    start of the results)
+    """
+    return base64.urlsafe_b64encode(json.dumps(position))
+
+def _decode_cursor(cursor):
+    """ Returns the result position held in a query cursor """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise BadArgumentError('Invalid cursor %r' % cursor)
+    if position is not None and not isinstance(position, list):
+        raise BadArgumentError('Invalid cursor %r' % cursor)
+    return position
+
+
+# Async calls
+
+# Number of worker threads serving async calls
+WORKER_THREADS = 4
+
+_requests = Queue.Queue()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+class Future(object):
+    """ Result of a storage call. The database read runs on a worker
+    thread; get_result() waits for it, then builds and returns the
+    result, or raises the call's error. A read no worker has started
+    yet is run by the waiting thread instead. Hooks are called from the
+    waiting thread, so per-thread counters see the call. Wait for
+    results outside transactions, which hold the engine lock.
+    """
+    def __init__(self, read, finish):
+        self._read = read
+        self._finish = finish
+        self._lock = threading.Lock()
+        self._started = False
+        self._done = threading.Event()
+        self._rows = None
+        self._error = None
+        self._result = None
+
+    def _claim(self):
+        """ Returns True if the caller is the one to do the read """
+        with self._lock:
+            started = self._started
+            self._started = True
+            return not started
+
+    def _run(self):
+        try:
+            self._rows = self._read()
+        except Exception:
+            self._error = sys.exc_info()
+        self._done.set()
+
+    def run_if_waiting(self):
+        """ Does the read, unless another thread already has """
+        if self._claim():
+            self._run()
+
+    def get_result(self):
+        self.run_if_waiting()
+        self._done.wait()
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        if self._finish:
+            self._result = self._finish(self._rows)
+            self._finish = self._rows = None
+        return self._result
+
+
+class _FutureIterator(object):
+    """ Iterator over the list result of a Future, which waits for it
+    when first advanced
+    """
+    def __init__(self, future):
+        self._future = future
+        self._results = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._results is None:
+            self._results = iter(self._future.get_result())
+        return next(self._results)
+
+
+def _work():
+    """ Worker thread loop, doing the reads of queued futures until it
+    is sent None
+    """
+    while True:
+        future = _requests.get()
+        if future is None:
+            return
+        future.run_if_waiting()
+
+@atexit.register
+def _stop_workers():
+    """ Stops the worker threads before the interpreter shuts down """
+    with _workers_lock:
+        for worker in _workers:
+            _requests.put(None)
+        for worker in _workers:
+            worker.join()
+        del _workers[:]
+
+def _submit(read, finish, background):
+    """ Returns a Future for read, queued for a worker thread if
+    background is True. Inside a transaction the read is left for the
+    caller, as the transaction holds the engine lock.
+    """
+    future = Future(read, finish)
+    if background and not get_engine().in_transaction():
+        with _workers_lock:
+            while len(_workers) < WORKER_THREADS:
+                worker = threading.Thread(target=_work,
+                                          name='storage-worker')
+                worker.daemon = True
+                worker.start()
+                _workers.append(worker)
+        _requests.put(future)
+    return future
+
+
+# Task queue
+
+_tasks = threading.local()
+
+def defer(function, *args, **kwargs):
+    """ Runs function(*args, **kwargs) as a task. Locally, tasks run in
+    the calling thread once any task already running there finishes.
+    Task queue options (keyword arguments starting with '_') are ignored.
+    """
+    for name in list(kwargs):
+        if name.startswith('_'):
+            del kwargs[name]
+    queue = getattr(_tasks, 'queue', None)
+    if queue is None:
+        queue = _tasks.queue = []
+    queue.append((function, args, kwargs))
+    if getattr(_tasks, 'running', False):
+        return
+    _tasks.running = True
+    try:
+        while queue:
+            function, args, kwargs = queue.pop(0)
+            function(*args, **kwargs)
+    finally:
+        _tasks.running = False
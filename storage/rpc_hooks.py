@@ -0,0 +1,68 @@
+# Storage operation hooks for App Engine's datastore.
+#
+# App Engine reports every datastore RPC to hooks registered on its API
+# proxy. These are translated into the same hook(op, count, elapsed)
+# calls that the local engine makes (see hooks in storage/local.py).
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+# Datastore RPC names and the storage operations they count as
+OPERATIONS = {
+    'Get': 'get',
+    'Put': 'put',
+    'Delete': 'delete',
+    'RunQuery': 'query',
+    'Next': 'query',
+    'AllocateIds': 'allocate_ids',
+    'BeginTransaction': 'begin',
+    'Commit': 'commit',
+    'Rollback': 'rollback',
+}
+
+hooks = []
+_started = threading.local()
+
+
+def _item_count(call, request, response):
+    """ Returns the number of keys or results an RPC handled """
+    try:
+        if call in ('Get', 'Delete'):
+            return request.key_size()
+        if call == 'Put':
+            return request.entity_size()
+        if call in ('RunQuery', 'Next'):
+            return response.result_size()
+    except AttributeError:
+        pass
+    return 1
+
+def _pre_call(service, call, request, response):
+    """ Notes when a datastore RPC starts """
+    if not hasattr(_started, 'times'):
+        _started.times = {}
+    _started.times[id(request)] = time.time()
+
+def _post_call(service, call, request, response, rpc=None, error=None):
+    """ Reports a finished datastore RPC to the registered hooks """
+    start = getattr(_started, 'times', {}).pop(id(request), None)
+    op = OPERATIONS.get(call)
+    if start is None or op is None:
+        return
+    elapsed = time.time() - start
+    count = _item_count(call, request, response)
+    for hook in list(hooks):
+        hook(op, count, elapsed)
+
+def add_hook(hook):
+    """ Registers hook(op, count, elapsed) to be called after every
+    datastore RPC
+    """
+    if not hooks:
+        apiproxy = apiproxy_stub_map.apiproxy
+        apiproxy.GetPreCallHooks().Append('blog_storage_hooks', _pre_call,
+                                          'datastore_v3')
+        apiproxy.GetPostCallHooks().Append('blog_storage_hooks', _post_call,
+                                           'datastore_v3')
+    hooks.append(hook)
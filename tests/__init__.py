@@ -0,0 +1,71 @@
+# Tests of the blog, run against the local storage engine.
+#
+# Each test starts with an empty in-memory store and cache (see
+# storage/local.py and cache.py) and drives blog.app in-process.
+#
+# Usage: python -m unittest discover -s tests -t .
+import os
+
+# The tests always run against the local storage engine
+os.environ['BLOG_STORAGE'] = 'local'
+
+import unittest
+
+import webapp2
+
+import blog
+import cache
+import utils
+from storage import local
+from models import summary, user
+from models.user import User
+from models.post import BlogPost
+
+PASSWORD = 'secret'
+
+
+class BlogTestCase(unittest.TestCase):
+    """ Base class of the blog tests. Gives every test a fresh store and
+    cache, and helpers to add users and posts and to make requests.
+    """
+    def setUp(self):
+        local.reset()
+        cache.set_backend(cache.LRUCache())
+        # Forget what the last test's store had backfilled
+        user._index_complete = summary._summaries_complete = False
+        user._index_checked = summary._summaries_checked = 0
+
+    def make_user(self, name):
+        """ Registers a user and returns it """
+        return User.register(name, utils.make_pw_hash(name, PASSWORD))
+
+    def make_post(self, author, subject='Subject', content='Content'):
+        """ Adds a post by this user and returns it """
+        return BlogPost.create(author.key(), author.name, subject, content)
+
+    def session_cookie(self, user):
+        """ Returns a Cookie header value logging in as this user """
+        return 'user_id=%s' % utils.make_session_token(user.key().id(),
+                                                       user.name)
+
+    def request(self, path, user=None, method='GET', post=None):
+        """ Requests path from the app, as user if one is given, and
+        returns the response
+        """
+        headers = {}
+        if user is not None:
+            headers['Cookie'] = self.session_cookie(user)
+        request = webapp2.Request.blank(path, headers=headers, POST=post)
+        request.method = method
+        return request.get_response(blog.app)
+
+    def request_args(self, user=None, method='GET', post=None):
+        """ Returns the request arguments for instrument.assert_op_budget
+        that request as user
+        """
+        args = {'environ': {'REQUEST_METHOD': method}}
+        if user is not None:
+            args['headers'] = {'Cookie': self.session_cookie(user)}
+        if post is not None:
+            args['POST'] = post
+        return args
@@ -0,0 +1,67 @@
+# Tests of the per-author totals
+import datetime
+
+from storage import db
+from models import authorstats
+from models.authorstats import AuthorStats, reconcile_author_stats
+from models.comment import Comment
+
+from tests import BlogTestCase
+
+
+class AuthorStatsTest(BlogTestCase):
+    """ Author totals follow posts, likes and comments, and drift is
+    only corrected once the author's records have settled
+    """
+    def setUp(self):
+        BlogTestCase.setUp(self)
+        self.author = self.make_user('alice')
+        self.reader = self.make_user('bob')
+        self.blog_id = self.make_post(self.author).get_id()
+        self.make_post(self.author)
+        self.settle = authorstats.RECONCILE_SETTLE
+
+    def tearDown(self):
+        authorstats.RECONCILE_SETTLE = self.settle
+
+    def totals(self):
+        return db.get(AuthorStats.stats_key(self.author.key())).totals()
+
+    def test_totals(self):
+        self.request('/blog/%d/like' % self.blog_id, self.reader)
+        Comment.create(self.blog_id, self.reader.key(), 'A comment')
+        self.assertEqual(self.totals(), (2, 1, 1))
+        self.request('/blog/delpost?blog_id=%d' % self.blog_id, self.author)
+        self.assertEqual(self.totals(), (1, 0, 0))
+
+    def test_reconcile(self):
+        stats = db.get(AuthorStats.stats_key(self.author.key()))
+        stats.comment_count = 5
+        stats.put()
+        # Changes may still be on their way, so a fresh drift is left
+        checked, drifts, cursor = reconcile_author_stats()
+        self.assertEqual(drifts, [('alice', (2, 0, 5), (2, 0, 0), False)])
+        self.assertEqual(self.totals(), (2, 0, 5))
+        authorstats.RECONCILE_SETTLE = 0
+        checked, drifts, cursor = reconcile_author_stats()
+        self.assertEqual((checked, cursor), (2, None))
+        self.assertEqual(drifts, [('alice', (2, 0, 5), (2, 0, 0), True)])
+        self.assertEqual(self.totals(), (2, 0, 0))
+
+    def test_repeated_task(self):
+        # A task delivered twice applies its change once
+        AuthorStats.apply(self.author.key(), 0, 3, 0, change_id='abc')
+        self.assertFalse(AuthorStats.apply(self.author.key(), 0, 3, 0,
+                                           change_id='abc'))
+        self.assertEqual(self.totals(), (2, 3, 0))
+        AuthorStats.apply(self.author.key(), 0, 1, 0, change_id='def')
+        self.assertEqual(self.totals(), (2, 4, 0))
+
+    def test_forget_old_changes(self):
+        key = authorstats.AuthorChange.change_key(self.author.key(), 'old')
+        authorstats.AuthorChange(key=key, created=datetime.datetime.utcnow() -
+                                 authorstats.CHANGE_TTL * 2).put()
+        changes = authorstats.AuthorChange.all().count()
+        self.assertEqual(authorstats.AuthorChange.forget_old(), 1)
+        self.assertEqual(authorstats.AuthorChange.all().count(), changes - 1)
+        self.assertIsNone(db.get(key))
@@ -0,0 +1,67 @@
+# Tests of batched comment loading
+import blog
+import instrument
+from models.comment import Comment, BATCH_SIZE
+
+from tests import BlogTestCase
+
+
+class LoadCommentsTest(BlogTestCase):
+    """ Comments are looked up in one call per BATCH_SIZE ids, however
+    many a post has
+    """
+    def setUp(self):
+        BlogTestCase.setUp(self)
+        self.author = self.make_user('alice')
+        self.post = self.make_post(self.author)
+
+    def make_legacy_comments(self, count):
+        """ Stores count comments the old way, listed on the post, and
+        returns their ids
+        """
+        ids = []
+        for i in range(count):
+            cmt = Comment(blog_post=self.post, author=self.author,
+                          text='Comment %d' % i)
+            cmt.put()
+            ids.append(cmt.key().id())
+        return ids
+
+    def test_one_call_per_batch(self):
+        for count, calls in [(1, 1), (40, 1), (BATCH_SIZE, 1),
+                             (BATCH_SIZE + 1, 2)]:
+            ids = self.make_legacy_comments(count)
+            with instrument.op_budget(get=calls, total=calls):
+                comments = Comment.get_comments(ids)
+            self.assertEqual([cmt.key().id() for cmt in comments], ids)
+
+    def test_stale_ids(self):
+        ids = self.make_legacy_comments(5)
+        Comment.delete_comment(ids[1])
+        comments, stale_ids = Comment.load_comments(ids + [ids[1] + 1000])
+        self.assertEqual([cmt.key().id() for cmt in comments],
+                         ids[:1] + ids[2:])
+        self.assertEqual(stale_ids, [ids[1], ids[1] + 1000])
+
+
+class PermalinkCallsTest(BlogTestCase):
+    """ The permalink page makes as many storage calls for a post with
+    many comments as for one with a few
+    """
+    def test_calls_stay_flat(self):
+        author = self.make_user('alice')
+        reader = self.make_user('bob')
+        post = self.make_post(author)
+        path = '/blog/%d' % post.get_id()
+        Comment.create(post.get_id(), reader.key(), 'First')
+        with instrument.counting() as counter:
+            self.assertEqual(self.request(path).status_int, 200)
+        budget = dict((op, totals['calls'])
+                      for op, totals in counter.summary().items())
+        for i in range(200):
+            Comment.create(post.get_id(), reader.key(), 'Comment %d' % i)
+        response = instrument.assert_op_budget(blog.app, path, budget)
+        self.assertEqual(response.status_int, 200)
+        self.assertIn('Comment 18</pre>', response.body)
+        self.assertIn('More comments', response.body)
+
@@ -0,0 +1,137 @@
+# Tests that likes and comments made at the same time are all kept, and
+# that transactions that collide are retried
+import threading
+
+from storage import db
+from models import txn
+from models.post import BlogPost
+from models.summary import PostSummary
+from models.comment import Comment
+
+from tests import BlogTestCase
+
+# Number of users acting on the post at once
+USERS = 200
+# Number of threads making their requests
+THREADS = 20
+
+
+class ConcurrencyTest(BlogTestCase):
+    """ Many users liking and commenting on one post at once: every like
+    and comment is counted once, and repeated likes are refused
+    """
+    def test_parallel_likes_and_comments(self):
+        author = self.make_user('author')
+        users = [self.make_user('user%d' % i) for i in range(USERS)]
+        blog_id = self.make_post(author).get_id()
+        # Each user likes the post twice and comments on it once
+        work = []
+        for user in users:
+            work.append(('/blog/%d/like' % blog_id, user, 'GET', None))
+            work.append(('/blog/%d/comment' % blog_id, user, 'POST',
+                         {'action': 'Save',
+                          'comment': 'From %s' % user.name}))
+            work.append(('/blog/%d/like' % blog_id, user, 'GET', None))
+        statuses = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker(items):
+            try:
+                for path, user, method, post in items:
+                    status = self.request(path, user, method,
+                                          post).status_int
+                    with lock:
+                        statuses.append(status)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+        before = txn.get_stats()
+        threads = [threading.Thread(target=worker, args=(work[i::THREADS],))
+                   for i in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(txn.get_stats()['failed'], before['failed'])
+        # The second like of each user is refused with an error page
+        self.assertEqual(statuses.count(302), 2 * USERS)
+        self.assertEqual(statuses.count(200), USERS)
+
+        post = BlogPost.get_with_counts(blog_id)
+        self.assertEqual(post.like_count(), USERS)
+        self.assertEqual(post.comment_count(), USERS)
+        for user in users:
+            self.assertTrue(post.user_already_liked(user.key().id()))
+        texts = set(cmt.text for cmt in Comment.post_comments(blog_id))
+        self.assertEqual(texts, set('From %s' % user.name
+                                    for user in users))
+        summary = PostSummary.get(PostSummary.summary_key(post.key()))
+        self.assertEqual(summary.like_count, USERS)
+        self.assertEqual(summary.comment_count, USERS)
+
+
+class RetryTest(BlogTestCase):
+    """ A transaction that collides is retried with growing delays, up to
+    MAX_ATTEMPTS times, and every outcome is counted
+    """
+    def setUp(self):
+        BlogTestCase.setUp(self)
+        self.failures = 0
+        self.attempts = 0
+        self.delays = []
+        self.run_in_transaction_options = txn.db.run_in_transaction_options
+        self.sleep = txn.time.sleep
+        txn.db.run_in_transaction_options = self.collide
+        txn.time.sleep = self.delays.append
+
+    def tearDown(self):
+        txn.db.run_in_transaction_options = self.run_in_transaction_options
+        txn.time.sleep = self.sleep
+
+    def collide(self, options, function, *args, **kwargs):
+        """ Fails the first self.failures attempts, as a colliding write
+        would
+        """
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise db.TransactionFailedError('Collided')
+        return self.run_in_transaction_options(options, function, *args,
+                                               **kwargs)
+
+    def check_delays(self):
+        # Each retry waits RETRY_DELAY * 2 ** attempt, give or take half
+        for attempt, delay in enumerate(self.delays, 1):
+            base = txn.RETRY_DELAY * 2 ** attempt
+            self.assertTrue(0.5 * base <= delay <= 1.5 * base,
+                            (attempt, delay))
+
+    def test_retried(self):
+        self.failures = txn.MAX_ATTEMPTS - 1
+        before = txn.get_stats()
+        self.assertEqual(txn.run_in_txn(lambda: 'done'), 'done')
+        self.assertEqual(self.attempts, txn.MAX_ATTEMPTS)
+        self.assertEqual(len(self.delays), txn.MAX_ATTEMPTS - 1)
+        self.check_delays()
+        after = txn.get_stats()
+        self.assertEqual(after['conflicts'] - before['conflicts'],
+                         txn.MAX_ATTEMPTS - 1)
+        self.assertEqual(after['committed'] - before['committed'], 1)
+        self.assertEqual(after['failed'], before['failed'])
+
+    def test_gives_up(self):
+        self.failures = txn.MAX_ATTEMPTS
+        before = txn.get_stats()
+        self.assertRaises(db.TransactionFailedError, txn.run_in_txn,
+                          lambda: 'done')
+        self.assertEqual(self.attempts, txn.MAX_ATTEMPTS)
+        self.assertEqual(len(self.delays), txn.MAX_ATTEMPTS - 1)
+        self.check_delays()
+        after = txn.get_stats()
+        self.assertEqual(after['conflicts'] - before['conflicts'],
+                         txn.MAX_ATTEMPTS)
+        self.assertEqual(after['committed'], before['committed'])
+        self.assertEqual(after['failed'] - before['failed'], 1)
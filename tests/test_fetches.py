@@ -0,0 +1,130 @@
+# Tests that each page fetches the entities it needs once per request
+import collections
+
+import blog
+import instrument
+from storage import db, local
+from models.comment import Comment
+from models.commentcount import CommentCount
+from models.counter import CounterShard
+from models.like import Like
+
+from tests import BlogTestCase
+
+
+class FetchTest(BlogTestCase):
+    """ Every route loads exactly the entities it needs, each once.
+    Reads made inside a transaction are left out, since a transaction
+    must read what it changes, and so are reads made by tasks, which
+    run as requests of their own in production.
+    """
+    def setUp(self):
+        BlogTestCase.setUp(self)
+        self.author = self.make_user('alice')
+        self.reader = self.make_user('bob')
+        self.post = self.make_post(self.author)
+        self.blog_id = self.post.get_id()
+        self.cid = Comment.create(self.blog_id, self.reader.key(),
+                                  'A comment').key().id()
+        self.post_key = self.post.key()
+        self.comment_key = Comment.comment_key(self.post, self.cid)
+        self.like_key = db.Key.from_path(
+            Like.kind(), Like.make_key_name(self.blog_id,
+                                            self.reader.key().id()))
+        # The post's comment count and like counter shards
+        likes = Like.counter_name(self.blog_id)
+        self.counts = ([CommentCount.count_key(self.post_key)] +
+                       CounterShard.shard_keys(likes))
+        # The post page: the post, its author, its commenter and counts
+        self.page = ([self.post_key, self.author.key(), self.reader.key()] +
+                     self.counts)
+        self.reads = collections.Counter()
+        engine = local.get_engine()
+        read = engine.read
+
+        def counting_read(encoded_keys):
+            if not (engine.in_transaction() or
+                    getattr(local._tasks, 'running', False)):
+                self.reads.update(encoded_keys)
+            return read(encoded_keys)
+        engine.read = counting_read
+
+    def fetch(self, path, user, method, post, status, expected):
+        """ Requests path and checks that it read exactly the expected
+        keys, each once. Returns the response.
+        """
+        self.reads.clear()
+        response = self.request(path, user, method, post)
+        self.assertEqual(response.status_int, status)
+        repeated = [key for key, count in self.reads.items() if count > 1]
+        self.assertEqual(repeated, [], '%s %s read %s more than once' %
+                         (method, path, repeated))
+        self.assertEqual(sorted(self.reads),
+                         sorted(local._encode_key(key) for key in expected),
+                         '%s %s read the wrong entities' % (method, path))
+        return response
+
+    def post_path(self, page):
+        return '/blog/%s?blog_id=%d' % (page, self.blog_id)
+
+    def comment_path(self, page):
+        return '/blog/%d/%s?cid=%d' % (self.blog_id, page, self.cid)
+
+    def test_permalink(self):
+        self.fetch('/blog/%d' % self.blog_id, None, 'GET', None, 200,
+                   self.page)
+
+    def test_edit_post(self):
+        path = self.post_path('editpost')
+        self.fetch(path, self.author, 'GET', None, 200, [self.post_key])
+        self.fetch(path, self.reader, 'GET', None, 200, self.page)
+        self.fetch(path, self.author, 'POST',
+                   {'action': 'Save', 'subject': 'New', 'content': 'Text'},
+                   302, [self.post_key])
+
+    def test_delete_post(self):
+        path = self.post_path('delpost')
+        self.fetch(path, self.reader, 'GET', None, 200, self.page)
+        # The purge looks up the like count and its own record
+        purge_key = db.Key.from_path('PostPurge', str(self.blog_id))
+        self.fetch(path, self.author, 'GET', None, 302,
+                   [self.post_key, purge_key] + self.counts[1:])
+
+    def test_edit_comment(self):
+        path = self.comment_path('editcmt')
+        # The comment's author sees the form, which names the post's
+        # author only
+        self.fetch(path, self.reader, 'GET', None, 200,
+                   [self.post_key, self.comment_key, self.author.key()] +
+                   self.counts)
+        self.fetch(path, self.author, 'GET', None, 200,
+                   self.page + [self.comment_key])
+        self.fetch(path, self.reader, 'POST',
+                   {'action': 'Save', 'comment': 'Edited'}, 302,
+                   [self.post_key, self.comment_key])
+
+    def test_delete_comment(self):
+        path = self.comment_path('delcmt')
+        self.fetch(path, self.author, 'GET', None, 200,
+                   self.page + [self.comment_key])
+        self.fetch(path, self.reader, 'GET', None, 302,
+                   [self.post_key, self.comment_key])
+
+    def test_new_comment(self):
+        self.fetch('/blog/%d/comment' % self.blog_id, self.reader, 'POST',
+                   {'action': 'Save', 'comment': 'Another'}, 302,
+                   [self.post_key])
+
+    def test_like(self):
+        path = '/blog/%d/like' % self.blog_id
+        self.fetch(path, self.reader, 'GET', None, 302,
+                   [self.post_key, self.like_key])
+        self.fetch(path, self.reader, 'GET', None, 200,
+                   self.page + [self.like_key])
+        self.fetch(path, self.author, 'GET', None, 200, self.page)
+
+    def test_edit_form_budget(self):
+        # The edit post form only needs the post
+        instrument.assert_op_budget(blog.app, self.post_path('editpost'),
+                                    {'get': 1, 'total': 1},
+                                    **self.request_args(self.author))
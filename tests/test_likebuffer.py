@@ -0,0 +1,54 @@
+# Tests of the in-process like buffer used with the local storage engine
+import os
+
+from models import likebuffer
+from models.like import Like
+from models.post import BlogPost
+
+from tests import BlogTestCase
+
+
+class LikeBufferTest(BlogTestCase):
+    """ Buffered likes are shown straight away, and stored once the
+    buffer is due or flushed
+    """
+    def setUp(self):
+        BlogTestCase.setUp(self)
+        os.environ['BLOG_LIKE_BUFFER'] = 'on'
+        likebuffer._buffer = likebuffer.LikeBuffer()
+        self.buffer = likebuffer.get_buffer()
+        self.author = self.make_user('alice')
+        self.blog_id = self.make_post(self.author).get_id()
+
+    def tearDown(self):
+        del os.environ['BLOG_LIKE_BUFFER']
+        likebuffer._buffer = None
+
+    def like(self, name):
+        path = '/blog/%d/like' % self.blog_id
+        return self.request(path, self.make_user(name)).status_int
+
+    def stored(self):
+        return Like.get_counts([self.blog_id])[self.blog_id]
+
+    def test_flushed_when_due(self):
+        for i in range(3):
+            self.assertEqual(self.like('user%d' % i), 302)
+        self.assertEqual(self.stored(), 0)
+        self.assertEqual(BlogPost.get_by_id(self.blog_id).like_count(), 3)
+        # Other requests leave the buffer alone
+        self.request('/blog')
+        self.assertEqual(self.buffer.count(self.blog_id), 3)
+        # The first like after the oldest has waited long enough flushes
+        self.buffer.oldest -= likebuffer.FLUSH_INTERVAL
+        self.assertEqual(self.like('late'), 302)
+        self.assertEqual(self.stored(), 4)
+        self.assertEqual(self.buffer.get_stats(),
+                         {'pending': 0, 'flushed': 4})
+
+    def test_flush_job(self):
+        self.assertEqual(self.like('bob'), 302)
+        response = self.request('/blog/_admin/flush-likes')
+        self.assertIn('Stored 1 buffered likes', response.body)
+        self.assertEqual(self.stored(), 1)
+        self.assertEqual(BlogPost.get_by_id(self.blog_id).like_count(), 1)
@@ -0,0 +1,73 @@
+# Tests of purging the comments and likes of deleted posts
+import logging
+
+from models import purge
+from models.comment import Comment
+from models.like import Like
+from models.post import BlogPost
+from models.purge import PostPurge
+
+from tests import BlogTestCase
+
+
+class PurgeTest(BlogTestCase):
+    """ Small purges run in the delete request, within their own time
+    budget, and anything they leave is handed to a task
+    """
+    def setUp(self):
+        BlogTestCase.setUp(self)
+        self.author = self.make_user('alice')
+        self.post = self.make_post(self.author)
+        self.blog_id = self.post.get_id()
+        Comment.create(self.blog_id, self.author.key(), 'A comment')
+        # Queued tasks are recorded instead of run
+        self.queued = []
+        self.defer = purge.defer
+        purge.defer = lambda function, *args: self.queued.append(args)
+
+    def tearDown(self):
+        purge.defer = self.defer
+
+    def start(self):
+        PostPurge.start(BlogPost.get_by_id(self.blog_id))
+
+    def test_small_purge_inline(self):
+        Like.add_many(self.blog_id, range(1000, 1010))
+        self.start()
+        self.assertEqual(self.queued, [])
+        self.assertEqual(PostPurge.all().count(), 0)
+        self.assertEqual(Like.all().count(), 0)
+        self.assertEqual(Comment.all().count(), 0)
+
+    def test_many_likes_queued(self):
+        # A few comments but many likes is too much for the request
+        Like.add_many(self.blog_id, range(1000, 1001 + purge.INLINE_LIMIT))
+        self.start()
+        self.assertEqual(self.queued, [(self.blog_id,)])
+        self.assertEqual(Like.all().count(), purge.INLINE_LIMIT + 1)
+        self.assertEqual(PostPurge.all().count(), 1)
+
+    def test_inline_out_of_time_queued(self):
+        budget = purge.INLINE_TIME_BUDGET
+        purge.INLINE_TIME_BUDGET = -1
+        try:
+            self.start()
+        finally:
+            purge.INLINE_TIME_BUDGET = budget
+        self.assertEqual(self.queued, [(self.blog_id,)])
+        self.assertEqual(PostPurge.all().count(), 1)
+
+    def test_inline_failure_queued(self):
+        run_purge = purge.run_purge
+
+        def failing(blog_id, time_budget):
+            raise ValueError('failed')
+        purge.run_purge = failing
+        logging.disable(logging.ERROR)
+        try:
+            self.start()
+        finally:
+            purge.run_purge = run_purge
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.queued, [(self.blog_id,)])
+        self.assertEqual(PostPurge.all().count(), 1)
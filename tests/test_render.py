@@ -0,0 +1,83 @@
+# Tests of buffered and streamed page rendering
+import logging
+import os
+import unittest
+
+from handlers import bloghandler, templating
+from models.comment import Comment
+
+from tests import BlogTestCase
+
+
+class RenderTest(BlogTestCase):
+    """ Streamed pages match buffered ones, and render errors get an
+    error response either way
+    """
+    def setUp(self):
+        BlogTestCase.setUp(self)
+        author = self.make_user('alice')
+        post = self.make_post(author)
+        Comment.create(post.get_id(), author.key(), 'A comment')
+        self.path = '/blog/%d' % post.get_id()
+        self.streaming = bloghandler.STREAM_PAGES
+
+    def tearDown(self):
+        bloghandler.STREAM_PAGES = self.streaming
+
+    def get_page(self, streamed):
+        bloghandler.STREAM_PAGES = streamed
+        return self.request(self.path)
+
+    def test_same_page(self):
+        buffered = self.get_page(False)
+        streamed = self.get_page(True)
+        self.assertEqual(buffered.status_int, 200)
+        self.assertEqual(streamed.status_int, 200)
+        self.assertEqual(buffered.body, streamed.body)
+        self.assertIn('A comment', buffered.body)
+
+    def test_render_error(self):
+        environment = templating.get_environment()
+        get_template = environment.get_template
+        environment.get_template = lambda name: FailingTemplate()
+        # Keep the expected tracebacks out of the test output
+        logging.disable(logging.ERROR)
+        try:
+            for streamed in (False, True):
+                self.assertEqual(self.get_page(streamed).status_int, 500)
+        finally:
+            logging.disable(logging.NOTSET)
+            environment.get_template = get_template
+
+
+class CompiledTemplatesTest(unittest.TestCase):
+    """ Missing compiled templates are reported, and the templates are
+    loaded from templates/ instead
+    """
+    def setUp(self):
+        self.compiled_dir = templating.compiled_dir
+        self.warnings = []
+        self.warning = templating.logging.warning
+        templating.logging.warning = self.warnings.append
+        os.environ['BLOG_TEMPLATES'] = 'compiled'
+
+    def tearDown(self):
+        templating.compiled_dir = self.compiled_dir
+        templating.logging.warning = self.warning
+        del os.environ['BLOG_TEMPLATES']
+
+    def test_missing(self):
+        templating.compiled_dir = os.path.join(self.compiled_dir, 'missing')
+        self.assertFalse(templating.use_compiled())
+        self.assertEqual(len(self.warnings), 1)
+        self.assertIn('No compiled templates', self.warnings[0])
+
+
+class FailingTemplate(object):
+    """ Template that fails as soon as it is rendered """
+    def render(self, params):
+        raise RuntimeError('Template failed')
+
+    def generate(self, params):
+        raise RuntimeError('Template failed')
+        yield u''
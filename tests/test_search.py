@@ -0,0 +1,117 @@
+# Tests of the sharded search index
+from storage import db, local
+from models import search, txn
+from models.search import (SearchTerm, SearchDoc, PART_SIZE, TERM_SHARDS,
+                           encode_postings)
+
+from tests import BlogTestCase
+
+
+class SearchTestCase(BlogTestCase):
+    """ Base class of the search tests, with a user to write posts """
+    def setUp(self):
+        BlogTestCase.setUp(self)
+        self.author = self.make_user('alice')
+
+    def add_post(self, subject, content):
+        """ Adds and indexes a post, returning its id """
+        blog_id = self.make_post(self.author, subject, content).get_id()
+        search.index_post(blog_id)
+        return blog_id
+
+
+class ShardTest(SearchTestCase):
+    """ Documents indexed one after another write to different shards of
+    a term, and searches read all of them
+    """
+    def test_shards(self):
+        ids = [self.add_post('Post %d' % i, 'common words')
+               for i in range(2 * TERM_SHARDS)]
+        base = SearchTerm.get(SearchTerm.term_key('common'))
+        shards = [(0, 0)] + base.other_shards()
+        self.assertEqual(len(shards), TERM_SHARDS)
+        entities = db.get([SearchTerm.term_key('common', *shard)
+                           for shard in shards])
+        self.assertEqual(sum(entity.count for entity in entities),
+                         len(ids))
+        docs, more = search.search('common', limit=len(ids))
+        self.assertEqual(sorted(doc.blog_id for doc in docs), sorted(ids))
+        # Unindexing empties and unlists the shards
+        for blog_id in ids:
+            search.unindex_post(blog_id)
+        self.assertIsNone(SearchTerm.get(SearchTerm.term_key('common')))
+        self.assertEqual(search.search('common'), ([], False))
+
+    def test_legacy_postings_move(self):
+        blog_id = self.add_post('Legacy', 'moved words')
+        name = search.post_doc_name(blog_id)
+        num = search.SearchName.get_by_key_name(name).num
+        self.assertNotEqual(num % TERM_SHARDS, 0)
+        # Put the postings where an unsharded index kept them
+        for term in ('moved', 'words'):
+            entity = SearchTerm.get(SearchTerm.term_key(term, 0,
+                                                        num % TERM_SHARDS))
+            entity.delete()
+            SearchTerm(key=SearchTerm.term_key(term), count=1, last=num,
+                       postings=encode_postings([(num, 1, 3)])).put()
+        # Reindexing the edited post moves the postings that changed to
+        # their shards
+        search.index_doc(name, blog_id, None, 'Legacy', 'moved text')
+        self.assertIsNone(SearchTerm.get(SearchTerm.term_key('words')))
+        self.assertEqual(search.search('words'), ([], False))
+        docs, more = search.search('moved')
+        self.assertEqual([doc.blog_id for doc in docs], [blog_id])
+
+
+class GroupsTest(SearchTestCase):
+    """ Indexing a document stays within App Engine's limit on the entity
+    groups of a transaction, past the first partition too
+    """
+    def test_groups_per_transaction(self):
+        # Skip the first partition's document numbers
+        db.allocate_ids(db.Key.from_path(SearchDoc.kind(), 1), PART_SIZE)
+        content = ' '.join('term%d' % i for i in range(40))
+        engine = local.get_engine()
+        counts = []
+        run_in_transaction_options = db.run_in_transaction_options
+
+        def counting(options, function, *args, **kwargs):
+            def counted():
+                result = function(*args, **kwargs)
+                counts.append(len(engine.local.groups))
+                return result
+            return run_in_transaction_options(options, counted)
+        txn.db.run_in_transaction_options = counting
+        try:
+            blog_id = self.add_post('Subject', content)
+        finally:
+            txn.db.run_in_transaction_options = run_in_transaction_options
+        num = search.SearchName.get_by_key_name(
+            search.post_doc_name(blog_id)).num
+        self.assertTrue(num >= PART_SIZE and num % TERM_SHARDS)
+        self.assertTrue(counts)
+        self.assertEqual(max(counts), 3 * search.TERMS_PER_TXN)
+        self.assertTrue(max(counts) <= local.MAX_TXN_GROUPS)
+
+    def test_limit_enforced(self):
+        keys = [SearchTerm.term_key('term%d' % i)
+                for i in range(local.MAX_TXN_GROUPS + 1)]
+        self.assertRaises(db.BadRequestError, txn.run_in_txn, db.get, keys)
+
+
+class CapTest(SearchTestCase):
+    """ A search scores at most MAX_SCORED_POSTINGS postings, rarest
+    terms first
+    """
+    def test_cap(self):
+        for i in range(20):
+            self.add_post('Post %d' % i, 'common words')
+        rare = self.add_post('Rare', 'common rare')
+        old_cap = search.MAX_SCORED_POSTINGS
+        search.MAX_SCORED_POSTINGS = 5
+        try:
+            docs, more = search.search('common rare', limit=100)
+        finally:
+            search.MAX_SCORED_POSTINGS = old_cap
+        self.assertEqual(docs[0].blog_id, rare)
+        self.assertLess(len(docs), 21)
@@ -46,3 +46,22 @@ def check_secure_cookie(h):
     val = h.split('|')[0]
     if h == make_secure_cookie(val):
         return val
+
+
+# Helper functions for session tokens, which carry the user's id and
+# name so most pages don't need to look up the user
+def make_session_token(uid, name):
+    # usernames are plain ASCII (see USER_RE), so keep the cookie a str
+    return make_secure_cookie('%d:%s' % (int(uid), str(name)))
+
+def check_session_token(h):
+    """ Returns (uid, name) from a valid session token, or None.
+    Older tokens only hold the user id, in which case name is None.
+    """
+    val = h and check_secure_cookie(h)
+    if not val:
+        return None
+    uid, sep, name = val.partition(':')
+    if not uid.isdigit():
+        return None
+    return int(uid), name or None